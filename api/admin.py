@@ -1,7 +1,8 @@
 from django.contrib import admin
 
-from .models import TopMovies, Movie
+from .models import Film, TopMovies, Movie
 
 
+admin.site.register(Film)
 admin.site.register(TopMovies)
 admin.site.register(Movie)
\ No newline at end of file
@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from . import cache, events
+
+        # A backend that cannot serve this deployment fails at start up
+        # rather than on the first change.
+        events.get_backend()
@@ -0,0 +1,207 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers import asgi
+from django.db import close_old_connections, connection
+from django.http import HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.urls import URLPattern, path
+from whitenoise import middleware as whitenoise
+
+from . import events, renderers, urls
+from .models import TopMovies
+from .timing import AsyncCapableMiddleware, query_wrappers
+
+ASYNC_ROUTES = ['TopMovies-detail', 'Movie-detail']
+
+executor = None
+
+asgi_receive = contextvars.ContextVar('asgi_receive')
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'API_ASYNC_THREADS', 8), thread_name_prefix='api-sync',
+        )
+    return executor
+
+
+def call_in_thread(func, *args, **kwargs):
+    # Query wrappers of the middleware follow the request to this thread.
+    with ExitStack() as stack:
+        for wrapper in query_wrappers.get():
+            if wrapper not in connection.execute_wrappers:
+                stack.enter_context(connection.execute_wrapper(wrapper))
+        return func(*args, **kwargs)
+
+
+def call_in_pool(func, *args, **kwargs):
+    # Pool threads keep their own connections, so they are recycled the way
+    # request_started does for request threads.
+    close_old_connections()
+    return call_in_thread(func, *args, **kwargs)
+
+
+async def run_sync(func, *args, **kwargs):
+    # Blocking ORM and cache calls run on a bounded pool, so a worker serves
+    # as many requests at once as it has threads and database connections.
+    # With API_ASYNC_THREADS = 0 they run thread-sensitively instead.
+    if not getattr(settings, 'API_ASYNC_THREADS', 8):
+        return await sync_to_async(call_in_thread)(func, *args, **kwargs)
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, call_in_pool, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), call)
+
+
+def render_view(view, request, *args, **kwargs):
+    response = view(request, *args, **kwargs)
+    if callable(getattr(response, 'render', None)):
+        response = response.render()
+    return response
+
+
+def async_view(view):
+    # The async variant keeps the name, actions and csrf_exempt flag of the
+    # DRF view it runs, and renders on the pool as well.
+    async def wrapper(request, *args, **kwargs):
+        return await run_sync(render_view, view, request, *args, **kwargs)
+    return functools.update_wrapper(wrapper, view)
+
+
+def async_urlpattern(pattern):
+    if not isinstance(pattern, URLPattern) or \
+            pattern.callback is not urls.api_root and pattern.name not in ASYNC_ROUTES:
+        return pattern
+    return URLPattern(pattern.pattern, async_view(pattern.callback), pattern.default_args, pattern.name)
+
+
+class EventStreamResponse(StreamingHttpResponse):
+
+    # Django 3.1 only streams sync iterators, so the async stream of events
+    # is sent by ASGIHandler below.
+    def __init__(self, events, **kwargs):
+        super().__init__((), content_type='text/event-stream', **kwargs)
+        self.events = events
+        self['Cache-Control'] = 'no-cache'
+        self['X-Accel-Buffering'] = 'no'
+
+
+def format_event(event):
+    return b'id: %s\nevent: %s\ndata: %s\n\n' % (
+        event.id.encode(), event.type.encode(), renderers.get_backend().dumps(event.data),
+    )
+
+
+async def stream_events(top_movies_id, last_event_id=None):
+    heartbeat = getattr(settings, 'API_EVENTS_HEARTBEAT', 15)
+    with events.get_backend().subscribe(top_movies_id, last_event_id) as subscription:
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), heartbeat)
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing an idle connection.
+                yield b': heartbeat\n\n'
+            else:
+                yield format_event(event)
+
+
+async def list_events(request, pk):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    if not await run_sync(TopMovies.objects.filter(pk=pk).exists):
+        return JsonResponse({'detail': 'Not found.'}, status=404)
+    return EventStreamResponse(stream_events(pk, request.headers.get('Last-Event-ID')))
+
+
+# The routes of api.urls in the same order, so e.g. top-movies/new/ still
+# wins over the list detail route. Only the hot reads are swapped.
+urlpatterns = [async_urlpattern(pattern) for pattern in urls.urlpatterns] + [
+    path('top-movies/<int:pk>/events/', list_events, name='TopMovies-events'),
+]
+
+
+class ASGIHandler(asgi.ASGIHandler):
+
+    async def __call__(self, scope, receive, send):
+        token = asgi_receive.set(receive)
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            asgi_receive.reset(token)
+
+    async def send_response(self, response, send):
+        if not isinstance(response, EventStreamResponse):
+            return await super().send_response(response, send)
+
+        async def send_events(message):
+            # The events go between the headers and the final empty body.
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                await self.stream(response, send)
+            await send(message)
+
+        await super().send_response(response, send_events)
+
+    async def stream(self, response, send):
+        async def forward():
+            async for chunk in response.events:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        async def disconnect():
+            receive = asgi_receive.get()
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        tasks = [asyncio.ensure_future(forward()), asyncio.ensure_future(disconnect())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+
+class AsyncRoutingMiddleware(AsyncCapableMiddleware):
+
+    # Under ASGI, requests resolve against API_ASYNC_URLCONF, which puts the
+    # async views above in front of the regular URLconf.
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if not asyncio.iscoroutinefunction(get_response) or not getattr(settings, 'API_ASYNC_URLCONF', None):
+            raise MiddlewareNotUsed
+
+    async def __call__(self, request):
+        request.urlconf = settings.API_ASYNC_URLCONF
+        return await self.get_response(request)
+
+
+class WhiteNoiseMiddleware(whitenoise.WhiteNoiseMiddleware):
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        # Looking up a static file is a dict lookup outside of DEBUG.
+        response = self.process_request(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
@@ -0,0 +1,63 @@
+import csv
+import io
+from collections import defaultdict
+
+from django.db import connection, transaction
+
+from .models import RANK_GAP, Film, TopMovies, Movie, borda_points
+
+SCORE_CHUNK_SIZE = 500
+
+
+def write_lists(lists, use_copy=False):
+    # lists holds unsaved (TopMovies, [movie dicts]) pairs; the movies are
+    # already cleaned and in rank order. Returns the number of Movie rows.
+    with transaction.atomic():
+        if connection.features.can_return_rows_from_bulk_insert:
+            TopMovies.objects.bulk_create([top_movies for top_movies, movies in lists])
+        else:
+            for top_movies, movies in lists:
+                top_movies.save()
+        films = Film.objects.get_films([movie for top_movies, movies in lists for movie in movies])
+        rows = []
+        scores = defaultdict(int)
+        list_counts = defaultdict(int)
+        for top_movies, movies in lists:
+            for rank, movie in enumerate(movies, start=1):
+                film_id = films[movie['tmdb_id']].pk
+                if top_movies.rank_mode == TopMovies.SPARSE:
+                    rows.append((None, rank * RANK_GAP, film_id, top_movies.pk))
+                else:
+                    rows.append((rank, rank, film_id, top_movies.pk))
+                scores[film_id] += borda_points(rank)
+                list_counts[film_id] += 1
+        if use_copy:
+            copy_movies(rows)
+        else:
+            Movie.objects.bulk_create([
+                Movie(rank=rank, position=position, film_id=film_id, top_movies_id=top_movies_id)
+                for rank, position, film_id, top_movies_id in rows
+            ], batch_size=5000)
+        film_ids = list(scores)
+        for i in range(0, len(film_ids), SCORE_CHUNK_SIZE):
+            chunk = film_ids[i:i + SCORE_CHUNK_SIZE]
+            Film.objects.add_scores(
+                {film_id: scores[film_id] for film_id in chunk},
+                {film_id: list_counts[film_id] for film_id in chunk},
+            )
+    return len(rows)
+
+
+def copy_movies(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    columns = ', '.join(
+        connection.ops.quote_name(Movie._meta.get_field(name).column)
+        for name in ('rank', 'position', 'film', 'top_movies')
+    )
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY {connection.ops.quote_name(Movie._meta.db_table)} ({columns}) FROM STDIN WITH (FORMAT csv)',
+            buffer,
+        )
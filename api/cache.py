@@ -0,0 +1,86 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.dispatch import receiver
+
+from .signals import list_changed
+
+
+class PayloadCache:
+
+    prefix = 'top-movies'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'API_CACHE_ALIAS', 'default')]
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'API_CACHE_TIMEOUT', 300)
+
+    def version_key(self, top_movies_id):
+        return f'{self.prefix}:{top_movies_id}:version'
+
+    def get_version(self, top_movies_id):
+        key = self.version_key(top_movies_id)
+        version = self.cache.get(key)
+        if version is None:
+            # A fresh timestamp never matches payloads cached under a version
+            # that has since been evicted.
+            self.cache.add(key, time.time_ns(), None)
+            version = self.cache.get(key)
+        return version
+
+    def bump_version(self, top_movies_id):
+        key = self.version_key(top_movies_id)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, time.time_ns(), None)
+
+    def payload_key(self, top_movies_id, revision, variant):
+        version = self.get_version(top_movies_id)
+        return f'{self.prefix}:{top_movies_id}:{revision}:{version}:{variant}'
+
+    def get(self, key):
+        payload = self.cache.get(key)
+        with self.lock:
+            if payload is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return payload
+
+    def set(self, key, payload):
+        self.cache.set(key, payload, self.timeout)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = self.misses = 0
+
+
+payload_cache = PayloadCache()
+
+
+def invalidate(top_movies_id):
+    payload_cache.bump_version(top_movies_id)
+    # Bump again once the transaction commits so that a payload rendered
+    # from the old rows in the meantime is never served.
+    transaction.on_commit(lambda: payload_cache.bump_version(top_movies_id))
+
+
+@receiver(list_changed)
+def invalidate_changed_list(sender, top_movies_id, **kwargs):
+    invalidate(top_movies_id)
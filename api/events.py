@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import os
+import secrets
+import select
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, connections, transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from . import renderers
+from .signals import rank_changed
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 100
+MAX_TOPICS = 1000
+
+Event = namedtuple('Event', ['id', 'type', 'data'])
+
+
+class Subscription:
+
+    def __init__(self, backend, topic, replay):
+        self.backend = backend
+        self.topic = topic
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(max(QUEUE_SIZE, len(replay)))
+        self.overflowed = False
+        for event in replay:
+            self.queue.put_nowait(event)
+
+    def put(self, event):
+        # Runs on the event loop. A client too slow to keep up starts over
+        # from a reset rather than holding on to an ever longer queue.
+        if self.queue.full():
+            self.overflowed = True
+        else:
+            self.queue.put_nowait(event)
+
+    async def get(self):
+        if self.overflowed:
+            self.overflowed = False
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            return self.backend.reset_event(self.topic)
+        return await self.queue.get()
+
+    def close(self):
+        self.backend.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Topic:
+
+    def __init__(self, history, resumable_after):
+        self.history = deque(maxlen=history)
+        self.subscribers = set()
+        # Ids after this one are all still in the history.
+        self.resumable_after = resumable_after
+
+
+class LocalBackend:
+
+    # Delivers events to subscribers in this process only, so it refuses to
+    # run under several workers, where most viewers would never hear of a
+    # change made through another one.
+    def __init__(self):
+        if type(self) is LocalBackend and int(os.environ.get('WEB_CONCURRENCY') or 1) > 1:
+            raise ImproperlyConfigured(
+                'LocalBackend only reaches viewers connected to the same process. '
+                'Set API_EVENTS_BACKEND to a shared backend such as api.events.PostgresBackend '
+                'when running more than one worker.'
+            )
+        self.lock = threading.Lock()
+        self.epoch = secrets.token_hex(4)
+        self.last_id = 0
+        self.topics = OrderedDict()
+
+    @property
+    def history(self):
+        return getattr(settings, 'API_EVENTS_HISTORY', 100)
+
+    def format_id(self, number):
+        return f'{self.epoch}-{number}'
+
+    def parse_id(self, event_id):
+        epoch, _, number = (event_id or '').partition('-')
+        if epoch != self.epoch or not number.isdigit():
+            return None
+        return int(number)
+
+    def get_topic(self, topic):
+        if topic not in self.topics:
+            self.topics[topic] = Topic(self.history, self.last_id)
+            # Only the history of lists nobody listens to is forgotten.
+            for name in list(self.topics):
+                if len(self.topics) <= MAX_TOPICS:
+                    break
+                if name != topic and not self.topics[name].subscribers:
+                    del self.topics[name]
+        self.topics.move_to_end(topic)
+        return self.topics[topic]
+
+    def reset_event(self, topic):
+        # Tells the client to fetch the list again, and where to resume from.
+        return Event(self.format_id(self.last_id), 'reset', {'top_movies': topic})
+
+    def publish(self, topic, event, data):
+        with self.lock:
+            self.last_id += 1
+            event = Event(self.format_id(self.last_id), event, data)
+            state = self.get_topic(topic)
+            if len(state.history) == state.history.maxlen:
+                state.resumable_after = self.parse_id(state.history[0].id)
+            state.history.append(event)
+            subscribers = list(state.subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # The loop of an abandoned subscription is closed.
+                self.unsubscribe(subscription)
+        return event
+
+    def subscribe(self, topic, last_event_id=None):
+        # Replaying and subscribing under one lock, so no event falls between.
+        with self.lock:
+            state = self.get_topic(topic)
+            replay = []
+            if last_event_id is not None:
+                last_id = self.parse_id(last_event_id)
+                if last_id is None or last_id < state.resumable_after:
+                    replay = [self.reset_event(topic)]
+                else:
+                    replay = [event for event in state.history if self.parse_id(event.id) > last_id]
+            subscription = Subscription(self, topic, replay)
+            state.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            state = self.topics.get(subscription.topic)
+            if state is not None:
+                state.subscribers.discard(subscription)
+
+    def subscriber_count(self, topic):
+        with self.lock:
+            state = self.topics.get(topic)
+            return len(state.subscribers) if state is not None else 0
+
+
+class PostgresBackend(LocalBackend):
+
+    # Fans events out to every process through LISTEN/NOTIFY on the default
+    # database. Each process keeps the history of the events it received, so
+    # ids stay local and a client resuming on another process gets a reset.
+    channel = 'api_events'
+
+    def __init__(self):
+        super().__init__()
+        self.listener = None
+
+    def publish(self, topic, event, data):
+        payload = renderers.get_backend().dumps({'topic': topic, 'event': event, 'data': data})
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, payload.decode()])
+
+    def deliver(self, payload):
+        message = renderers.get_backend().loads(payload)
+        return super().publish(message['topic'], message['event'], message['data'])
+
+    def subscribe(self, topic, last_event_id=None):
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.listen, name='api-events', daemon=True)
+                self.listener.start()
+        return super().subscribe(topic, last_event_id)
+
+    def listen(self):
+        while True:
+            try:
+                self.listen_once()
+            except Exception:
+                logger.exception('Lost the events connection, reconnecting')
+                time.sleep(1)
+            # Whatever was sent while the connection was down is gone.
+            with self.lock:
+                topics = [name for name, state in self.topics.items() if state.subscribers]
+            for topic in topics:
+                super().publish(topic, 'reset', {'top_movies': topic})
+
+    def listen_once(self):
+        # A connection of its own, which does nothing but wait for notifies.
+        db = connections['default']
+        conn = db.get_new_connection(db.get_connection_params())
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {self.channel}')
+            while True:
+                select.select([conn], [], [], 5)
+                conn.poll()
+                while conn.notifies:
+                    self.deliver(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+
+backends = {}
+
+
+def get_backend():
+    path = getattr(settings, 'API_EVENTS_BACKEND', 'api.events.LocalBackend')
+    if path not in backends:
+        backends[path] = import_string(path)()
+    return backends[path]
+
+
+def publish(top_movies_id, event, data):
+    return get_backend().publish(top_movies_id, event, data)
+
+
+@receiver(rank_changed)
+def publish_rank_change(sender, top_movies_id, event, data, **kwargs):
+    # Viewers only hear about changes that were committed.
+    transaction.on_commit(lambda: publish(top_movies_id, event, data))
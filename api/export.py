@@ -0,0 +1,80 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import FILM_FIELDS, TopMovies, Movie
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+LIST_FIELDS = ['id', 'title', 'rank_mode']
+CSV_HEADER = ['top_movies', 'top_movies_title', 'rank_mode', 'rank'] + FILM_FIELDS
+BUFFER_SIZE = 64 * 1024
+
+
+class Echo:
+
+    def write(self, value):
+        return value
+
+
+def iter_lists(min_id=None, max_id=None, chunk_size=2000):
+    lists = TopMovies.objects.order_by('id')
+    movies = Movie.objects.order_by('top_movies_id', 'position', 'id')
+    if min_id is not None:
+        lists = lists.filter(pk__gte=min_id)
+        movies = movies.filter(top_movies__gte=min_id)
+    if max_id is not None:
+        lists = lists.filter(pk__lte=max_id)
+        movies = movies.filter(top_movies__lte=max_id)
+    # Both querysets walk the same id range in the same order, so lists and
+    # their movies are merged from two cursors without holding either in memory.
+    movie_rows = movies.values_list(
+        'top_movies', *[f'film__{name}' for name in FILM_FIELDS]
+    ).iterator(chunk_size=chunk_size)
+    movie = next(movie_rows, None)
+    for top_movies in lists.values(*LIST_FIELDS).iterator(chunk_size=chunk_size):
+        while movie is not None and movie[0] < top_movies['id']:
+            movie = next(movie_rows, None)
+        ranked = []
+        while movie is not None and movie[0] == top_movies['id']:
+            ranked.append({'rank': len(ranked) + 1, **dict(zip(FILM_FIELDS, movie[1:]))})
+            movie = next(movie_rows, None)
+        yield top_movies, ranked
+
+
+def render_ndjson(lists):
+    for top_movies, movies in lists:
+        yield json.dumps({**top_movies, 'movie': movies}, cls=DjangoJSONEncoder) + '\n'
+
+
+def render_csv(lists):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    for top_movies, movies in lists:
+        values = [top_movies[name] for name in LIST_FIELDS]
+        if not movies:
+            yield writer.writerow(values + [''] * (len(CSV_HEADER) - len(values)))
+        for movie in movies:
+            yield writer.writerow(values + [movie['rank']] + [movie[name] for name in FILM_FIELDS])
+
+
+def buffered(lines, size=BUFFER_SIZE):
+    buffer = []
+    length = 0
+    for line in lines:
+        buffer.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def export_lists(export_format, min_id=None, max_id=None, chunk_size=2000):
+    render = render_csv if export_format == 'csv' else render_ndjson
+    return buffered(render(iter_lists(min_id, max_id, chunk_size)))
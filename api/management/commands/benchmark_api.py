@@ -0,0 +1,221 @@
+import json
+import platform
+import random
+import subprocess
+import time
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from api.cache import payload_cache
+from api.models import MAX_MOVIES, Film, TopMovies, Movie
+
+API_PATH = '/api/v1'
+TMDB_PREFIX = 'bench-'
+ENDPOINTS = [
+    'new', 'add', 'move_rank_up', 'move_rank_down', 'delete_rank',
+    'top_movies_list', 'top_movies_detail', 'top_movies_detail_cached', 'movie_list', 'movie_detail',
+]
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = max(int(round(percent / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+
+    help = 'Benchmarks the ranking endpoints against seeded lists and prints the results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lists', type=int, default=50, help='Lists to seed.')
+        parser.add_argument('--list-size', type=int, default=50, help='Movies per seeded list.')
+        parser.add_argument('--films', type=int, default=500, help='Distinct films to draw movies from.')
+        parser.add_argument('--requests', type=int, default=100, help='Requests per endpoint.')
+        parser.add_argument('--endpoint', action='append', choices=ENDPOINTS,
+                            help='Endpoint to run, may be repeated. Defaults to all of them.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='File to write the JSON report to instead of stdout.')
+        parser.add_argument('--keep-data', action='store_true',
+                            help='Keep the seeded lists and every change made by the requests.')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.client = Client()
+        self.films = [
+            {
+                'tmdb_id': f'{TMDB_PREFIX}{i}',
+                'title': f'Benchmark film {i}',
+                'release_date': f'{1950 + i % 70}-01-01',
+                'poster_path': '',
+            }
+            for i in range(options['films'])
+        ]
+        # Every request commits on its own, as it would in production, so
+        # the lists are deleted again afterwards rather than rolled back.
+        self.lists = {}
+        try:
+            self.seed(options['lists'], min(options['list_size'], MAX_MOVIES))
+            endpoints = {
+                name: self.measure(name, options['requests'])
+                for name in options['endpoint'] or ENDPOINTS
+            }
+        finally:
+            if not options['keep_data']:
+                TopMovies.objects.filter(pk__in=self.lists).delete()
+                Film.objects.filter(tmdb_id__startswith=TMDB_PREFIX, movie=None).delete()
+        report = json.dumps({
+            'meta': {
+                'commit': get_commit(),
+                'vendor': connection.vendor,
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'lists': options['lists'],
+                'list_size': options['list_size'],
+                'films': options['films'],
+                'requests': options['requests'],
+                'seed': options['seed'],
+            },
+            'endpoints': endpoints,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report + '\n')
+        else:
+            self.stdout.write(report)
+
+    def seed(self, lists, list_size):
+        for i in range(lists):
+            top_movies = TopMovies.objects.create(title=f'Benchmark list {i}')
+            Movie.objects.create_movies(top_movies, self.random.sample(self.films, list_size))
+            self.lists[top_movies.pk] = dict(top_movies.movie.values_list('id', 'film__tmdb_id'))
+
+    def measure(self, name, requests):
+        latencies = []
+        queries = []
+        errors = 0
+        for i in range(requests):
+            request = getattr(self, f'request_{name}')()
+            if request is None:
+                break
+            method, path, data, on_response = request
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                if data is None:
+                    response = getattr(self.client, method)(path)
+                else:
+                    response = getattr(self.client, method)(
+                        path, data=json.dumps(data), content_type='application/json',
+                    )
+                latencies.append(time.perf_counter() - started)
+            queries.append(len(context))
+            if 200 <= response.status_code < 300:
+                if on_response is not None:
+                    on_response(response)
+            else:
+                errors += 1
+        if not latencies:
+            return {'requests': 0, 'errors': 0}
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput_rps': round(len(latencies) / sum(latencies), 1),
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies) * 1000, 3),
+                'p50': round(percentile(latencies, 50) * 1000, 3),
+                'p90': round(percentile(latencies, 90) * 1000, 3),
+                'p99': round(percentile(latencies, 99) * 1000, 3),
+                'max': round(max(latencies) * 1000, 3),
+            },
+            'queries': {
+                'mean': round(sum(queries) / len(queries), 2),
+                'max': max(queries),
+            },
+        }
+
+    def pick_list(self, condition=lambda movies: True):
+        candidates = [pk for pk, movies in self.lists.items() if condition(movies)]
+        return self.random.choice(candidates) if candidates else None
+
+    def pick_movie(self):
+        top_movies_id = self.pick_list(lambda movies: len(movies) > 1)
+        if top_movies_id is None:
+            return None, None
+        return top_movies_id, self.random.choice(list(self.lists[top_movies_id]))
+
+    def request_new(self):
+        film = self.random.choice(self.films)
+
+        def on_response(response):
+            self.lists[response.data['top_movies']] = {response.data['id']: film['tmdb_id']}
+
+        return 'post', f'{API_PATH}/top-movies/new/', film, on_response
+
+    def request_add(self):
+        top_movies_id = self.pick_list(lambda movies: len(movies) < MAX_MOVIES)
+        if top_movies_id is None:
+            return None
+        movies = self.lists[top_movies_id]
+        listed = set(movies.values())
+        film = self.random.choice([film for film in self.films if film['tmdb_id'] not in listed] or self.films)
+
+        def on_response(response):
+            movies[response.data['id']] = film['tmdb_id']
+
+        return 'post', f'{API_PATH}/top-movies/{top_movies_id}/add/', film, on_response
+
+    def request_move_rank_up(self):
+        top_movies_id, movie_id = self.pick_movie()
+        if movie_id is None:
+            return None
+        return 'put', f'{API_PATH}/top-movie/{movie_id}/move-rank-up/', None, None
+
+    def request_move_rank_down(self):
+        top_movies_id, movie_id = self.pick_movie()
+        if movie_id is None:
+            return None
+        return 'put', f'{API_PATH}/top-movie/{movie_id}/move-rank-down/', None, None
+
+    def request_delete_rank(self):
+        top_movies_id, movie_id = self.pick_movie()
+        if movie_id is None:
+            return None
+
+        def on_response(response):
+            del self.lists[top_movies_id][movie_id]
+
+        return 'delete', f'{API_PATH}/top-movie/{movie_id}/delete-rank/', None, on_response
+
+    def request_top_movies_list(self):
+        return 'get', f'{API_PATH}/top-movies/', None, None
+
+    def request_top_movies_detail(self):
+        top_movies_id = self.pick_list()
+        # Measure a cache miss: the payload cached by earlier requests is dropped.
+        payload_cache.bump_version(top_movies_id)
+        return 'get', f'{API_PATH}/top-movies/{top_movies_id}/', None, None
+
+    def request_top_movies_detail_cached(self):
+        return 'get', f'{API_PATH}/top-movies/{self.pick_list()}/', None, None
+
+    def request_movie_list(self):
+        return 'get', f'{API_PATH}/top-movie/', None, None
+
+    def request_movie_detail(self):
+        top_movies_id, movie_id = self.pick_movie()
+        if movie_id is None:
+            return None
+        return 'get', f'{API_PATH}/top-movie/{movie_id}/', None, None
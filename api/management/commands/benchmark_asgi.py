@@ -0,0 +1,182 @@
+import asyncio
+import io
+import json
+import random
+import sys
+import time
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from api.models import MAX_MOVIES, Film, TopMovies, Movie
+from api.timing import wrap_queries
+
+from .benchmark_api import API_PATH, percentile
+
+TMDB_PREFIX = 'asgi-bench-'
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Compares one WSGI worker, serving a request at a time, with one ASGI worker serving '
+        'concurrent requests, on the list detail, movie detail and root endpoints.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lists', type=int, default=20, help='Lists to seed.')
+        parser.add_argument('--list-size', type=int, default=50, help='Movies per seeded list.')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per server.')
+        parser.add_argument('--concurrency', type=int, default=32, help='Requests in flight against ASGI.')
+        parser.add_argument('--db-latency-ms', type=float, default=2.0,
+                            help='Round trip added to every query, as to a database over the network.')
+        parser.add_argument('--cached', action='store_true', help='Serve lists from the payload cache.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='File to write the JSON report to instead of stdout.')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        # Requests are served from other threads, so the lists are committed
+        # and deleted again afterwards.
+        self.seed(options['lists'], min(options['list_size'], MAX_MOVIES))
+        try:
+            paths = [self.pick_path() for i in range(options['requests'])]
+            latency = options['db_latency_ms'] / 1000
+
+            def sleep(execute, sql, params, many, context):
+                time.sleep(latency)
+                return execute(sql, params, many, context)
+
+            cache_timeout = {} if options['cached'] else {'API_CACHE_TIMEOUT': 0}
+            with override_settings(**cache_timeout), wrap_queries(sleep):
+                servers = {
+                    'wsgi': self.run_wsgi(paths),
+                    'asgi': asyncio.run(self.run_asgi(paths, options['concurrency'])),
+                }
+        finally:
+            TopMovies.objects.filter(pk__in=self.lists).delete()
+            Film.objects.filter(tmdb_id__startswith=TMDB_PREFIX).delete()
+        servers['asgi']['speedup'] = round(
+            servers['asgi']['throughput_rps'] / servers['wsgi']['throughput_rps'], 2,
+        )
+        report = json.dumps({
+            'meta': {
+                'lists': options['lists'],
+                'list_size': options['list_size'],
+                'requests': options['requests'],
+                'concurrency': options['concurrency'],
+                'db_latency_ms': options['db_latency_ms'],
+                'cached': options['cached'],
+                'seed': options['seed'],
+            },
+            'servers': servers,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report + '\n')
+        else:
+            self.stdout.write(report)
+
+    def seed(self, lists, list_size):
+        films = [
+            {
+                'tmdb_id': f'{TMDB_PREFIX}{i}',
+                'title': f'Benchmark film {i}',
+                'release_date': f'{1950 + i % 70}-01-01',
+                'poster_path': '',
+            }
+            for i in range(list_size * 2)
+        ]
+        self.lists = {}
+        for i in range(lists):
+            top_movies = TopMovies.objects.create(title=f'ASGI benchmark list {i}')
+            Movie.objects.create_movies(top_movies, self.random.sample(films, list_size))
+            self.lists[top_movies.pk] = list(top_movies.movie.values_list('id', flat=True))
+
+    def pick_path(self):
+        top_movies_id = self.random.choice(list(self.lists))
+        return self.random.choice([
+            f'{API_PATH}/',
+            f'{API_PATH}/top-movies/{top_movies_id}/',
+            f'{API_PATH}/top-movie/{self.random.choice(self.lists[top_movies_id])}/',
+        ])
+
+    def run_wsgi(self, paths):
+        application = WSGIHandler()
+        statuses = []
+
+        def start_response(status, headers, exc_info=None):
+            statuses.append(int(status.split()[0]))
+
+        latencies = []
+        started = time.perf_counter()
+        for path in paths:
+            request_started = time.perf_counter()
+            response = application({
+                'REQUEST_METHOD': 'GET',
+                'PATH_INFO': path,
+                'QUERY_STRING': '',
+                'SERVER_NAME': 'testserver',
+                'SERVER_PORT': '80',
+                'HTTP_HOST': 'testserver',
+                'wsgi.url_scheme': 'http',
+                'wsgi.input': io.BytesIO(),
+                'wsgi.errors': sys.stderr,
+            }, start_response)
+            b''.join(response)
+            response.close()
+            latencies.append(time.perf_counter() - request_started)
+        return self.summarize(latencies, statuses, time.perf_counter() - started)
+
+    async def run_asgi(self, paths, concurrency):
+        application = ASGIHandler()
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        statuses = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+
+        async def request(path):
+            async with semaphore:
+                request_started = time.perf_counter()
+                await application({
+                    'type': 'http',
+                    'asgi': {'version': '3.0'},
+                    'http_version': '1.1',
+                    'method': 'GET',
+                    'scheme': 'http',
+                    'path': path,
+                    'raw_path': path.encode(),
+                    'query_string': b'',
+                    'root_path': '',
+                    'headers': [(b'host', b'testserver')],
+                    'client': ('127.0.0.1', 0),
+                    'server': ('testserver', 80),
+                }, receive, send)
+                latencies.append(time.perf_counter() - request_started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[request(path) for path in paths])
+        return self.summarize(latencies, statuses, time.perf_counter() - started)
+
+    def summarize(self, latencies, statuses, elapsed):
+        return {
+            'requests': len(latencies),
+            'errors': sum(1 for status in statuses if status >= 400),
+            'throughput_rps': round(len(latencies) / elapsed, 1),
+            # Average number of requests in flight.
+            'concurrency': round(sum(latencies) / elapsed, 2),
+            'latency_ms': {
+                'p50': round(percentile(latencies, 50) * 1000, 3),
+                'p90': round(percentile(latencies, 90) * 1000, 3),
+                'p99': round(percentile(latencies, 99) * 1000, 3),
+                'max': round(max(latencies) * 1000, 3),
+            },
+        }
@@ -0,0 +1,60 @@
+import json
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework import renderers
+
+from api.models import MAX_MOVIES, TopMovies, Movie
+from api.renderers import BACKENDS
+from api.serializers import TopMoviesSerializer
+
+TITLES = ['The Godfather', 'Amélie', 'Spirited Away', 'Léon: The Professional', 'Casablanca', '8½ Women']
+
+
+class Command(BaseCommand):
+
+    help = 'Compares JSON render throughput of the available backends on serialized lists.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--movies', type=int, default=MAX_MOVIES, help='Movies in the rendered list.')
+        parser.add_argument('--iterations', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        data = self.get_payload(options['movies'])
+        expected = renderers.JSONRenderer().render(data)
+        candidates = {'drf': lambda: renderers.JSONRenderer().render(data)}
+        for name, backend in BACKENDS.items():
+            candidates[name] = lambda backend=backend: backend.dumps(data)
+        results = {}
+        for name, render in candidates.items():
+            content = render()
+            started = time.perf_counter()
+            for i in range(options['iterations']):
+                render()
+            elapsed = time.perf_counter() - started
+            results[name] = {
+                'renders_per_second': round(options['iterations'] / elapsed),
+                'mb_per_second': round(len(content) * options['iterations'] / elapsed / 1e6, 1),
+                'identical_to_drf': content == expected,
+            }
+        report = {'movies': options['movies'], 'bytes': len(expected), 'backends': results}
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def get_payload(self, movie_count):
+        # The list only exists long enough to be serialized.
+        with transaction.atomic():
+            top_movies = TopMovies.objects.create(title='Benchmark')
+            Movie.objects.create_movies(top_movies, [
+                {
+                    'tmdb_id': f'render-bench-{i}',
+                    'title': f'{TITLES[i % len(TITLES)]} {i}',
+                    'release_date': date(1950, 1, 1) + timedelta(days=i * 197),
+                    'poster_path': f'https://image.tmdb.org/t/p/w500/poster-{i}.jpg',
+                }
+                for i in range(movie_count)
+            ])
+            data = TopMoviesSerializer(TopMovies.objects.with_movies().get(pk=top_movies.pk)).data
+            transaction.set_rollback(True)
+        return data
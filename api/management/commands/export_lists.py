@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from api.export import EXPORT_FORMATS, export_lists
+
+
+class Command(BaseCommand):
+
+    help = 'Streams every list and its ranked movies as NDJSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='ndjson')
+        parser.add_argument('--min-id', type=int, help='Export lists with at least this id.')
+        parser.add_argument('--max-id', type=int, help='Export lists with at most this id.')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--output', help='File to write to instead of stdout.')
+
+    def handle(self, *args, **options):
+        chunks = export_lists(options['format'], options['min_id'], options['max_id'], options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', newline='') as output:
+                output.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,261 @@
+import gzip
+import io
+import json
+import os
+import random
+import time
+from datetime import date, timedelta
+from itertools import accumulate
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.bulk import write_lists
+from api.models import MAX_MOVIES, Film, TopMovies, borda_points
+
+# Well above real TMDB ids, so generated films never take over real ones.
+FIRST_TMDB_ID = 90000000
+FIRST_YEAR = 1920
+LAST_YEAR = 2020
+GENERATED_AT = '2020-12-31T00:00:00Z'
+FILM_CHUNK_SIZE = 5000
+# Most lists are a round "top N", the rest are free-form.
+ROUND_LENGTHS = [3, 5, 10, 10, 10, 20, 25, 50, 100]
+ADJECTIVES = [
+    'Silent', 'Broken', 'Golden', 'Last', 'Hidden', 'Crimson', 'Lonely', 'Endless',
+    'Electric', 'Forgotten', 'Savage', 'Midnight', 'Burning', 'Frozen', 'Wild', 'Little',
+]
+NOUNS = [
+    'River', 'Empire', 'Summer', 'Stranger', 'Garden', 'Machine', 'Kingdom', 'Highway',
+    'Witness', 'Dream', 'Harbor', 'Frontier', 'Promise', 'Storm', 'Mirror', 'City',
+]
+
+generator = None
+
+
+class ListGenerator:
+
+    def __init__(self, seed, film_count, skew):
+        self.seed = seed
+        self.film_count = film_count
+        self.films = range(film_count)
+        # Zipf-like popularity: film i is picked with weight 1 / (i + 1) ** skew.
+        self.cum_weights = list(accumulate(1 / (i + 1) ** skew for i in self.films))
+
+    def make_list(self, index):
+        # Every list has its own generator, so the data does not depend on
+        # the batch size or on how lists are spread across workers.
+        rng = random.Random(f'{self.seed}:list:{index}')
+        if rng.random() < 0.6:
+            length = rng.choice(ROUND_LENGTHS)
+        else:
+            length = int(rng.lognormvariate(2.7, 0.9))
+        length = max(1, min(length, MAX_MOVIES, self.film_count))
+        picked = {}
+        while len(picked) < length:
+            for film in rng.choices(self.films, cum_weights=self.cum_weights, k=length - len(picked)):
+                picked[film] = None
+        return f'Top {length} #{index + 1}', list(picked)
+
+    def make_lists(self, bounds):
+        return [self.make_list(index) for index in range(*bounds)]
+
+
+def init_worker(seed, film_count, skew):
+    global generator
+    generator = ListGenerator(seed, film_count, skew)
+
+
+def make_lists(bounds):
+    return generator.make_lists(bounds)
+
+
+def make_films(seed, count):
+    rng = random.Random(f'{seed}:films')
+    films = []
+    for i in range(count):
+        # Recent years are far more common than old ones.
+        year = max(FIRST_YEAR, LAST_YEAR - int(rng.expovariate(1 / 12)))
+        films.append({
+            'tmdb_id': str(FIRST_TMDB_ID + i),
+            'title': f'The {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}',
+            'release_date': date(year, 1, 1) + timedelta(days=rng.randrange(365)),
+            'poster_path': '',
+        })
+    return films
+
+
+class DatabaseWriter:
+
+    def __init__(self, films, use_copy):
+        self.films = films
+        self.use_copy = use_copy
+        for i in range(0, len(films), FILM_CHUNK_SIZE):
+            Film.objects.get_films(films[i:i + FILM_CHUNK_SIZE])
+
+    def write(self, lists):
+        return write_lists([
+            (TopMovies(title=title, movie_count=len(films)), [self.films[film] for film in films])
+            for title, films in lists
+        ], self.use_copy)
+
+    def close(self):
+        pass
+
+
+class FixtureWriter:
+
+    # Django 3.1 only reads whole JSON fixtures, so lists are split across
+    # files small enough for loaddata to hold in memory.
+    def __init__(self, directory, films, lists_per_file, compress):
+        self.directory = directory
+        self.films = films
+        self.lists_per_file = lists_per_file
+        self.suffix = '.json.gz' if compress else '.json'
+        self.scores = [0] * len(films)
+        self.list_counts = [0] * len(films)
+        self.labels = []
+        self.output = None
+        self.top_movies_id = 0
+        self.movie_id = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, name):
+        path = os.path.join(self.directory, name + self.suffix)
+        self.labels.append(name)
+        if self.suffix.endswith('.gz'):
+            # A fixed mtime keeps compressed fixtures byte-for-byte reproducible.
+            self.output = io.TextIOWrapper(gzip.GzipFile(path, 'wb', mtime=0))
+        else:
+            self.output = open(path, 'w')
+        self.output.write('[\n')
+        self.first = True
+
+    def dump(self, model, pk, fields):
+        if not self.first:
+            self.output.write(',\n')
+        self.first = False
+        self.output.write(json.dumps({'model': model, 'pk': pk, 'fields': fields}))
+
+    def finish(self):
+        self.output.write('\n]\n')
+        self.output.close()
+        self.output = None
+
+    def write(self, lists):
+        movie_count = 0
+        for title, films in lists:
+            if self.top_movies_id % self.lists_per_file == 0:
+                if self.output:
+                    self.finish()
+                self.open(f'lists_{len(self.labels) + 1:04d}')
+            self.top_movies_id += 1
+            self.dump('api.topmovies', self.top_movies_id, {
+                'title': title,
+                'rank_mode': TopMovies.DENSE,
+                'movie_count': len(films),
+                'revision': 0,
+                'updated_at': GENERATED_AT,
+            })
+            for rank, film in enumerate(films, start=1):
+                self.movie_id += 1
+                self.dump('api.movie', self.movie_id, {
+                    'rank': rank,
+                    'position': rank,
+                    'film': film + 1,
+                    'top_movies': self.top_movies_id,
+                })
+                self.scores[film] += borda_points(rank)
+                self.list_counts[film] += 1
+            movie_count += len(films)
+        return movie_count
+
+    def close(self):
+        if self.output:
+            self.finish()
+        # Films go last, once their leaderboard scores are known.
+        self.open('films')
+        for i, film in enumerate(self.films):
+            self.dump('api.film', i + 1, {
+                'tmdb_id': film['tmdb_id'],
+                'title': film['title'],
+                'release_date': film['release_date'].isoformat(),
+                'poster_path': film['poster_path'],
+                'score': self.scores[i],
+                'list_count': self.list_counts[i],
+            })
+        self.finish()
+        self.labels.insert(0, self.labels.pop())
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Generates a deterministic dataset of lists with skewed film popularity, '
+        'either straight into the database or as fixtures for an empty database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lists', type=int, default=10000)
+        parser.add_argument('--films', type=int, default=20000, help='Size of the film catalog.')
+        parser.add_argument('--skew', type=float, default=1.0, help='Zipf exponent of film popularity.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=1000, help='Lists per transaction or worker task.')
+        parser.add_argument('--workers', type=int, default=1, help='Processes generating lists.')
+        parser.add_argument('--fixture', metavar='NAME',
+                            help='Write fixtures to NAME in the first FIXTURE_DIRS entry instead of the database.')
+        parser.add_argument('--lists-per-file', type=int, default=20000, help='Lists per fixture file.')
+        parser.add_argument('--compress', action='store_true', help='Gzip the fixture files.')
+        parser.add_argument('--no-copy', action='store_true', help='Use bulk_create even on PostgreSQL.')
+
+    def handle(self, *args, **options):
+        for name in ('films', 'batch_size', 'lists_per_file', 'workers'):
+            if options[name] < 1:
+                raise CommandError(f'--{name.replace("_", "-")} must be positive.')
+        seed = options['seed']
+        films = make_films(seed, options['films'])
+        if options['fixture']:
+            if not settings.FIXTURE_DIRS:
+                raise CommandError('FIXTURE_DIRS is not configured.')
+            directory = os.path.join(settings.FIXTURE_DIRS[0], options['fixture'])
+            writer = FixtureWriter(directory, films, options['lists_per_file'], options['compress'])
+        else:
+            use_copy = connection.vendor == 'postgresql' and not options['no_copy']
+            writer = DatabaseWriter(films, use_copy)
+        bounds = [
+            (start, min(start + options['batch_size'], options['lists']))
+            for start in range(0, options['lists'], options['batch_size'])
+        ]
+        initargs = (seed, options['films'], options['skew'])
+        started = time.monotonic()
+        lists = movies = 0
+        pool = None
+        if options['workers'] > 1:
+            pool = Pool(options['workers'], initializer=init_worker, initargs=initargs)
+            batches = pool.imap(make_lists, bounds)
+        else:
+            init_worker(*initargs)
+            batches = map(make_lists, bounds)
+        try:
+            for batch in batches:
+                movies += writer.write(batch)
+                lists += len(batch)
+                self.report(lists, movies, started)
+        finally:
+            if pool:
+                pool.terminate()
+        writer.close()
+        if not lists:
+            self.report(lists, movies, started)
+        if options['fixture']:
+            labels = ' '.join(f'{options["fixture"]}/{label}' for label in writer.labels)
+            self.stdout.write(f'Load into an empty database with: manage.py loaddata {labels}')
+
+    def report(self, lists, movies, started):
+        elapsed = max(time.monotonic() - started, 1e-6)
+        self.stdout.write(
+            f'Generated {lists} lists and {movies} movies '
+            f'in {elapsed:.1f}s ({(lists + movies) / elapsed:.0f} rows/s).'
+        )
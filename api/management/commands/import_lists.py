@@ -0,0 +1,174 @@
+import json
+import os
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils.dateparse import parse_date
+
+from api.bulk import write_lists
+from api.models import MAX_MOVIES, Film, TopMovies
+
+READ_SIZE = 64 * 1024
+# Longer values would make the database reject the whole batch.
+MAX_LENGTHS = {name: Film._meta.get_field(name).max_length for name in ('tmdb_id', 'title', 'poster_path')}
+
+
+def iter_json_array(stream):
+    decoder = json.JSONDecoder()
+    buffer = stream.read(READ_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise CommandError('Expected a JSON array.')
+    buffer = buffer[1:]
+    eof = False
+    while True:
+        buffer = buffer.lstrip()
+        if buffer.startswith(','):
+            buffer = buffer[1:].lstrip()
+        if buffer.startswith(']'):
+            return
+        if buffer:
+            try:
+                value, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise CommandError('Invalid JSON array.')
+            else:
+                yield value
+                buffer = buffer[end:]
+                continue
+        elif eof:
+            raise CommandError('Unterminated JSON array.')
+        more = stream.read(READ_SIZE)
+        eof = not more
+        buffer += more
+
+
+def iter_ndjson(stream):
+    for number, line in enumerate(stream, start=1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                raise CommandError(f'Invalid JSON on line {number}.')
+
+
+def iter_lists(records, title):
+    # Records are either whole lists ({"title", "movie": [...]}, as written
+    # by export_lists) or bare movies, which are gathered into one list.
+    movies = []
+    for record in records:
+        if isinstance(record, dict) and 'movie' in record:
+            if movies:
+                yield {'title': title, 'movie': movies}
+                movies = []
+            yield record
+        else:
+            movies.append(record)
+    if movies:
+        yield {'title': title, 'movie': movies}
+
+
+class Command(BaseCommand):
+
+    help = 'Imports lists from a JSON array or NDJSON file in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSON array of movies or lists, or NDJSON of lists.')
+        parser.add_argument('--format', choices=['json', 'ndjson'],
+                            help='Defaults to ndjson for .ndjson and .jsonl files, json otherwise.')
+        parser.add_argument('--title', default='', help='Title of the list made of bare movies.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Lists per transaction.')
+        parser.add_argument('--checkpoint', help='File recording imported lists, to resume an interrupted run.')
+        parser.add_argument('--no-copy', action='store_true', help='Use bulk_create even on PostgreSQL.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        import_format = options['format']
+        if import_format is None:
+            import_format = 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'json'
+        self.use_copy = connection.vendor == 'postgresql' and not options['no_copy']
+        self.stats = defaultdict(int)
+        checkpoint = self.load_checkpoint(options['checkpoint'], path)
+        started = time.monotonic()
+        with open(path) as stream:
+            records = iter_ndjson(stream) if import_format == 'ndjson' else iter_json_array(stream)
+            batch = []
+            for count, top_movies in enumerate(iter_lists(records, options['title']), start=1):
+                if count <= checkpoint:
+                    continue
+                batch.append(top_movies)
+                if len(batch) >= options['batch_size']:
+                    self.import_batch(batch)
+                    self.save_checkpoint(options['checkpoint'], path, count)
+                    self.report(started)
+                    batch = []
+            if batch:
+                self.import_batch(batch)
+                self.save_checkpoint(options['checkpoint'], path, count)
+                self.report(started)
+        if not self.stats['lists']:
+            self.report(started)
+        skipped = ', '.join(f'{self.stats[name]} {name}' for name in ('duplicate', 'invalid', 'over limit'))
+        self.stdout.write(f'Skipped movies: {skipped}.')
+
+    def load_checkpoint(self, checkpoint_path, path):
+        if not checkpoint_path or not os.path.exists(checkpoint_path):
+            return 0
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint.get('source') != os.path.abspath(path):
+            raise CommandError(f'{checkpoint_path} belongs to another import.')
+        self.stdout.write(f'Resuming after {checkpoint["lists"]} lists.')
+        return checkpoint['lists']
+
+    def save_checkpoint(self, checkpoint_path, path, lists):
+        if not checkpoint_path:
+            return
+        with open(checkpoint_path + '.tmp', 'w') as checkpoint_file:
+            json.dump({'source': os.path.abspath(path), 'lists': lists}, checkpoint_file)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+    def report(self, started):
+        rows = self.stats['lists'] + self.stats['movies']
+        elapsed = max(time.monotonic() - started, 1e-6)
+        self.stdout.write(
+            f'Imported {self.stats["lists"]} lists and {self.stats["movies"]} movies '
+            f'in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s).'
+        )
+
+    def clean_movies(self, movies):
+        seen = set()
+        cleaned = []
+        for movie in movies:
+            if not isinstance(movie, dict) or not movie.get('tmdb_id') or not movie.get('title') \
+                    or not parse_date(str(movie.get('release_date', ''))) \
+                    or any(len(str(movie.get(name) or '')) > length for name, length in MAX_LENGTHS.items()):
+                self.stats['invalid'] += 1
+            elif str(movie['tmdb_id']) in seen:
+                self.stats['duplicate'] += 1
+            elif len(cleaned) >= MAX_MOVIES:
+                self.stats['over limit'] += 1
+            else:
+                seen.add(str(movie['tmdb_id']))
+                cleaned.append({
+                    'tmdb_id': str(movie['tmdb_id']),
+                    'title': movie['title'],
+                    'release_date': parse_date(str(movie['release_date'])),
+                    'poster_path': movie.get('poster_path') or '',
+                })
+        return cleaned
+
+    def import_batch(self, batch):
+        lists = []
+        for record in batch:
+            rank_mode = record.get('rank_mode')
+            if rank_mode not in (TopMovies.DENSE, TopMovies.SPARSE):
+                rank_mode = TopMovies.DENSE
+            movies = self.clean_movies(record.get('movie') or [])
+            top_movies = TopMovies(title=(record.get('title') or '')[:255], rank_mode=rank_mode, movie_count=len(movies))
+            lists.append((top_movies, movies))
+        movie_count = write_lists(lists, self.use_copy)
+        self.stats['lists'] += len(lists)
+        self.stats['movies'] += movie_count
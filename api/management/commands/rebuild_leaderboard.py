@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.models import Film, Movie, borda_points
+
+
+class Command(BaseCommand):
+
+    help = 'Recomputes the leaderboard scores of every film from the Movie table in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report drifted films, exit with an error if there are any.',
+        )
+
+    def handle(self, *args, **options):
+        checked = drifted = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                # Locking the films makes pending score updates wait. Rank
+                # edits write scores only after they commit, so an edit that
+                # commits while a chunk is counted can still be counted twice;
+                # --check again before repairing a busy database.
+                films = list(Film.objects.select_for_update().filter(pk__gt=last_id).order_by('pk')
+                                         .only('score', 'list_count')[:options['chunk_size']])
+                if not films:
+                    break
+                last_id = films[-1].pk
+                checked += len(films)
+                scores = {film.pk: [0, 0] for film in films}
+                ranks = Movie.objects.with_list_rank(Movie.objects.filter(film__in=list(scores))) \
+                                     .values_list('film', 'list_rank')
+                for film_id, rank in ranks:
+                    scores[film_id][0] += borda_points(rank)
+                    scores[film_id][1] += 1
+                drifted_films = []
+                for film in films:
+                    if [film.score, film.list_count] != scores[film.pk]:
+                        film.score, film.list_count = scores[film.pk]
+                        drifted_films.append(film)
+                drifted += len(drifted_films)
+                if not options['check']:
+                    Film.objects.bulk_update(drifted_films, ['score', 'list_count'])
+        if not options['check']:
+            self.stdout.write(f'Checked {checked} films, corrected {drifted}.')
+        elif drifted:
+            raise CommandError(f'Checked {checked} films, {drifted} drifted.')
+        else:
+            self.stdout.write(f'Checked {checked} films, none drifted.')
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from api.models import TopMovies, Movie
+
+
+class Command(BaseCommand):
+
+    help = 'Recomputes TopMovies.movie_count from the Movie table in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        movie_count = Movie.objects.filter(top_movies=OuterRef('pk')).order_by() \
+                                   .values('top_movies').annotate(count=Count('pk')).values('count')
+        checked = corrected = 0
+        last_id = 0
+        while True:
+            ids = list(TopMovies.objects.filter(pk__gt=last_id).order_by('pk')
+                                        .values_list('pk', flat=True)[:options['chunk_size']])
+            if not ids:
+                break
+            last_id = ids[-1]
+            checked += len(ids)
+            drifted = TopMovies.objects.filter(pk__in=ids) \
+                                       .annotate(actual=Coalesce(Subquery(movie_count), 0)) \
+                                       .exclude(movie_count=F('actual')) \
+                                       .values_list('pk', flat=True)
+            corrected += TopMovies.objects.filter(pk__in=list(drifted)) \
+                                          .update(movie_count=Coalesce(Subquery(movie_count), 0))
+        self.stdout.write(f'Checked {checked} lists, corrected {corrected}.')
@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.slow_queries import slow_query_log
+
+
+class Command(BaseCommand):
+
+    help = 'Shows the slowest recent statements recorded by SlowQueryMiddleware, newest first.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, help='Show at most this many entries.')
+        parser.add_argument('--json', action='store_true', help='Print the entries as JSON.')
+        parser.add_argument('--clear', action='store_true', help='Empty the log after reading it.')
+
+    def handle(self, *args, **options):
+        entries = slow_query_log.entries()[:options['limit']]
+        if options['json']:
+            self.stdout.write(json.dumps(entries, indent=2))
+        elif not entries:
+            self.stdout.write('No slow queries recorded.')
+        else:
+            for entry in entries:
+                self.write_entry(entry)
+        if options['clear']:
+            slow_query_log.clear()
+
+    def write_entry(self, entry):
+        self.stdout.write(
+            f'{entry["recorded_at"]}  {entry["duration_ms"]} ms  {entry["view"]}  [{entry["fingerprint_id"]}]'
+        )
+        self.stdout.write(f'  {entry["fingerprint"]}')
+        for line in (entry['explain'] or '').splitlines():
+            self.stdout.write(f'    {line}')
@@ -0,0 +1,232 @@
+import asyncio
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .cache import payload_cache
+from .timing import AsyncCapableMiddleware, get_view_name, wrap_queries
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+QUERY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200]
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def empty(self):
+        return 0
+
+    def merge(self, total, value):
+        return total + value
+
+    def inc(self, values, labels, amount=1):
+        values[labels] = values.get(labels, 0) + amount
+
+    def samples(self, labels, value):
+        yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+
+    def empty(self):
+        # One count per bucket plus +Inf, then the sum of observations.
+        return [0] * (len(self.buckets) + 1) + [0]
+
+    def merge(self, total, value):
+        return [a + b for a, b in zip(total, value)]
+
+    def observe(self, values, labels, amount):
+        if labels not in values:
+            values[labels] = self.empty()
+        values[labels][bisect_left(self.buckets, amount)] += 1
+        values[labels][-1] += amount
+
+    def samples(self, labels, value):
+        count = 0
+        for bound, bucket_count in zip(self.buckets + ['+Inf'], value):
+            count += bucket_count
+            yield (
+                f'{self.name}_bucket',
+                format_labels(self.labelnames + ['le'], list(labels) + [bound]),
+                count,
+            )
+        yield f'{self.name}_sum', format_labels(self.labelnames, labels), value[-1]
+        yield f'{self.name}_count', format_labels(self.labelnames, labels), count
+
+
+REQUESTS = Counter('api_requests_total', 'Requests by view, method and status code.', ['view', 'method', 'status'])
+LATENCY = Histogram('api_request_duration_seconds', 'Request latency by view.', ['view'], LATENCY_BUCKETS)
+QUERIES = Histogram('api_request_queries', 'Database queries per request by view.', ['view'], QUERY_BUCKETS)
+CACHE_REQUESTS = Counter('api_payload_cache_requests_total', 'Payload cache lookups by result.', ['result'])
+METRICS = [REQUESTS, LATENCY, QUERIES, CACHE_REQUESTS]
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.values = {metric.name: {} for metric in METRICS}
+            self.flushed_at = 0
+            self.pid = os.getpid()
+            self.token = uuid.uuid4().hex
+
+    def check_fork(self):
+        # A forked worker must not report, or overwrite, its parent's values.
+        if self.pid != os.getpid():
+            self.reset()
+
+    def record_request(self, view, method, status, duration, queries):
+        self.check_fork()
+        if method not in METHODS:
+            method = 'other'
+        with self.lock:
+            REQUESTS.inc(self.values[REQUESTS.name], (view, method, str(status)))
+            LATENCY.observe(self.values[LATENCY.name], (view,), duration)
+            QUERIES.observe(self.values[QUERIES.name], (view,), queries)
+
+    def snapshot(self):
+        self.check_fork()
+        stats = payload_cache.stats()
+        with self.lock:
+            self.values[CACHE_REQUESTS.name] = {('hit',): stats['hits'], ('miss',): stats['misses']}
+            return {
+                name: [[list(labels), value] for labels, value in values.items()]
+                for name, values in self.values.items()
+            }
+
+    @property
+    def directory(self):
+        return getattr(settings, 'API_METRICS_DIR', None)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f'metrics-{self.pid}-{self.token}.json')
+
+    def flush(self, force=False):
+        # Each process keeps its own file, so counters of workers that have
+        # exited still add up.
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self.flushed_at < getattr(settings, 'API_METRICS_FLUSH_INTERVAL', 1):
+            return
+        self.flushed_at = now
+        snapshot = self.snapshot()
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as output:
+            json.dump(snapshot, output)
+        os.replace(self.path + '.tmp', self.path)
+
+    def collect(self):
+        if not self.directory:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush(force=True)
+            snapshots = []
+            for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+                try:
+                    with open(path) as snapshot:
+                        snapshots.append(json.load(snapshot))
+                except (OSError, ValueError):
+                    continue
+        totals = {metric.name: defaultdict(metric.empty) for metric in METRICS}
+        for snapshot in snapshots:
+            for metric in METRICS:
+                for labels, value in snapshot.get(metric.name, []):
+                    labels = tuple(labels)
+                    totals[metric.name][labels] = metric.merge(totals[metric.name][labels], value)
+        return totals
+
+    def render(self):
+        totals = self.collect()
+        lines = []
+        for metric in METRICS:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for labels in sorted(totals[metric.name]):
+                for name, label_text, value in metric.samples(labels, totals[metric.name][labels]):
+                    lines.append(f'{name}{label_text} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+atexit.register(registry.flush, force=True)
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+class MetricsMiddleware(AsyncCapableMiddleware):
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if not getattr(settings, 'API_METRICS_ENABLED', False):
+            raise MiddlewareNotUsed
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with wrap_queries(counter):
+            response = self.get_response(request)
+        return self.record(request, response, time.perf_counter() - start, counter.queries)
+
+    async def __acall__(self, request):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with wrap_queries(counter):
+            response = await self.get_response(request)
+        return self.record(request, response, time.perf_counter() - start, counter.queries)
+
+    def record(self, request, response, duration, queries):
+        registry.record_request(get_view_name(request), request.method, response.status_code, duration, queries)
+        registry.flush()
+        return response
@@ -0,0 +1,40 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:10
+
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import F
+
+
+def copy_rank_to_position(apps, schema_editor):
+    Movie = apps.get_model('api', 'Movie')
+    Movie.objects.update(position=F('rank'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_auto_20201123_2216'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='movie',
+            options={'ordering': ['top_movies', 'position']},
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='position',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='topmovies',
+            name='rank_mode',
+            field=models.CharField(choices=[('dense', 'Dense'), ('sparse', 'Sparse')], default='dense', max_length=6),
+        ),
+        migrations.AlterField(
+            model_name='movie',
+            name='rank',
+            field=models.PositiveIntegerField(blank=True, default=1, null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxLengthValidator(100)]),
+        ),
+        migrations.RunPython(copy_rank_to_position, migrations.RunPython.noop),
+    ]
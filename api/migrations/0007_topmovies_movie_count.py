@@ -0,0 +1,35 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:12
+
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_movies(apps, schema_editor):
+    TopMovies = apps.get_model('api', 'TopMovies')
+    Movie = apps.get_model('api', 'Movie')
+    movie_count = Movie.objects.filter(top_movies=OuterRef('pk')).order_by() \
+                               .values('top_movies').annotate(count=Count('pk')).values('count')
+    TopMovies.objects.update(movie_count=Coalesce(Subquery(movie_count), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_movie_position'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topmovies',
+            name='movie_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='movie',
+            name='rank',
+            field=models.PositiveIntegerField(blank=True, default=1, null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)]),
+        ),
+        migrations.RunPython(count_movies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_topmovies_movie_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(fields=['top_movies', 'position', 'id'], name='movie_list_position_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_movie_list_position_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topmovies',
+            name='revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='topmovies',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:20
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.constraints
+
+
+def renumber_duplicate_ranks(apps, schema_editor):
+    Movie = apps.get_model('api', 'Movie')
+    top_movies_ids = Movie.objects.filter(rank__isnull=False).values('top_movies', 'rank') \
+                                  .annotate(count=Count('id')).filter(count__gt=1) \
+                                  .values_list('top_movies', flat=True).distinct()
+    for top_movies_id in list(top_movies_ids):
+        movies = list(Movie.objects.filter(top_movies=top_movies_id).order_by('rank', 'position', 'id'))
+        for i, movie in enumerate(movies, start=1):
+            movie.rank = movie.position = i
+        Movie.objects.bulk_update(movies, ['rank', 'position'])
+
+
+def create_rank_index(apps, schema_editor):
+    if not schema_editor.connection.features.supports_deferrable_unique_constraints:
+        schema_editor.execute(
+            'CREATE UNIQUE INDEX movie_list_rank_uniq ON api_movie (top_movies_id, rank)'
+        )
+
+
+def drop_rank_index(apps, schema_editor):
+    if not schema_editor.connection.features.supports_deferrable_unique_constraints:
+        schema_editor.execute('DROP INDEX movie_list_rank_uniq')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_topmovies_revision'),
+    ]
+
+    operations = [
+        migrations.RunPython(renumber_duplicate_ranks, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(fields=['tmdb_id'], name='movie_tmdb_id_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='movie',
+            constraint=models.UniqueConstraint(deferrable=django.db.models.constraints.Deferrable['DEFERRED'], fields=('top_movies', 'rank'), name='movie_list_rank_uniq'),
+        ),
+        migrations.RunPython(create_rank_index, drop_rank_index),
+    ]
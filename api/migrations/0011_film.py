@@ -0,0 +1,53 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_rank_index(apps, schema_editor):
+    # Rebuilding api_movie on SQLite drops the index added by 0010.
+    if not schema_editor.connection.features.supports_deferrable_unique_constraints:
+        schema_editor.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS movie_list_rank_uniq ON api_movie (top_movies_id, rank)'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_movie_list_rank_uniq'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, create_rank_index),
+        migrations.CreateModel(
+            name='Film',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tmdb_id', models.CharField(max_length=50, unique=True)),
+                ('title', models.CharField(max_length=255)),
+                ('release_date', models.DateField()),
+                ('poster_path', models.URLField(blank=True, max_length=255)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='film',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='movie', to='api.film'),
+        ),
+        migrations.AlterField(
+            model_name='movie',
+            name='tmdb_id',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='movie',
+            name='title',
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='movie',
+            name='release_date',
+            field=models.DateField(null=True),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:30
+
+from django.db import migrations, transaction
+from django.db.models import Min, OuterRef, Subquery
+
+BATCH_SIZE = 1000
+
+
+def copy_films(apps, schema_editor):
+    Film = apps.get_model('api', 'Film')
+    Movie = apps.get_model('api', 'Movie')
+    films = Film.objects.filter(tmdb_id=OuterRef('tmdb_id')).values('pk')
+    # Each batch commits on its own, so an interrupted run resumes from the
+    # movies that still have no film. The oldest copy of a film's metadata wins.
+    while True:
+        with transaction.atomic():
+            tmdb_ids = list(Movie.objects.filter(film__isnull=True).order_by()
+                                         .values_list('tmdb_id', flat=True).distinct()[:BATCH_SIZE])
+            if not tmdb_ids:
+                break
+            first_ids = Movie.objects.filter(tmdb_id__in=tmdb_ids).order_by() \
+                                     .values('tmdb_id').annotate(first_id=Min('pk')) \
+                                     .values_list('first_id', flat=True)
+            Film.objects.bulk_create([
+                Film(
+                    tmdb_id=movie.tmdb_id,
+                    title=movie.title,
+                    release_date=movie.release_date,
+                    poster_path=movie.poster_path,
+                )
+                for movie in Movie.objects.filter(pk__in=list(first_ids))
+            ], ignore_conflicts=True)
+            Movie.objects.filter(film__isnull=True, tmdb_id__in=tmdb_ids) \
+                         .update(film=Subquery(films[:1]))
+
+
+def copy_metadata(apps, schema_editor):
+    Film = apps.get_model('api', 'Film')
+    Movie = apps.get_model('api', 'Movie')
+    films = Film.objects.filter(pk=OuterRef('film'))
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            ids = list(Movie.objects.filter(pk__gt=last_id).order_by('pk')
+                                    .values_list('pk', flat=True)[:BATCH_SIZE])
+            if not ids:
+                break
+            last_id = ids[-1]
+            Movie.objects.filter(pk__in=ids).update(**{
+                name: Subquery(films.values(name)[:1])
+                for name in ['tmdb_id', 'title', 'release_date', 'poster_path']
+            })
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('api', '0011_film'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_films, copy_metadata),
+    ]
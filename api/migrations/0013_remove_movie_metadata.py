@@ -0,0 +1,53 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_rank_index(apps, schema_editor):
+    # Rebuilding api_movie on SQLite drops the index added by 0010.
+    if not schema_editor.connection.features.supports_deferrable_unique_constraints:
+        schema_editor.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS movie_list_rank_uniq ON api_movie (top_movies_id, rank)'
+        )
+
+
+def drop_rank_index(apps, schema_editor):
+    if not schema_editor.connection.features.supports_deferrable_unique_constraints:
+        schema_editor.execute('DROP INDEX IF EXISTS movie_list_rank_uniq')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_copy_films'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='movie',
+            name='film',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='movie', to='api.film'),
+        ),
+        migrations.RemoveIndex(
+            model_name='movie',
+            name='movie_tmdb_id_idx',
+        ),
+        migrations.RemoveField(
+            model_name='movie',
+            name='tmdb_id',
+        ),
+        migrations.RemoveField(
+            model_name='movie',
+            name='title',
+        ),
+        migrations.RemoveField(
+            model_name='movie',
+            name='release_date',
+        ),
+        migrations.RemoveField(
+            model_name='movie',
+            name='poster_path',
+        ),
+        migrations.RunPython(create_rank_index, drop_rank_index),
+    ]
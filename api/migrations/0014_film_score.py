@@ -0,0 +1,55 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:30
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 1000
+MAX_MOVIES = 100
+
+
+def count_scores(apps, schema_editor):
+    Film = apps.get_model('api', 'Film')
+    Movie = apps.get_model('api', 'Movie')
+    preceding = Movie.objects.filter(top_movies=OuterRef('top_movies'), position__lt=OuterRef('position')) \
+                             .order_by().values('top_movies').annotate(count=Count('pk')).values('count')
+    last_id = 0
+    while True:
+        ids = list(Film.objects.filter(pk__gt=last_id).order_by('pk')
+                               .values_list('pk', flat=True)[:BATCH_SIZE])
+        if not ids:
+            break
+        last_id = ids[-1]
+        scores = {pk: Film(pk=pk, score=0, list_count=0) for pk in ids}
+        ranks = Movie.objects.filter(film__in=ids) \
+                             .annotate(list_rank=Coalesce(Subquery(preceding), 0) + 1) \
+                             .values_list('film', 'list_rank')
+        for film_id, rank in ranks:
+            scores[film_id].score += MAX_MOVIES + 1 - rank
+            scores[film_id].list_count += 1
+        Film.objects.bulk_update(scores.values(), ['score', 'list_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_remove_movie_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='film',
+            name='list_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='film',
+            name='score',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='film',
+            index=models.Index(fields=['-score', 'id'], name='film_score_idx'),
+        ),
+        migrations.RunPython(count_scores, migrations.RunPython.noop),
+    ]
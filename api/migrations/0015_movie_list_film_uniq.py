@@ -0,0 +1,71 @@
+# Generated by Django 3.1.3 on 2026-10-18 14:23
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+MAX_MOVIES = 100
+
+
+def remove_duplicate_films(apps, schema_editor):
+    # Keeps the best ranked entry of a film in each list, closes the gaps
+    # and recounts the lists and the scores of their films.
+    Film = apps.get_model('api', 'Film')
+    Movie = apps.get_model('api', 'Movie')
+    TopMovies = apps.get_model('api', 'TopMovies')
+    top_movies_ids = Movie.objects.order_by().values('top_movies', 'film').annotate(count=Count('id')) \
+                                  .filter(count__gt=1).values_list('top_movies', flat=True).distinct()
+    film_ids = set()
+    for top_movies_id in list(top_movies_ids):
+        seen = set()
+        movies = []
+        for movie in Movie.objects.filter(top_movies=top_movies_id).order_by('position', 'id'):
+            if movie.film_id in seen:
+                movie.delete()
+            else:
+                seen.add(movie.film_id)
+                movies.append(movie)
+        film_ids |= seen
+        if movies and movies[0].rank is not None:
+            Movie.objects.filter(top_movies=top_movies_id).update(rank=None)
+            for i, movie in enumerate(movies, start=1):
+                movie.rank = movie.position = i
+            Movie.objects.bulk_update(movies, ['rank', 'position'])
+        TopMovies.objects.filter(pk=top_movies_id).update(movie_count=len(movies))
+    preceding = Movie.objects.filter(top_movies=OuterRef('top_movies'), position__lt=OuterRef('position')) \
+                             .order_by().values('top_movies').annotate(count=Count('pk')).values('count')
+    films = {pk: Film(pk=pk, score=0, list_count=0) for pk in film_ids}
+    ranks = Movie.objects.filter(film__in=film_ids) \
+                         .annotate(list_rank=Coalesce(Subquery(preceding), 0) + 1) \
+                         .values_list('film', 'list_rank')
+    for film_id, rank in ranks:
+        films[film_id].score += MAX_MOVIES + 1 - rank
+        films[film_id].list_count += 1
+    Film.objects.bulk_update(films.values(), ['score', 'list_count'])
+
+
+def create_rank_index(apps, schema_editor):
+    # Adding the constraint rebuilds api_movie on SQLite, which drops the
+    # index added by 0010.
+    if not schema_editor.connection.features.supports_deferrable_unique_constraints:
+        schema_editor.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS movie_list_rank_uniq ON api_movie (top_movies_id, rank)'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_film_score'),
+    ]
+
+    operations = [
+        # Unapplied, the constraint is removed by rebuilding the table again,
+        # so the index is restored once that has happened.
+        migrations.RunPython(remove_duplicate_films, create_rank_index),
+        migrations.AddConstraint(
+            model_name='movie',
+            constraint=models.UniqueConstraint(fields=('top_movies', 'film'), name='movie_list_film_uniq'),
+        ),
+        migrations.RunPython(create_rank_index, migrations.RunPython.noop),
+    ]
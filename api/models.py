@@ -1,40 +1,396 @@
-from django.db import models
-from django.db.models import Q
-from django.core.validators import MinValueValidator, MaxLengthValidator
+import random
+import time
 
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import (
+    Case, Count, Deferrable, F, Max, OuterRef, Prefetch, Subquery, UniqueConstraint, Value, When,
+)
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.core.validators import MinValueValidator, MaxValueValidator
+from django.utils import timezone
+
+from .signals import list_changed, rank_changed
+
+RANK_GAP = 2 ** 16
+RANK_OFFSET = 1000000
+MAX_MOVIES = 100
+FILM_FIELDS = ['tmdb_id', 'title', 'release_date', 'poster_path']
+MOVIE_FIELDS = ['id', 'rank', 'top_movies', 'film'] + [f'film__{name}' for name in FILM_FIELDS]
+MAX_RETRIES = 5
+RETRY_DELAY = 0.005
+
+
+class ConcurrentUpdate(Exception):
+    pass
+
+
+class StaleRevision(ConcurrentUpdate):
+    pass
+
+
+def borda_points(rank):
+    return MAX_MOVIES + 1 - rank
+
+
+def notify_list_changed(top_movies_id, revision=None):
+    top_movies = TopMovies.objects.filter(pk=top_movies_id)
+    if revision is not None:
+        top_movies = top_movies.filter(revision=revision)
+    if not top_movies.update(revision=F('revision') + 1, updated_at=timezone.now()):
+        return False
+    list_changed.send(sender=TopMovies, top_movies_id=top_movies_id)
+    return True
+
+
+def notify_list_reset(top_movies_id):
+    # Changes that touch many ranks at once are sent as a reset, after which
+    # viewers fetch the list again.
+    rank_changed.send(sender=TopMovies, top_movies_id=top_movies_id, event='reset', data={
+        'top_movies': top_movies_id,
+    })
+
+
+def retry_attempts():
+    for attempt in range(MAX_RETRIES):
+        if attempt:
+            time.sleep(random.uniform(0, RETRY_DELAY * 2 ** attempt))
+        yield attempt
+    raise ConcurrentUpdate('The list kept changing, giving up after %d attempts.' % MAX_RETRIES)
+
+
+def check_revision(revision, expected_revision):
+    # A caller that expects a revision gets told it is gone instead of having
+    # its change retried on top of a list it has not seen.
+    if expected_revision is not None and revision != expected_revision:
+        raise StaleRevision('The list has changed since revision %d.' % expected_revision)
+
+
+def claim_revision(top_movies_id, expected_revision=None):
+    # Bumping the revision locks the list for the rest of the transaction.
+    if not notify_list_changed(top_movies_id, expected_revision):
+        check_revision(None, expected_revision)
+
+
+class FilmManager(models.Manager):
+
+    def get_film(self, tmdb_id, title, release_date, poster_path=''):
+        film, created = self.get_or_create(tmdb_id=tmdb_id, defaults={
+            'title': title,
+            'release_date': release_date,
+            'poster_path': poster_path,
+        })
+        return film
+
+    def get_films(self, movies):
+        films = self.in_bulk([movie['tmdb_id'] for movie in movies], field_name='tmdb_id')
+        new_films = {}
+        for movie in movies:
+            if movie['tmdb_id'] not in films and movie['tmdb_id'] not in new_films:
+                new_films[movie['tmdb_id']] = Film(
+                    tmdb_id=movie['tmdb_id'],
+                    title=movie['title'],
+                    release_date=movie['release_date'],
+                    poster_path=movie.get('poster_path', ''),
+                )
+        if new_films:
+            # A concurrent request may insert the same films; keep theirs.
+            self.bulk_create(new_films.values(), ignore_conflicts=True)
+            films.update(self.in_bulk(list(new_films), field_name='tmdb_id'))
+        return films
+
+    def add_scores(self, scores, list_counts=None):
+        list_counts = list_counts or {}
+        film_ids = {pk for pk, delta in scores.items() if delta} | \
+                   {pk for pk, delta in list_counts.items() if delta}
+        if not film_ids:
+            return 0
+        return super().get_queryset().filter(pk__in=film_ids).update(
+            score=F('score') + self._get_deltas(scores),
+            list_count=F('list_count') + self._get_deltas(list_counts),
+        )
+
+    def add_scores_on_commit(self, scores, list_counts=None):
+        # A film row is shared by every list holding the film, so its score
+        # is written once the rank edit has committed. Edits of unrelated
+        # lists then never wait on each other for a popular film. Scores
+        # lost to a crash in between are repaired by rebuild_leaderboard.
+        transaction.on_commit(lambda: self.add_scores(scores, list_counts))
+
+    def _get_deltas(self, deltas):
+        whens = [When(pk=pk, then=Value(delta)) for pk, delta in deltas.items() if delta]
+        if not whens:
+            return Value(0)
+        return Case(*whens, default=Value(0), output_field=models.IntegerField())
+
+class Film(models.Model):
+
+    tmdb_id = models.CharField(max_length=50, unique=True)
+    title = models.CharField(max_length=255)
+    release_date = models.DateField()
+    poster_path = models.URLField(max_length=255, blank=True)
+    # Borda count over every list: rank 1 earns MAX_MOVIES points, the
+    # last possible rank earns one.
+    score = models.IntegerField(default=0)
+    list_count = models.IntegerField(default=0)
+    objects = FilmManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-score', 'id'], name='film_score_idx'),
+        ]
+
+class TopMoviesManager(models.Manager):
+
+    def with_movies(self):
+        return super().get_queryset().prefetch_related(
+            Prefetch('movie', queryset=Movie.objects.only(*MOVIE_FIELDS, 'position'))
+        )
+
+    def get_revision(self, top_movies_id):
+        return super().get_queryset().values_list('revision', 'updated_at').get(pk=top_movies_id)
+
+    def reserve_ranks(self, top_movies, amount=1):
+        updated = super().get_queryset().filter(
+            pk=top_movies.pk,
+            movie_count__lte=MAX_MOVIES - amount,
+        ).update(movie_count=F('movie_count') + amount)
+        if not updated:
+            raise ValidationError(f'A list cannot hold more than {MAX_MOVIES} movies.')
+        movie_count = super().get_queryset().values_list('movie_count', flat=True).get(pk=top_movies.pk)
+        top_movies.movie_count = movie_count
+        return movie_count - amount
+
+    def release_ranks(self, top_movies_id, amount=1):
+        return super().get_queryset().filter(pk=top_movies_id, movie_count__gte=amount) \
+                                     .update(movie_count=F('movie_count') - amount)
 
 class TopMovies(models.Model):
 
+    DENSE = 'dense'
+    SPARSE = 'sparse'
+    RANK_MODE_CHOICES = [
+        (DENSE, 'Dense'),
+        (SPARSE, 'Sparse'),
+    ]
+
     title = models.CharField(max_length=255, blank=True)
+    rank_mode = models.CharField(
+        max_length=6,
+        choices=RANK_MODE_CHOICES,
+        default=DENSE,
+    )
+    movie_count = models.PositiveIntegerField(default=0)
+    revision = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    objects = TopMoviesManager()
+
+    COUNTER_FIELDS = ['movie_count', 'revision']
+
+    def save(self, *args, **kwargs):
+        # Counters are only ever changed with F-expressions, so a stale
+        # instance must not write them back.
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+    def set_rank_mode(self, rank_mode):
+        if rank_mode == self.rank_mode:
+            return
+        with transaction.atomic():
+            self.rank_mode = rank_mode
+            self.save(update_fields=['rank_mode', 'updated_at'])
+            Movie.objects.renumber(self)
+            notify_list_reset(self.pk)
+
+    def set_order(self, movie_ids, expected_revision=None):
+        with transaction.atomic():
+            # Claiming the revision first locks the list against concurrent moves.
+            claim_revision(self.pk, expected_revision)
+            films = dict(Movie.objects.get_related_movies(self).values_list('id', 'film'))
+            # The order was validated before the list was locked, so a movie
+            # added or deleted in between is caught here.
+            if len(movie_ids) != len(films) or set(movie_ids) != set(films):
+                raise ValidationError('Order must contain every movie of this list exactly once.')
+            ranks = {movie_id: rank for rank, movie_id in enumerate(films, start=1)}
+            Movie.objects.renumber(self, movie_ids)
+            Film.objects.add_scores_on_commit({
+                films[movie_id]: ranks[movie_id] - rank
+                for rank, movie_id in enumerate(movie_ids, start=1)
+            })
+            notify_list_reset(self.pk)
 
 class MovieManager(models.Manager):
 
+    def get_list_revision(self, movie_id):
+        return super().get_queryset().values_list(
+            'top_movies', 'top_movies__revision', 'top_movies__updated_at',
+        ).get(pk=movie_id)
+
+    def get_queryset(self):
+        # Every representation of a movie needs its film.
+        return super().get_queryset().select_related('film')
+
+    def with_top_movies(self):
+        return self.get_queryset().select_related('top_movies').prefetch_related(
+            Prefetch('top_movies__movie', queryset=self.only(*MOVIE_FIELDS, 'position'))
+        )
+
+    def with_list_rank(self, queryset=None):
+        if queryset is None:
+            queryset = super().get_queryset()
+        preceding = Movie.objects.filter(
+            top_movies=OuterRef('top_movies'),
+            position__lt=OuterRef('position'),
+        ).order_by().values('top_movies').annotate(count=Count('pk')).values('count')
+        return queryset.annotate(
+            list_rank=Coalesce('rank', Coalesce(Subquery(preceding), 0) + 1)
+        )
+
     def get_related_movies(self, top_movies):
-        return super().get_queryset().filter(top_movies=top_movies).order_by('rank')
+        return super().get_queryset().filter(top_movies=top_movies).order_by('position')
     
     def create_movie(self, tmdb_id, title, release_date, poster_path, top_movies):
-        movies = self.get_related_movies(top_movies)
-        rank = len(movies) + 1
-        movie, created = self.get_or_create(
-            tmdb_id=tmdb_id,
-            title=title,
-            release_date=release_date,
-            poster_path=poster_path,
-            top_movies=top_movies,
-            defaults={'rank': rank}
-        )
+        movies = self.get_related_movies(top_movies).select_related('film')
+        film = Film.objects.get_film(tmdb_id, title, release_date, poster_path)
+        try:
+            return self._create_movie(film, top_movies, movies)
+        except IntegrityError:
+            # The same film was added concurrently.
+            movie = movies.filter(film=film).first()
+            if movie is None:
+                raise
+            return movie
+
+    def _create_movie(self, film, top_movies, movies):
+        with transaction.atomic():
+            movie = movies.filter(film=film).first()
+            if movie is not None:
+                return movie
+            rank = TopMovies.objects.reserve_ranks(top_movies) + 1
+            if top_movies.rank_mode == TopMovies.SPARSE:
+                last_position = movies.aggregate(Max('position'))['position__max']
+                rank, position = None, (last_position or 0) + RANK_GAP
+            else:
+                position = rank
+            movie = self.create(
+                film=film,
+                top_movies=top_movies,
+                rank=rank,
+                position=position,
+            )
+            Film.objects.add_scores_on_commit({film.pk: borda_points(top_movies.movie_count)}, {film.pk: 1})
+            rank_changed.send(sender=Movie, top_movies_id=top_movies.pk, event='add', data={
+                'id': movie.pk,
+                'rank': top_movies.movie_count,
+                'tmdb_id': film.tmdb_id,
+                'title': film.title,
+                'release_date': film.release_date,
+                'poster_path': film.poster_path,
+            })
         return movie
 
+    def create_movies(self, top_movies, movies):
+        with transaction.atomic():
+            related_movies = self.get_related_movies(top_movies)
+            tmdb_ids = [movie['tmdb_id'] for movie in movies]
+            seen = set(related_movies.filter(film__tmdb_id__in=tmdb_ids)
+                                     .values_list('film__tmdb_id', flat=True))
+            new_films = []
+            for movie in movies:
+                if movie['tmdb_id'] in seen:
+                    continue
+                seen.add(movie['tmdb_id'])
+                new_films.append(movie)
+            if not new_films:
+                return []
+            films = Film.objects.get_films(new_films)
+            new_movies = [
+                Movie(film=films[movie['tmdb_id']], top_movies=top_movies)
+                for movie in new_films
+            ]
+            last_rank = TopMovies.objects.reserve_ranks(top_movies, len(new_movies))
+            Film.objects.add_scores_on_commit(
+                {movie.film_id: borda_points(last_rank + i) for i, movie in enumerate(new_movies, start=1)},
+                {movie.film_id: 1 for movie in new_movies},
+            )
+            if top_movies.rank_mode == TopMovies.SPARSE:
+                last_position = related_movies.aggregate(Max('position'))['position__max'] or 0
+                for i, movie in enumerate(new_movies, start=1):
+                    movie.rank = None
+                    movie.position = last_position + i * RANK_GAP
+            else:
+                for i, movie in enumerate(new_movies, start=1):
+                    movie.rank = movie.position = last_rank + i
+            new_movies = self.bulk_create(new_movies)
+            notify_list_changed(top_movies.pk)
+            notify_list_reset(top_movies.pk)
+        return new_movies
+
+    def update_ranks(self, top_movies, movies, rank):
+        if connection.features.supports_deferrable_unique_constraints:
+            return movies.update(rank=rank, position=rank)
+        # (top_movies, rank) uniqueness is checked row by row here, so the
+        # rows are parked above every real rank before being moved back.
+        updated = movies.update(rank=rank + RANK_OFFSET, position=rank)
+        self.get_related_movies(top_movies).filter(rank__gt=RANK_OFFSET) \
+                                           .update(rank=F('rank') - RANK_OFFSET)
+        return updated
+
+    def shift_ranks(self, top_movies, start, end, delta):
+        movies = self.get_related_movies(top_movies).filter(rank__gte=start)
+        if end is not None:
+            movies = movies.filter(rank__lte=end)
+        return self.update_ranks(top_movies, movies, F('rank') + delta)
+
+    def move_rank(self, top_movies, movie_id, current_rank, rank):
+        delta = 1 if rank < current_rank else -1
+        movies = self.get_related_movies(top_movies).filter(
+            rank__gte=min(rank, current_rank),
+            rank__lte=max(rank, current_rank),
+        )
+        return self.update_ranks(top_movies, movies, Case(
+            When(pk=movie_id, then=Value(rank)),
+            default=F('rank') + delta,
+        ))
+
+    def renumber(self, top_movies, movie_ids=None):
+        if not isinstance(top_movies, TopMovies):
+            top_movies = TopMovies.objects.get(pk=top_movies)
+        if movie_ids is None:
+            movies = list(self.get_related_movies(top_movies).only('id'))
+        else:
+            movies = [Movie(id=movie_id) for movie_id in movie_ids]
+        for i, movie in enumerate(movies, start=1):
+            if top_movies.rank_mode == TopMovies.SPARSE:
+                movie.rank = None
+                movie.position = i * RANK_GAP
+            else:
+                movie.rank = i
+                movie.position = i
+        if not connection.features.supports_deferrable_unique_constraints:
+            self.get_related_movies(top_movies).update(rank=None)
+        self.bulk_update(movies, ['rank', 'position'])
+
 class Movie(models.Model):
     
     rank = models.PositiveIntegerField(
-        validators=[MinValueValidator(1), MaxLengthValidator(100)],
+        validators=[MinValueValidator(1), MaxValueValidator(MAX_MOVIES)],
         default=1,
+        null=True,
+        blank=True,
+    )
+    position = models.BigIntegerField(default=0)
+    film = models.ForeignKey(
+        Film,
+        on_delete=models.PROTECT,
+        related_name="movie",
     )
-    tmdb_id = models.CharField(max_length=50)
-    title = models.CharField(max_length=255)
-    release_date = models.DateField()
-    poster_path = models.URLField(max_length=255, blank=True)
     top_movies = models.ForeignKey(
         TopMovies,
         on_delete=models.CASCADE,
@@ -43,36 +399,173 @@ class Movie(models.Model):
     objects = MovieManager()
 
     class Meta:
-        ordering = ['top_movies', 'rank']
+        ordering = ['top_movies', 'position']
+        indexes = [
+            models.Index(fields=['top_movies', 'position', 'id'], name='movie_list_position_idx'),
+        ]
+        constraints = [
+            # Databases without deferrable constraints get a plain unique
+            # index on the same columns from migration 0010 instead.
+            UniqueConstraint(
+                fields=['top_movies', 'rank'],
+                name='movie_list_rank_uniq',
+                deferrable=Deferrable.DEFERRED,
+            ),
+            UniqueConstraint(fields=['top_movies', 'film'], name='movie_list_film_uniq'),
+        ]
+
+    @property
+    def tmdb_id(self):
+        return self.film.tmdb_id
+
+    @property
+    def title(self):
+        return self.film.title
+
+    @property
+    def release_date(self):
+        return self.film.release_date
+
+    @property
+    def poster_path(self):
+        return self.film.poster_path
 
     def _get_related_movies(self):
-        return Movie.objects.get_related_movies(self.top_movies)
+        return Movie.objects.get_related_movies(self.top_movies_id)
 
     related_movies = property(_get_related_movies)
 
-    def reorder_rank(self, rank):
-        if rank == self.rank:
+    def get_rank(self):
+        if self.rank is not None:
+            return self.rank
+        if hasattr(self, 'list_rank'):
+            return self.list_rank
+        return self.related_movies.filter(position__lt=self.position).count() + 1
+
+    def _get_list_state(self):
+        # Read the movie and its list in one statement so the ranks we act on
+        # belong to the revision we later compare against.
+        self.rank, self.position, *state = Movie.objects.values_list(
+            'rank', 'position', 'top_movies__rank_mode', 'top_movies__movie_count', 'top_movies__revision',
+        ).get(pk=self.pk)
+        return state
+
+    def reorder_rank(self, rank=None, delta=None, expected_revision=None):
+        # A delta is applied to the rank read in each attempt, so a move up
+        # stays a move up when a concurrent edit moved the movie first.
+        for attempt in retry_attempts():
+            rank_mode, count, revision = self._get_list_state()
+            check_revision(revision, expected_revision)
+            current_rank = self.get_rank()
+            if delta is not None:
+                rank = current_rank + delta
+            rank = min(max(rank, 1), count)
+            if rank == current_rank:
+                return
+            with transaction.atomic():
+                # Claim the revision before writing anything; a concurrent edit
+                # bumped it and we start over from fresh ranks.
+                if not notify_list_changed(self.top_movies_id, revision):
+                    check_revision(None, expected_revision)
+                    continue
+                Film.objects.add_scores_on_commit(self._get_move_scores(current_rank, rank))
+                if rank_mode == TopMovies.SPARSE:
+                    self._reorder_position(rank, count)
+                else:
+                    Movie.objects.move_rank(self.top_movies_id, self.pk, self.rank, rank)
+                    self.rank = rank
+                    self.position = rank
+                rank_changed.send(sender=Movie, top_movies_id=self.top_movies_id, event='move', data={
+                    'id': self.pk, 'from': current_rank, 'to': rank,
+                })
+                return
+
+    def _get_move_scores(self, current_rank, rank):
+        start, end = sorted([current_rank, rank])
+        siblings = self.related_movies.exclude(pk=self.pk)
+        points = -1 if rank < current_rank else 1
+        scores = {film_id: points for film_id in siblings.values_list('film', flat=True)[start - 1:end - 1]}
+        scores[self.film_id] = current_rank - rank
+        return scores
+
+    def _reorder_position(self, rank, count):
+        siblings = self.related_movies.exclude(pk=self.pk)
+        neighbours = list(siblings.values_list('position', flat=True)[max(rank - 2, 0):rank])
+        if rank == 1:
+            position = neighbours[0] - RANK_GAP
+        elif rank == count:
+            position = neighbours[-1] + RANK_GAP
+        elif neighbours[1] - neighbours[0] > 1:
+            position = (neighbours[0] + neighbours[1]) // 2
+        else:
+            Movie.objects.renumber(self.top_movies_id)
+            return self._reorder_position(rank, count)
+        self.position = position
+        Movie.objects.filter(pk=self.pk).update(position=position)
+
+    def delete_rank(self, expected_revision=None):
+        for attempt in retry_attempts():
+            revision = self._get_list_state()[-1]
+            check_revision(revision, expected_revision)
+            with transaction.atomic():
+                if not notify_list_changed(self.top_movies_id, revision):
+                    check_revision(None, expected_revision)
+                    continue
+                following = self.related_movies.filter(position__gt=self.position)
+                scores = {film_id: 1 for film_id in following.values_list('film', flat=True)}
+                rank = self.get_rank()
+                scores[self.film_id] = -borda_points(rank)
+                Film.objects.add_scores_on_commit(scores, {self.film_id: -1})
+                movie_id = self.pk
+                self.delete()
+                TopMovies.objects.release_ranks(self.top_movies_id)
+                if self.rank is not None:
+                    Movie.objects.shift_ranks(self.top_movies_id, self.rank + 1, None, -1)
+                rank_changed.send(sender=Movie, top_movies_id=self.top_movies_id, event='delete', data={
+                    'id': movie_id, 'rank': rank,
+                })
+                return
+
+    def set_film(self, film):
+        if film.pk == self.film_id:
             return
-        if rank >= self.related_movies.count():
-            rank = self.related_movies.count()
-        if rank <= 0:
-            rank = 1
-        current_rank = self.rank
-        affected_top_movies = self.related_movies.exclude(rank=current_rank) \
-                                                 .filter(Q(rank__lte=max(rank, current_rank))
-                                                         & Q(rank__gte=min(rank, current_rank)))
-        for affected_top_movie in affected_top_movies:
-            if current_rank > rank:
-                affected_top_movie.rank += 1
-            else:
-                affected_top_movie.rank -= 1
-            affected_top_movie.save()
-        self.rank = rank
-        self.save()
-    
-    def delete_rank(self):
-        affected_top_movies = self.related_movies.filter(Q(rank__gt=self.rank))
-        for affected_top_movie in affected_top_movies:
-            affected_top_movie.rank -= 1
-            affected_top_movie.save()
-        self.delete()
\ No newline at end of file
+        previous_film = self.film
+        try:
+            with transaction.atomic():
+                points = borda_points(self.get_rank())
+                Film.objects.add_scores_on_commit(
+                    {self.film_id: -points, film.pk: points}, {self.film_id: -1, film.pk: 1},
+                )
+                self.film = film
+                self.save(update_fields=['film'])
+        except IntegrityError:
+            self.film = previous_film
+            raise ValidationError('This film is already in the list.')
+
+
+@receiver(post_save, sender=TopMovies)
+def top_movies_saved(sender, instance, created, raw, **kwargs):
+    # Fixtures are loaded with raw saves and carry their own revisions.
+    if not created and not raw:
+        notify_list_changed(instance.pk)
+
+
+@receiver(pre_delete, sender=TopMovies)
+def top_movies_deleting(sender, instance, **kwargs):
+    films = list(Movie.objects.get_related_movies(instance).values_list('film', flat=True))
+    Film.objects.add_scores_on_commit(
+        {film_id: -borda_points(rank) for rank, film_id in enumerate(films, start=1)},
+        {film_id: -1 for film_id in films},
+    )
+
+
+@receiver(post_delete, sender=TopMovies)
+def top_movies_deleted(sender, instance, **kwargs):
+    list_changed.send(sender=TopMovies, top_movies_id=instance.pk)
+    notify_list_reset(instance.pk)
+
+
+@receiver(post_save, sender=Movie)
+def movie_saved(sender, instance, raw, **kwargs):
+    if not raw:
+        notify_list_changed(instance.top_movies_id)
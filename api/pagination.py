@@ -0,0 +1,132 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    ordering = ('id',)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.ordering = tuple(getattr(view, 'ordering', self.ordering))
+        self.fields = [queryset.model._meta.get_field(name.lstrip('-')) for name in self.ordering]
+        self.attnames = [field.attname for field in self.fields]
+
+        reverse, values = self.decode_cursor(request)
+        if reverse:
+            queryset = queryset.order_by(*[
+                name[1:] if name.startswith('-') else '-' + name for name in self.ordering
+            ])
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        if values is not None:
+            queryset = queryset.filter(self.get_keyset_filter(values, reverse))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next = values is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = values is not None
+        self.page = results
+        return results
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                page_size = int(request.query_params[self.page_size_query_param])
+                if page_size > 0:
+                    return min(page_size, self.max_page_size)
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def get_keyset_filter(self, values, reverse):
+        keyset_filter = Q()
+        for i, name in enumerate(self.ordering):
+            lookup = 'lt' if reverse != name.startswith('-') else 'gt'
+            condition = Q(**{f'{name.lstrip("-")}__{lookup}': values[i]})
+            for previous_name, value in zip(self.ordering[:i], values[:i]):
+                condition &= Q(**{previous_name.lstrip('-'): value})
+            keyset_filter |= condition
+        return keyset_filter
+
+    def get_values(self, instance):
+        return [getattr(instance, attname) for attname in self.attnames]
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return False, None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            reverse, values = bool(cursor['r']), cursor['v']
+        except (TypeError, ValueError, KeyError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering) or None in values:
+            raise NotFound(self.invalid_cursor_message)
+        # The values end up in a filter, so a tampered cursor must fail here.
+        try:
+            values = [field.to_python(value) for field, value in zip(self.fields, values)]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return reverse, values
+
+    def encode_cursor(self, reverse, values):
+        cursor = json.dumps({'r': int(reverse), 'v': values}, separators=(',', ':'))
+        encoded = base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(False, self.get_values(self.page[-1]))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(True, self.get_values(self.page[0]))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'previous': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
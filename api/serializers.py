@@ -1,33 +1,187 @@
-from django.forms.models import model_to_dict
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
 
-from .models import TopMovies, Movie
+from .models import FILM_FIELDS, Film, TopMovies, Movie
+from .timing import current_timings, measure
 
 # def restrict_amount(value):
 #     if Movie.objects.filter(top_movies=value).count() >= 5:
 #         raise ValidationError('Max number of movies already')
 
+def get_query_list(request, name):
+    if request is None:
+        return []
+    value = request.query_params.get(name, '')
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+class TimingMixin:
+
+    def to_representation(self, instance):
+        if current_timings.get() is None:
+            return super().to_representation(instance)
+        with measure('serialize'):
+            return super().to_representation(instance)
+
+    def run_validation(self, data=serializers.empty):
+        if current_timings.get() is None:
+            return super().run_validation(data)
+        with measure('serialize'):
+            return super().run_validation(data)
+
+class DynamicFieldsMixin:
+
+    expandable_fields = {}
+
+    def is_top_level(self):
+        if isinstance(self.parent, serializers.ListSerializer):
+            return self.parent.parent is None
+        return self.parent is None
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if not self.is_top_level():
+            return fields
+        request = self.context.get('request')
+        for name in get_query_list(request, 'expand'):
+            if name in self.expandable_fields:
+                fields[name] = self.expandable_fields[name]()
+        requested = get_query_list(request, 'fields')
+        if requested and not hasattr(self.root, 'initial_data'):
+            for name in set(fields) - set(requested):
+                fields.pop(name)
+        return fields
+
 class MovieRelatedField(serializers.RelatedField):
 
     def to_representation(self, value):
-        return model_to_dict(value)
+        return {
+            'id': value.id,
+            'rank': value.rank,
+            'tmdb_id': value.tmdb_id,
+            'title': value.title,
+            'release_date': value.release_date,
+            'poster_path': value.poster_path,
+            'top_movies': value.top_movies_id,
+        }
 
-class TopMoviesSerializer(serializers.ModelSerializer):
+class TopMoviesSerializer(TimingMixin, DynamicFieldsMixin, serializers.ModelSerializer):
     
     movie = MovieRelatedField(many=True, read_only=True)
 
     class Meta:
         model = TopMovies
-        fields = ['id', 'movie', 'title']
+        fields = ['id', 'movie', 'title', 'rank_mode']
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        for rank, movie in enumerate(data.get('movie', []), start=1):
+            movie['rank'] = rank
+        return data
+
+    def update(self, instance, validated_data):
+        rank_mode = validated_data.pop('rank_mode', instance.rank_mode)
+        instance = super().update(instance, validated_data)
+        instance.set_rank_mode(rank_mode)
+        return instance
+
+class MovieListSerializer(serializers.ListSerializer):
+
+    def create(self, validated_data):
+        if not validated_data:
+            return []
+        top_movies = validated_data[0]['top_movies']
+        try:
+            return Movie.objects.create_movies(top_movies, validated_data)
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.messages)
+
+class MovieSerializer(TimingMixin, DynamicFieldsMixin, serializers.ModelSerializer):
 
-class MovieSerializer(serializers.ModelSerializer):
+    tmdb_id = serializers.CharField(max_length=50)
+    title = serializers.CharField(max_length=255)
+    release_date = serializers.DateField()
+    poster_path = serializers.URLField(max_length=255, allow_blank=True, required=False)
+    top_movies = serializers.PrimaryKeyRelatedField(read_only=True)
 
-    top_movies = TopMoviesSerializer(required=False)
+    expandable_fields = {
+        'top_movies': lambda: TopMoviesSerializer(read_only=True),
+    }
 
     class Meta:
         model = Movie
         fields = ['id', 'tmdb_id', 'title', 'release_date',
                   'poster_path', 'top_movies', 'rank']
+        # Ranks only change through the move and order endpoints, which keep
+        # the other ranks, counts and scores in step.
+        read_only_fields = ['rank']
+        list_serializer_class = MovieListSerializer
     
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if 'rank' in data:
+            data['rank'] = instance.get_rank()
+        return data
+
     def create(self, validated_data):
-        return Movie.objects.create_movie(**validated_data)
\ No newline at end of file
+        try:
+            return Movie.objects.create_movie(**validated_data)
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.messages)
+
+    def validate(self, attrs):
+        # Film metadata is shared between lists, so an entry can only be
+        # pointed at another film, never rewrite the one it references.
+        instance = self.instance
+        if instance is None:
+            return attrs
+        if attrs.get('tmdb_id', instance.tmdb_id) == instance.tmdb_id:
+            errors = {
+                name: 'Film details are shared between lists and cannot be changed, send another tmdb_id.'
+                for name in FILM_FIELDS if name in attrs and attrs[name] != getattr(instance, name)
+            }
+        elif Film.objects.filter(tmdb_id=attrs['tmdb_id']).exists():
+            errors = {}
+        else:
+            errors = {
+                name: 'Required for a film that is not in the catalog yet.'
+                for name in ('title', 'release_date') if name not in attrs
+            }
+        if errors:
+            raise serializers.ValidationError(errors)
+        return attrs
+
+    def update(self, instance, validated_data):
+        film_data = {name: validated_data.pop(name) for name in FILM_FIELDS if name in validated_data}
+        if film_data.get('tmdb_id', instance.tmdb_id) != instance.tmdb_id:
+            # A film already in the catalog keeps its details.
+            film = Film.objects.filter(tmdb_id=film_data['tmdb_id']).first()
+            try:
+                instance.set_film(film or Film.objects.get_film(**film_data))
+            except DjangoValidationError as e:
+                raise serializers.ValidationError(e.messages)
+        return super().update(instance, validated_data)
+
+class MovieOrderSerializer(TimingMixin, serializers.Serializer):
+
+    order = serializers.ListField(child=serializers.IntegerField(), allow_empty=True)
+
+    def validate_order(self, value):
+        top_movies = self.context['top_movies']
+        movie_ids = set(Movie.objects.get_related_movies(top_movies).values_list('id', flat=True))
+        if len(value) != len(set(value)):
+            raise serializers.ValidationError('Movie ids must not repeat.')
+        if set(value) != movie_ids:
+            raise serializers.ValidationError('Order must contain every movie of this list exactly once.')
+        return value
+
+
+class MoveToSerializer(TimingMixin, serializers.Serializer):
+
+    rank = serializers.IntegerField()
+
+
+class LeaderboardSerializer(TimingMixin, serializers.ModelSerializer):
+
+    class Meta:
+        model = Film
+        fields = ['tmdb_id', 'title', 'release_date', 'poster_path', 'score', 'list_count']
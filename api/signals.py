@@ -0,0 +1,11 @@
+from django.dispatch import Signal
+
+# Sent after the movies or metadata of a TopMovies list change, with the
+# keyword argument `top_movies_id`.
+list_changed = Signal()
+
+# Sent when a movie is added to, moved within or removed from a TopMovies
+# list, with the keyword arguments `top_movies_id`, `event` ('add', 'move'
+# or 'delete') and `data`, a compact description of the change. Changes to
+# many ranks at once, like a new order or a deleted list, send 'reset'.
+rank_changed = Signal()
@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from .timing import AsyncCapableMiddleware, get_view_name, wrap_queries
+
+logger = logging.getLogger('api.slow_queries')
+
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+QUOTED_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+VALUE_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+SPACE_RE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    # Statements that differ only in their values or IN-list lengths share
+    # a fingerprint.
+    sql = QUOTED_RE.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = NUMBER_RE.sub('?', sql)
+    sql = VALUE_LIST_RE.sub('(...)', sql)
+    return SPACE_RE.sub(' ', sql).strip()
+
+
+class SlowQueryLog:
+
+    # A fixed number of cache slots written round-robin, so every process
+    # sharing the cache appends to the same bounded log.
+    prefix = 'slow-queries'
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'API_SLOW_QUERY_CACHE_ALIAS', 'default')]
+
+    @property
+    def size(self):
+        return getattr(settings, 'API_SLOW_QUERY_LOG_SIZE', 100)
+
+    def slot_keys(self):
+        return [f'{self.prefix}:{slot}' for slot in range(self.size)]
+
+    def append(self, entry):
+        key = f'{self.prefix}:sequence'
+        self.cache.add(key, 0, None)
+        try:
+            sequence = self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, 1, None)
+            sequence = 1
+        entry['sequence'] = sequence
+        self.cache.set(f'{self.prefix}:{sequence % self.size}', entry, None)
+
+    def entries(self):
+        # Newest first.
+        entries = self.cache.get_many(self.slot_keys()).values()
+        return sorted(entries, key=lambda entry: entry['sequence'], reverse=True)
+
+    def clear(self):
+        self.cache.delete_many(self.slot_keys() + [f'{self.prefix}:sequence'])
+
+
+slow_query_log = SlowQueryLog()
+
+
+def explain(connection, sql, params, many):
+    if not sql.lstrip().upper().startswith(EXPLAINABLE):
+        return None
+    if many:
+        params = next(iter(params), None)
+    try:
+        prefix = connection.ops.explain_query_prefix()
+        # A savepoint keeps a failing EXPLAIN from aborting the transaction.
+        with transaction.atomic(using=connection.alias):
+            cursor = connection.create_cursor()
+            try:
+                cursor.execute(f'{prefix} {sql}', params)
+                return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+            finally:
+                cursor.close()
+    except DatabaseError as e:
+        return f'EXPLAIN failed: {e}'
+
+
+class SlowQueryRecorder:
+
+    def __init__(self, threshold, request=None):
+        self.threshold = threshold
+        self.request = request
+        self.recording = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.recording:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        result = execute(sql, params, many, context)
+        duration = time.perf_counter() - start
+        if duration * 1000 >= self.threshold:
+            self.recording = True
+            try:
+                self.record(context['connection'], sql, params, many, duration)
+            finally:
+                self.recording = False
+        return result
+
+    def record(self, connection, sql, params, many, duration):
+        normalized = fingerprint(sql)
+        entry = {
+            'fingerprint': normalized,
+            'fingerprint_id': hashlib.sha1(normalized.encode()).hexdigest()[:12],
+            'sql': sql,
+            'view': get_view_name(self.request),
+            'duration_ms': round(duration * 1000, 2),
+            'vendor': connection.vendor,
+            'explain': explain(connection, sql, params, many),
+            'recorded_at': timezone.now().isoformat(),
+        }
+        slow_query_log.append(entry)
+        logger.warning(
+            'slow query view=%s duration_ms=%s fingerprint_id=%s',
+            entry['view'], entry['duration_ms'], entry['fingerprint_id'],
+        )
+
+
+class SlowQueryMiddleware(AsyncCapableMiddleware):
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.threshold = getattr(settings, 'API_SLOW_QUERY_MS', None)
+        if self.threshold is None:
+            raise MiddlewareNotUsed
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        with wrap_queries(SlowQueryRecorder(self.threshold, request)):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with wrap_queries(SlowQueryRecorder(self.threshold, request)):
+            return await self.get_response(request)
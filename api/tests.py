@@ -1,15 +1,57 @@
+import asyncio
+import base64
+import csv
+import datetime
+import decimal
 import json
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import unittest
+import uuid
+from io import StringIO
+from unittest import mock
 
-from django.test import TestCase
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.translation import gettext_lazy
+from rest_framework import renderers
 from rest_framework.test import APIClient
 from rest_framework import status
 
-from .models import TopMovies, Movie
+from .async_views import ASGIHandler
+from .cache import payload_cache
+from .events import QUEUE_SIZE, LocalBackend, PostgresBackend, get_backend as get_events_backend, publish
+from .metrics import registry
+from .renderers import BACKENDS, JSONRenderer
+from .slow_queries import fingerprint, slow_query_log
+from .serializers import MovieOrderSerializer
+from .models import ConcurrentUpdate, Film, TopMovies, Movie, MAX_MOVIES, MAX_RETRIES, RANK_GAP, notify_list_changed
 
 API_PATH = 'api/v1'
 
 TEST_MOVIES = json.load(open("functional_tests/movies.json"))
 
+# Without deferrable unique constraints, rank shifts park the affected rows
+# in a second statement.
+PARKING_QUERIES = 0 if connection.features.supports_deferrable_unique_constraints else 1
+
+
+def run_commit_hooks():
+    # TestCase never commits, so the hooks a commit would run, like the
+    # leaderboard score updates, are run here.
+    while connection.run_on_commit:
+        sids, func = connection.run_on_commit.pop(0)
+        func()
+
 class APIRootTest(TestCase):
     
     client = APIClient
@@ -22,6 +64,9 @@ class TopMoviesViewSetTest(TestCase):
     
     client = APIClient
     
+    def setUp(self):
+        cache.clear()
+
     def test_can_GET_top_movies(self):
         top_movies = TopMovies.objects.create()
         response = self.client.get(f'/{API_PATH}/top-movies/{top_movies.id}/')
@@ -33,14 +78,13 @@ class MovieViewSetTest(TestCase):
     
     def setUp(self):
         top_movies = TopMovies.objects.create()
-        movie = {
-            'tmdb_id': '123',
-            'title': 'new movie',
-            'release_date': '2012-04-25',
-            'poster_path': 'https://themoviedb.org/path-to-movie-poster.jpg',
-            'top_movies': top_movies
-        }
-        self.movie = Movie.objects.create(**movie)
+        film = Film.objects.create(
+            tmdb_id='123',
+            title='new movie',
+            release_date='2012-04-25',
+            poster_path='https://themoviedb.org/path-to-movie-poster.jpg',
+        )
+        self.movie = Movie.objects.create(film=film, top_movies=top_movies)
 
     def test_can_GET_movie(self):
         response = self.client.get(f'/{API_PATH}/top-movie/{self.movie.id}/')
@@ -129,6 +173,15 @@ class MovieRankingTest(TestCase):
             data=TEST_MOVIES[0]
         )
         self.assertEqual(self.top_movies.movie.count(), 5)
+
+    def test_patching_rank_is_ignored(self):
+        movie = self.top_movies.movie.get(rank=4)
+        response = self.client.patch(
+            f'/{API_PATH}/top-movie/{movie.id}/', data=json.dumps({'rank': 2}), content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['rank'], 4)
+        self.assertEqual(list(self.top_movies.movie.values_list('rank', flat=True)), [1, 2, 3, 4, 5])
     
     def test_delete_movie_updates_movie_ranks_correctly(self):
         movie_1 = self.top_movies.movie.get(rank=1)
@@ -202,3 +255,2105 @@ class MovieRankingTest(TestCase):
         self.assertEqual(movie_2.title, TEST_MOVIES[2]["title"])
         self.assertEqual(movie_3.title, TEST_MOVIES[1]["title"])
 
+
+class MovieRankQueryCountTest(TestCase):
+
+    LIST_SIZES = [10, 100, 1000]
+
+    def create_top_movies(self, size):
+        top_movies = TopMovies.objects.create(movie_count=size)
+        films = Film.objects.get_films([
+            {'tmdb_id': str(i), 'title': f'movie {i}', 'release_date': '2012-04-25'}
+            for i in range(1, size + 1)
+        ])
+        Movie.objects.bulk_create([
+            Movie(
+                film=films[str(i)],
+                top_movies=top_movies,
+                rank=i,
+                position=i,
+            )
+            for i in range(1, size + 1)
+        ])
+        return top_movies
+
+    def assertDenseRanks(self, top_movies):
+        ranks = list(top_movies.movie.values_list('rank', flat=True))
+        self.assertEqual(ranks, list(range(1, len(ranks) + 1)))
+
+    def test_reorder_rank_runs_constant_number_of_queries(self):
+        for size in self.LIST_SIZES:
+            with self.subTest(size=size):
+                top_movies = self.create_top_movies(size)
+                movie = top_movies.movie.get(rank=size)
+                with self.assertNumQueries(6 + PARKING_QUERIES):
+                    movie.reorder_rank(1)
+                self.assertEqual(top_movies.movie.get(rank=1).id, movie.id)
+                self.assertEqual(top_movies.movie.get(rank=2).tmdb_id, '1')
+                self.assertDenseRanks(top_movies)
+
+                with self.assertNumQueries(6 + PARKING_QUERIES):
+                    movie.reorder_rank(size)
+                self.assertEqual(top_movies.movie.get(rank=size).id, movie.id)
+                self.assertEqual(top_movies.movie.get(rank=1).tmdb_id, '1')
+                self.assertDenseRanks(top_movies)
+
+    def test_delete_rank_runs_constant_number_of_queries(self):
+        for size in self.LIST_SIZES:
+            with self.subTest(size=size):
+                top_movies = self.create_top_movies(size)
+                movie = top_movies.movie.get(rank=1)
+                with self.assertNumQueries(8 + PARKING_QUERIES):
+                    movie.delete_rank()
+                self.assertEqual(top_movies.movie.count(), size - 1)
+                self.assertEqual(top_movies.movie.get(rank=1).tmdb_id, '2')
+                self.assertDenseRanks(top_movies)
+
+    def test_sparse_move_writes_one_movie_and_scores_films_after_commit(self):
+        size = 100
+        top_movies = self.create_top_movies(size)
+        top_movies.set_rank_mode(TopMovies.SPARSE)
+        run_commit_hooks()
+        movie = top_movies.movie.get(position=size * RANK_GAP)
+        with CaptureQueriesContext(connection) as context:
+            movie.reorder_rank(1)
+        writes = [query['sql'].split()[1] for query in context.captured_queries
+                  if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        # The revision and the moved movie, while no film row is locked.
+        self.assertEqual(writes, ['"api_topmovies"', '"api_movie"'])
+        with CaptureQueriesContext(connection) as context, \
+                mock.patch.object(Film.objects, 'add_scores', wraps=Film.objects.add_scores) as add_scores:
+            run_commit_hooks()
+        # Once committed, every film that changed rank is scored in one statement.
+        self.assertEqual(len(context), 1)
+        self.assertEqual(len(add_scores.call_args[0][0]), size)
+        self.assertEqual(Film.objects.get(pk=movie.film_id).score, size - 1)
+
+    def test_reorder_rank_clamps_out_of_range_ranks(self):
+        top_movies = self.create_top_movies(10)
+        movie = top_movies.movie.get(rank=5)
+        movie.reorder_rank(0)
+        self.assertEqual(movie.rank, 1)
+        movie.reorder_rank(50)
+        self.assertEqual(movie.rank, 10)
+        self.assertDenseRanks(top_movies)
+
+    def test_relative_move_uses_the_rank_of_each_attempt(self):
+        top_movies = self.create_top_movies(10)
+        movie = top_movies.movie.get(rank=5)
+        claims = []
+
+        def notify(top_movies_id, revision=None):
+            if not claims:
+                claims.append(revision)
+                # A concurrent edit moves the movie to the top before the
+                # move up claims the revision.
+                Movie.objects.get(pk=movie.pk).reorder_rank(1)
+                return False
+            return notify_list_changed(top_movies_id, revision)
+
+        with mock.patch('api.models.notify_list_changed', side_effect=notify):
+            movie.reorder_rank(delta=-1)
+        self.assertEqual(top_movies.movie.get(pk=movie.pk).rank, 1)
+        self.assertDenseRanks(top_movies)
+
+class SparseRankModeTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        cache.clear()
+        self.top_movies = TopMovies.objects.create(rank_mode=TopMovies.SPARSE)
+        self.movies = [
+            self.client.post(
+                f'/{API_PATH}/top-movies/{self.top_movies.id}/add/',
+                data=movie
+            ).data
+            for movie in TEST_MOVIES
+        ]
+
+    def get_positions(self):
+        return dict(self.top_movies.movie.values_list('id', 'position'))
+
+    def get_titles(self):
+        response = self.client.get(f'/{API_PATH}/top-movies/{self.top_movies.id}/')
+        ranks = [movie['rank'] for movie in response.data['movie']]
+        self.assertEqual(ranks, list(range(1, len(TEST_MOVIES) + 1)))
+        return [movie['title'] for movie in response.data['movie']]
+
+    def test_added_movies_get_dense_ranks(self):
+        for i, movie in enumerate(self.movies):
+            self.assertEqual(movie['rank'], i+1)
+        self.assertEqual(self.top_movies.movie.filter(rank__isnull=True).count(), 5)
+
+    def test_patching_rank_leaves_ranks_sparse(self):
+        movie_5 = self.movies[4]
+        response = self.client.patch(
+            f'/{API_PATH}/top-movie/{movie_5["id"]}/', data=json.dumps({'rank': 1}), content_type='application/json',
+        )
+        self.assertEqual(response.data['rank'], 5)
+        self.assertEqual(self.top_movies.movie.filter(rank__isnull=True).count(), 5)
+        self.assertEqual(self.get_titles()[-1], TEST_MOVIES[4]['title'])
+
+    def test_move_rank_up_writes_only_moved_movie(self):
+        movie_3 = self.movies[2]
+        positions = self.get_positions()
+        response = self.client.put(
+            f'/{API_PATH}/top-movie/{movie_3["id"]}/move-rank-up/',
+        )
+        self.assertEqual(response.data['rank'], 2)
+        new_positions = self.get_positions()
+        changed = [pk for pk in positions if positions[pk] != new_positions[pk]]
+        self.assertEqual(changed, [movie_3['id']])
+        titles = [movie['title'] for movie in TEST_MOVIES]
+        titles[1], titles[2] = titles[2], titles[1]
+        self.assertEqual(self.get_titles(), titles)
+
+    def test_move_rank_down_writes_only_moved_movie(self):
+        movie_1 = self.movies[0]
+        positions = self.get_positions()
+        response = self.client.put(
+            f'/{API_PATH}/top-movie/{movie_1["id"]}/move-rank-down/',
+        )
+        self.assertEqual(response.data['rank'], 2)
+        new_positions = self.get_positions()
+        changed = [pk for pk in positions if positions[pk] != new_positions[pk]]
+        self.assertEqual(changed, [movie_1['id']])
+        titles = [movie['title'] for movie in TEST_MOVIES]
+        titles[0], titles[1] = titles[1], titles[0]
+        self.assertEqual(self.get_titles(), titles)
+
+    def test_delete_rank_keeps_remaining_ranks_dense(self):
+        positions = self.get_positions()
+        response = self.client.delete(
+            f'/{API_PATH}/top-movie/{self.movies[1]["id"]}/delete-rank/',
+        )
+        self.assertEqual(response.status_code, 200)
+        new_positions = self.get_positions()
+        del positions[self.movies[1]['id']]
+        self.assertEqual(positions, new_positions)
+        response = self.client.get(f'/{API_PATH}/top-movies/{self.top_movies.id}/')
+        ranks = [movie['rank'] for movie in response.data['movie']]
+        self.assertEqual(ranks, [1, 2, 3, 4])
+
+    def test_dense_keys_are_rebalanced(self):
+        for i, movie in enumerate(self.top_movies.movie.all()):
+            movie.position = i
+            movie.save()
+        movie = self.top_movies.movie.get(id=self.movies[4]['id'])
+        movie.reorder_rank(2)
+        self.assertEqual(movie.get_rank(), 2)
+        positions = list(self.top_movies.movie.values_list('position', flat=True))
+        gaps = [b - a for a, b in zip(positions, positions[1:])]
+        self.assertTrue(all(gap > 1 for gap in gaps))
+        titles = [movie['title'] for movie in TEST_MOVIES]
+        titles.insert(1, titles.pop())
+        self.assertEqual(self.get_titles(), titles)
+
+    def test_switching_rank_mode_keeps_order(self):
+        self.client.put(f'/{API_PATH}/top-movie/{self.movies[4]["id"]}/move-rank-up/')
+        titles = self.get_titles()
+        response = self.client.patch(
+            f'/{API_PATH}/top-movies/{self.top_movies.id}/',
+            data=json.dumps({'rank_mode': TopMovies.DENSE}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.data['rank_mode'], TopMovies.DENSE)
+        ranks = list(self.top_movies.movie.values_list('rank', flat=True))
+        self.assertEqual(ranks, [1, 2, 3, 4, 5])
+        self.assertEqual(self.get_titles(), titles)
+
+class TopMoviesOrderTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        self.top_movies = TopMovies.objects.create()
+        self.movies = [
+            self.client.post(
+                f'/{API_PATH}/top-movies/{self.top_movies.id}/add/',
+                data=movie
+            ).data
+            for movie in TEST_MOVIES
+        ]
+        self.other_top_movies = TopMovies.objects.create()
+        self.other_movie = self.client.post(
+            f'/{API_PATH}/top-movies/{self.other_top_movies.id}/add/',
+            data=TEST_MOVIES[0]
+        ).data
+
+    def put_order(self, order, top_movies=None):
+        top_movies = top_movies or self.top_movies
+        return self.client.put(
+            f'/{API_PATH}/top-movies/{top_movies.id}/order/',
+            data=json.dumps({'order': order}),
+            content_type='application/json',
+        )
+
+    def test_can_PUT_full_ordering(self):
+        order = [movie['id'] for movie in reversed(self.movies)]
+        with self.assertNumQueries(10 + PARKING_QUERIES):
+            self.put_order(order)
+        response = self.put_order(order)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([movie['id'] for movie in response.data['movie']], order)
+        self.assertEqual([movie['rank'] for movie in response.data['movie']], [1, 2, 3, 4, 5])
+        ranks = list(self.top_movies.movie.values_list('id', 'rank'))
+        self.assertEqual(ranks, [(movie_id, i + 1) for i, movie_id in enumerate(order)])
+
+    def test_can_PUT_full_ordering_in_sparse_mode(self):
+        self.top_movies.set_rank_mode(TopMovies.SPARSE)
+        order = [movie['id'] for movie in reversed(self.movies)]
+        response = self.put_order(order)
+        self.assertEqual([movie['id'] for movie in response.data['movie']], order)
+        self.assertEqual([movie['rank'] for movie in response.data['movie']], [1, 2, 3, 4, 5])
+
+    def test_incomplete_ordering_is_rejected(self):
+        order = [movie['id'] for movie in self.movies[1:]]
+        response = self.put_order(order)
+        self.assertEqual(response.status_code, 400)
+
+    def test_repeated_movie_is_rejected(self):
+        order = [movie['id'] for movie in self.movies]
+        order[0] = order[1]
+        response = self.put_order(order)
+        self.assertEqual(response.status_code, 400)
+
+    def test_movie_from_other_list_is_rejected(self):
+        order = [movie['id'] for movie in self.movies[1:]] + [self.other_movie['id']]
+        response = self.put_order(order)
+        self.assertEqual(response.status_code, 400)
+        ranks = list(self.top_movies.movie.values_list('rank', flat=True))
+        self.assertEqual(ranks, [1, 2, 3, 4, 5])
+
+    def test_movie_deleted_after_validation_is_rejected(self):
+        order = [movie['id'] for movie in reversed(self.movies)]
+        validate_order = MovieOrderSerializer.validate_order
+
+        def delete_concurrently(serializer, value):
+            value = validate_order(serializer, value)
+            Movie.objects.get(pk=self.movies[0]['id']).delete_rank()
+            return value
+
+        with mock.patch.object(MovieOrderSerializer, 'validate_order', delete_concurrently):
+            response = self.put_order(order)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('order', response.data)
+        ranks = list(self.top_movies.movie.values_list('id', 'rank'))
+        self.assertEqual(ranks, [(movie['id'], i) for i, movie in enumerate(self.movies[1:], start=1)])
+
+    def test_movie_added_after_validation_is_rejected(self):
+        order = [movie['id'] for movie in reversed(self.movies)]
+        Movie.objects.create_movie(**dict(TEST_MOVIES[0], tmdb_id='999'), top_movies=self.top_movies)
+        with self.assertRaises(ValidationError):
+            self.top_movies.set_order(order)
+        self.assertEqual(list(self.top_movies.movie.values_list('rank', flat=True)), [1, 2, 3, 4, 5, 6])
+
+class MoveToTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        self.top_movies = TopMovies.objects.create()
+        self.movies = [
+            self.client.post(
+                f'/{API_PATH}/top-movies/{self.top_movies.id}/add/',
+                data=movie
+            ).data
+            for movie in TEST_MOVIES
+        ]
+
+    def move_to(self, movie, rank):
+        return self.client.put(
+            f'/{API_PATH}/top-movie/{movie["id"]}/move-to/',
+            data=json.dumps({'rank': rank}),
+            content_type='application/json',
+        )
+
+    def get_titles(self):
+        return list(self.top_movies.movie.values_list('film__title', flat=True))
+
+    def test_move_to_higher_rank(self):
+        response = self.move_to(self.movies[4], 2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['previous_rank'], 5)
+        self.assertEqual(response.data['rank'], 2)
+        self.assertEqual(response.data['shifted'], {'start': 2, 'end': 4, 'delta': 1})
+        titles = [movie['title'] for movie in TEST_MOVIES]
+        titles.insert(1, titles.pop())
+        self.assertEqual(self.get_titles(), titles)
+
+    def test_move_to_lower_rank(self):
+        response = self.move_to(self.movies[0], 3)
+        self.assertEqual(response.data['rank'], 3)
+        self.assertEqual(response.data['shifted'], {'start': 2, 'end': 3, 'delta': -1})
+        titles = [movie['title'] for movie in TEST_MOVIES]
+        titles.insert(2, titles.pop(0))
+        self.assertEqual(self.get_titles(), titles)
+
+    def test_move_to_clamps_target_rank(self):
+        response = self.move_to(self.movies[1], 100)
+        self.assertEqual(response.data['rank'], 5)
+        response = self.move_to(self.movies[1], -3)
+        self.assertEqual(response.data['rank'], 1)
+        response = self.move_to(self.movies[1], 1)
+        self.assertIsNone(response.data['shifted'])
+
+    def test_move_to_in_sparse_mode(self):
+        self.top_movies.set_rank_mode(TopMovies.SPARSE)
+        response = self.move_to(self.movies[4], 1)
+        self.assertEqual(response.data['rank'], 1)
+        self.assertEqual(response.data['shifted'], {'start': 1, 'end': 4, 'delta': 1})
+        self.assertEqual(self.get_titles()[0], TEST_MOVIES[4]['title'])
+
+    def test_move_to_requires_rank(self):
+        response = self.client.put(f'/{API_PATH}/top-movie/{self.movies[0]["id"]}/move-to/')
+        self.assertEqual(response.status_code, 400)
+
+    def test_move_to_gives_up_on_persistent_conflicts(self):
+        with mock.patch('api.models.notify_list_changed', return_value=False) as notify:
+            response = self.move_to(self.movies[4], 1)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(notify.call_count, MAX_RETRIES)
+        self.assertEqual(self.get_titles(), [movie['title'] for movie in TEST_MOVIES])
+
+class AddManyTest(TestCase):
+
+    client = APIClient
+
+    def post_movies(self, path, movies):
+        return self.client.post(
+            f'/{API_PATH}/{path}',
+            data=json.dumps(movies),
+            content_type='application/json',
+        )
+
+    def test_can_POST_many_movies_to_existing_list(self):
+        top_movies = TopMovies.objects.create()
+        response = self.post_movies(f'top-movies/{top_movies.id}/add-many/', TEST_MOVIES)
+        self.assertEqual(response.status_code, 201)
+        titles = [movie['title'] for movie in response.data['movie']]
+        self.assertEqual(titles, [movie['title'] for movie in TEST_MOVIES])
+        ranks = list(top_movies.movie.values_list('rank', flat=True))
+        self.assertEqual(ranks, [1, 2, 3, 4, 5])
+
+    def test_add_many_appends_after_existing_movies(self):
+        top_movies = TopMovies.objects.create()
+        self.post_movies(f'top-movies/{top_movies.id}/add-many/', TEST_MOVIES[:2])
+        self.post_movies(f'top-movies/{top_movies.id}/add-many/', TEST_MOVIES[2:])
+        ranks = list(top_movies.movie.values_list('rank', 'film__title'))
+        self.assertEqual(ranks, [(i + 1, movie['title']) for i, movie in enumerate(TEST_MOVIES)])
+
+    def test_add_many_skips_duplicate_tmdb_ids(self):
+        top_movies = TopMovies.objects.create()
+        self.post_movies(f'top-movies/{top_movies.id}/add-many/', TEST_MOVIES[:2])
+        response = self.post_movies(
+            f'top-movies/{top_movies.id}/add-many/',
+            [TEST_MOVIES[1], TEST_MOVIES[2], TEST_MOVIES[2]],
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(top_movies.movie.count(), 3)
+        self.assertEqual(list(top_movies.movie.values_list('rank', flat=True)), [1, 2, 3])
+
+    def test_add_many_in_sparse_mode(self):
+        top_movies = TopMovies.objects.create(rank_mode=TopMovies.SPARSE)
+        response = self.post_movies(f'top-movies/{top_movies.id}/add-many/', TEST_MOVIES)
+        self.assertEqual([movie['rank'] for movie in response.data['movie']], [1, 2, 3, 4, 5])
+
+    def test_add_many_runs_constant_number_of_queries(self):
+        top_movies = TopMovies.objects.create()
+        with self.assertNumQueries(12):
+            self.post_movies(f'top-movies/{top_movies.id}/add-many/', TEST_MOVIES)
+        other_top_movies = TopMovies.objects.create()
+        movies = [dict(TEST_MOVIES[0], tmdb_id=str(i)) for i in range(100)]
+        with self.assertNumQueries(12):
+            self.post_movies(f'top-movies/{other_top_movies.id}/add-many/', movies)
+        known_top_movies = TopMovies.objects.create()
+        with self.assertNumQueries(10):
+            self.post_movies(f'top-movies/{known_top_movies.id}/add-many/', movies)
+
+    def test_invalid_movie_rejects_whole_batch(self):
+        top_movies = TopMovies.objects.create()
+        movies = TEST_MOVIES[:2] + [{'title': 'missing fields'}]
+        response = self.post_movies(f'top-movies/{top_movies.id}/add-many/', movies)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(top_movies.movie.count(), 0)
+
+    def test_can_POST_new_populated_top_movies_list(self):
+        response = self.post_movies('top-movies/new/', TEST_MOVIES)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(TopMovies.objects.count(), 1)
+        top_movies = TopMovies.objects.first()
+        self.assertEqual(response.data['id'], top_movies.id)
+        self.assertEqual(top_movies.movie.count(), 5)
+
+    def test_invalid_new_populated_list_is_not_created(self):
+        response = self.post_movies('top-movies/new/', [{'title': 'missing fields'}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(TopMovies.objects.count(), 0)
+
+class MovieCountTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        self.top_movies = TopMovies.objects.create()
+
+    def get_movie_count(self):
+        self.top_movies.refresh_from_db()
+        return self.top_movies.movie_count
+
+    def test_movie_count_follows_add_and_delete(self):
+        movies = [
+            self.client.post(
+                f'/{API_PATH}/top-movies/{self.top_movies.id}/add/',
+                data=movie
+            ).data
+            for movie in TEST_MOVIES
+        ]
+        self.assertEqual(self.get_movie_count(), 5)
+        self.client.post(f'/{API_PATH}/top-movies/{self.top_movies.id}/add/', data=TEST_MOVIES[0])
+        self.assertEqual(self.get_movie_count(), 5)
+        self.client.delete(f'/{API_PATH}/top-movie/{movies[0]["id"]}/delete-rank/')
+        self.assertEqual(self.get_movie_count(), 4)
+        self.client.delete(f'/{API_PATH}/top-movie/{movies[1]["id"]}/')
+        self.assertEqual(self.get_movie_count(), 3)
+        self.assertEqual(list(self.top_movies.movie.values_list('rank', flat=True)), [1, 2, 3])
+
+    def test_movie_count_follows_bulk_add(self):
+        self.client.post(
+            f'/{API_PATH}/top-movies/{self.top_movies.id}/add-many/',
+            data=json.dumps(TEST_MOVIES + TEST_MOVIES),
+            content_type='application/json',
+        )
+        self.assertEqual(self.get_movie_count(), 5)
+
+    def test_add_does_not_scan_existing_movies(self):
+        for movie in TEST_MOVIES:
+            self.client.post(f'/{API_PATH}/top-movies/{self.top_movies.id}/add/', data=movie)
+        with self.assertNumQueries(12):
+            self.client.post(
+                f'/{API_PATH}/top-movies/{self.top_movies.id}/add/',
+                data=dict(TEST_MOVIES[0], tmdb_id='999'),
+            )
+
+    def test_cannot_add_more_than_max_movies(self):
+        movies = [dict(TEST_MOVIES[0], tmdb_id=str(i)) for i in range(MAX_MOVIES)]
+        self.client.post(
+            f'/{API_PATH}/top-movies/{self.top_movies.id}/add-many/',
+            data=json.dumps(movies),
+            content_type='application/json',
+        )
+        response = self.client.post(
+            f'/{API_PATH}/top-movies/{self.top_movies.id}/add/',
+            data=dict(TEST_MOVIES[0], tmdb_id='extra'),
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            f'/{API_PATH}/top-movies/{self.top_movies.id}/add-many/',
+            data=json.dumps([dict(TEST_MOVIES[0], tmdb_id='extra')]),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get_movie_count(), MAX_MOVIES)
+        self.assertEqual(self.top_movies.movie.count(), MAX_MOVIES)
+
+    def test_recount_movies_repairs_drifted_counters(self):
+        for movie in TEST_MOVIES:
+            self.client.post(f'/{API_PATH}/top-movies/{self.top_movies.id}/add/', data=movie)
+        empty_top_movies = TopMovies.objects.create()
+        TopMovies.objects.update(movie_count=42)
+        out = StringIO()
+        call_command('recount_movies', chunk_size=1, stdout=out)
+        self.assertIn('corrected 2', out.getvalue())
+        self.assertEqual(self.get_movie_count(), 5)
+        empty_top_movies.refresh_from_db()
+        self.assertEqual(empty_top_movies.movie_count, 0)
+
+class ReadQueryCountTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        cache.clear()
+
+    def create_top_movies(self, count, rank_mode=TopMovies.DENSE):
+        for _ in range(count):
+            top_movies = TopMovies.objects.create(rank_mode=rank_mode)
+            Movie.objects.create_movies(top_movies, TEST_MOVIES)
+
+    def count_queries(self, path):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f'/{API_PATH}/{path}')
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_top_movies_list_query_count_is_flat(self):
+        self.create_top_movies(1)
+        queries = self.count_queries('top-movies/')
+        self.create_top_movies(20)
+        self.assertEqual(self.count_queries('top-movies/'), queries)
+        self.assertEqual(queries, 2)
+
+    def test_top_movies_detail_query_count_is_flat(self):
+        self.create_top_movies(1)
+        top_movies = TopMovies.objects.first()
+        self.assertEqual(self.count_queries(f'top-movies/{top_movies.id}/'), 3)
+
+    def test_movie_list_query_count_is_flat(self):
+        for rank_mode in [TopMovies.DENSE, TopMovies.SPARSE]:
+            with self.subTest(rank_mode=rank_mode):
+                self.create_top_movies(1, rank_mode)
+                queries = self.count_queries('top-movie/')
+                self.create_top_movies(20, rank_mode)
+                self.assertEqual(self.count_queries('top-movie/'), queries)
+                self.assertEqual(queries, 1)
+                queries = self.count_queries('top-movie/?expand=top_movies')
+                self.create_top_movies(20, rank_mode)
+                self.assertEqual(self.count_queries('top-movie/?expand=top_movies'), queries)
+                self.assertEqual(queries, 2)
+
+    def test_movie_list_returns_dense_ranks_in_sparse_mode(self):
+        self.create_top_movies(2, TopMovies.SPARSE)
+        response = self.client.get(f'/{API_PATH}/top-movie/')
+        ranks = [movie['rank'] for movie in response.data['results']]
+        self.assertEqual(ranks, [1, 2, 3, 4, 5] * 2)
+
+    def test_movie_detail_query_count_is_flat(self):
+        self.create_top_movies(1)
+        movie = Movie.objects.last()
+        self.assertEqual(self.count_queries(f'top-movie/{movie.id}/'), 2)
+        self.assertEqual(self.count_queries(f'top-movie/{movie.id}/?expand=top_movies'), 3)
+
+class CompactRepresentationTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        self.top_movies = TopMovies.objects.create(title='favourites')
+        Movie.objects.create_movies(self.top_movies, TEST_MOVIES)
+        self.movie = self.top_movies.movie.get(rank=2)
+
+    def get(self, path):
+        return self.client.get(f'/{API_PATH}/{path}')
+
+    def test_movie_references_parent_by_id(self):
+        response = self.get(f'top-movie/{self.movie.id}/')
+        self.assertEqual(response.data['top_movies'], self.top_movies.id)
+        self.assertEqual(response.data['rank'], 2)
+
+    def test_movie_can_expand_parent(self):
+        response = self.get(f'top-movie/{self.movie.id}/?expand=top_movies')
+        self.assertEqual(response.data['top_movies']['id'], self.top_movies.id)
+        self.assertEqual(len(response.data['top_movies']['movie']), 5)
+
+    def test_move_rank_up_returns_compact_movie(self):
+        response = self.client.put(f'/{API_PATH}/top-movie/{self.movie.id}/move-rank-up/')
+        self.assertEqual(response.data['rank'], 1)
+        self.assertEqual(response.data['top_movies'], self.top_movies.id)
+
+    def test_movie_sparse_fieldset(self):
+        response = self.get(f'top-movie/{self.movie.id}/?fields=id,rank')
+        self.assertEqual(response.data, {'id': self.movie.id, 'rank': 2})
+        response = self.get('top-movie/?fields=title')
+        self.assertEqual([movie['title'] for movie in response.data['results']],
+                         [movie['title'] for movie in TEST_MOVIES])
+        self.assertEqual(set(response.data['results'][0]), {'title'})
+
+    def test_top_movies_sparse_fieldset_skips_movies(self):
+        with self.assertNumQueries(1):
+            response = self.get('top-movies/?fields=id,title')
+        self.assertEqual(response.data['results'], [{'id': self.top_movies.id, 'title': 'favourites'}])
+
+    def test_fields_apply_to_expanded_parent_only_at_top_level(self):
+        response = self.get(f'top-movie/{self.movie.id}/?expand=top_movies&fields=id,top_movies')
+        self.assertEqual(set(response.data), {'id', 'top_movies'})
+        self.assertIn('movie', response.data['top_movies'])
+
+    def test_fields_do_not_affect_validation(self):
+        response = self.client.post(
+            f'/{API_PATH}/top-movies/{self.top_movies.id}/add/?fields=id',
+            data=dict(TEST_MOVIES[0], tmdb_id='999'),
+        )
+        self.assertEqual(response.status_code, 201)
+
+class KeysetPaginationTest(TestCase):
+
+    client = APIClient
+
+    def walk(self, path, key='next'):
+        results = []
+        while path:
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            results.append(response.data['results'])
+            path = response.data[key]
+        return results
+
+    def test_top_movies_pages_cover_every_list_once(self):
+        ids = [TopMovies.objects.create().id for _ in range(25)]
+        pages = self.walk(f'/{API_PATH}/top-movies/?page_size=10&fields=id')
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual([top_movies['id'] for page in pages for top_movies in page], ids)
+
+    def test_previous_link_walks_back(self):
+        ids = [TopMovies.objects.create().id for _ in range(25)]
+        pages = self.walk(f'/{API_PATH}/top-movies/?page_size=10&fields=id')
+        response = self.client.get(f'/{API_PATH}/top-movies/?page_size=10&fields=id')
+        response = self.client.get(response.data['next'])
+        response = self.client.get(response.data['next'])
+        self.assertIsNone(response.data['next'])
+        back = self.walk(response.data['previous'], key='previous')
+        self.assertEqual([top_movies['id'] for top_movies in back[0]], ids[10:20])
+        self.assertEqual([top_movies['id'] for top_movies in back[1]], ids[:10])
+        self.assertEqual(len(back), 2)
+
+    def test_cursor_is_stable_when_rows_are_added(self):
+        ids = [TopMovies.objects.create().id for _ in range(10)]
+        response = self.client.get(f'/{API_PATH}/top-movies/?page_size=5&fields=id')
+        TopMovies.objects.filter(id=ids[0]).delete()
+        ids.append(TopMovies.objects.create().id)
+        response = self.client.get(response.data['next'])
+        self.assertEqual([top_movies['id'] for top_movies in response.data['results']], ids[5:10])
+
+    def test_movies_are_paginated_by_list_and_rank(self):
+        for rank_mode in [TopMovies.DENSE, TopMovies.SPARSE, TopMovies.DENSE]:
+            top_movies = TopMovies.objects.create(rank_mode=rank_mode)
+            Movie.objects.create_movies(top_movies, TEST_MOVIES)
+        pages = self.walk(f'/{API_PATH}/top-movie/?page_size=4')
+        self.assertEqual([len(page) for page in pages], [4, 4, 4, 3])
+        movies = [(movie['top_movies'], movie['rank']) for page in pages for movie in page]
+        lists = sorted(set(top_movies for top_movies, rank in movies))
+        self.assertEqual(movies, [(top_movies, rank) for top_movies in lists for rank in range(1, 6)])
+
+    def test_deep_pages_use_keyset_not_offset(self):
+        for _ in range(30):
+            TopMovies.objects.create()
+        response = self.client.get(f'/{API_PATH}/top-movies/?page_size=10&fields=id')
+        response = self.client.get(response.data['next'])
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(response.data['next'])
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertNotIn('OFFSET', context.captured_queries[0]['sql'])
+
+    def test_page_size_is_capped(self):
+        for _ in range(3):
+            TopMovies.objects.create()
+        response = self.client.get(f'/{API_PATH}/top-movies/?page_size=100000')
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_invalid_cursor_returns_404(self):
+        response = self.client.get(f'/{API_PATH}/top-movies/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_with_wrong_typed_values_returns_404(self):
+        for values in [['abc'], [None], [[1]], [{'id': 1}]]:
+            cursor = base64.urlsafe_b64encode(json.dumps({'r': 0, 'v': values}).encode()).decode()
+            with self.subTest(values=values):
+                response = self.client.get(f'/{API_PATH}/top-movies/?cursor={cursor}')
+                self.assertEqual(response.status_code, 404)
+                self.assertEqual(response.data['detail'], 'Invalid cursor')
+
+class PayloadCacheTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        cache.clear()
+        payload_cache.reset_stats()
+        self.top_movies = TopMovies.objects.create(title='favourites')
+        Movie.objects.create_movies(self.top_movies, TEST_MOVIES)
+        self.movies = list(self.top_movies.movie.all())
+
+    def get_top_movies(self, query=''):
+        return self.client.get(f'/{API_PATH}/top-movies/{self.top_movies.id}/{query}')
+
+    def assertInvalidated(self, mutate):
+        self.get_top_movies()
+        self.assertEqual(self.get_top_movies()['X-Cache'], 'HIT')
+        mutate()
+        response = self.get_top_movies()
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.top_movies.refresh_from_db()
+        expected = [movie.title for movie in self.top_movies.movie.all()]
+        self.assertEqual([movie['title'] for movie in json.loads(response.content)['movie']], expected)
+
+    def test_cached_payload_is_served_after_a_revision_lookup(self):
+        first = self.get_top_movies()
+        with self.assertNumQueries(1):
+            second = self.get_top_movies()
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['Content-Type'], first['Content-Type'])
+        self.assertEqual(payload_cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_query_parameters_are_cached_separately(self):
+        self.get_top_movies()
+        response = self.get_top_movies('?fields=id,title')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(response.content), {'id': self.top_movies.id, 'title': 'favourites'})
+
+    def test_media_types_are_cached_separately(self):
+        self.client.get(
+            f'/{API_PATH}/top-movies/{self.top_movies.id}/', HTTP_ACCEPT='application/json; indent=4',
+        )
+        response = self.get_top_movies()
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertNotIn(b'\n', response.content)
+
+    def test_write_missed_by_the_cache_is_not_served_stale(self):
+        # Another worker with its own cache made the change, so this
+        # worker's cache was never invalidated.
+        self.get_top_movies()
+        with mock.patch('api.cache.invalidate'):
+            TopMovies.objects.filter(pk=self.top_movies.pk).update(title='renamed')
+            notify_list_changed(self.top_movies.pk)
+        response = self.get_top_movies()
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(response.content)['title'], 'renamed')
+
+    def test_missing_list_is_not_cached(self):
+        response = self.client.get(f'/{API_PATH}/top-movies/999/')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(f'/{API_PATH}/top-movies/999/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_add_invalidates(self):
+        self.assertInvalidated(lambda: self.client.post(
+            f'/{API_PATH}/top-movies/{self.top_movies.id}/add/',
+            data=dict(TEST_MOVIES[0], tmdb_id='999', title='added'),
+        ))
+
+    def test_add_many_invalidates(self):
+        self.assertInvalidated(lambda: self.client.post(
+            f'/{API_PATH}/top-movies/{self.top_movies.id}/add-many/',
+            data=json.dumps([dict(TEST_MOVIES[0], tmdb_id='999', title='added')]),
+            content_type='application/json',
+        ))
+
+    def test_order_invalidates(self):
+        self.assertInvalidated(lambda: self.client.put(
+            f'/{API_PATH}/top-movies/{self.top_movies.id}/order/',
+            data=json.dumps({'order': [movie.id for movie in reversed(self.movies)]}),
+            content_type='application/json',
+        ))
+
+    def test_update_list_invalidates(self):
+        def mutate():
+            self.client.patch(
+                f'/{API_PATH}/top-movies/{self.top_movies.id}/',
+                data=json.dumps({'title': 'renamed', 'rank_mode': TopMovies.SPARSE}),
+                content_type='application/json',
+            )
+        self.assertInvalidated(mutate)
+        self.assertEqual(json.loads(self.get_top_movies().content)['title'], 'renamed')
+
+    def test_delete_list_invalidates(self):
+        self.get_top_movies()
+        self.client.delete(f'/{API_PATH}/top-movies/{self.top_movies.id}/')
+        self.assertEqual(self.get_top_movies().status_code, 404)
+
+    def test_rank_actions_invalidate(self):
+        for action in ['move-rank-up', 'move-rank-down', 'delete-rank']:
+            with self.subTest(action=action):
+                movie = self.top_movies.movie.all()[1]
+                self.assertInvalidated(lambda: self.client.put(
+                    f'/{API_PATH}/top-movie/{movie.id}/{action}/',
+                ))
+
+    def test_move_to_invalidates(self):
+        self.assertInvalidated(lambda: self.client.put(
+            f'/{API_PATH}/top-movie/{self.movies[4].id}/move-to/',
+            data=json.dumps({'rank': 1}),
+            content_type='application/json',
+        ))
+
+    def test_sparse_moves_invalidate(self):
+        self.top_movies.set_rank_mode(TopMovies.SPARSE)
+        self.assertInvalidated(lambda: self.movies[4].reorder_rank(1))
+        self.assertInvalidated(lambda: self.movies[4].delete_rank())
+
+    def test_movie_update_and_delete_invalidate(self):
+        self.assertInvalidated(lambda: self.client.patch(
+            f'/{API_PATH}/top-movie/{self.movies[0].id}/',
+            data=json.dumps(dict(TEST_MOVIES[0], tmdb_id='999', title='renamed')),
+            content_type='application/json',
+        ))
+        self.assertInvalidated(lambda: self.client.delete(
+            f'/{API_PATH}/top-movie/{self.movies[0].id}/',
+        ))
+
+    def test_evicted_version_does_not_serve_stale_payload(self):
+        self.get_top_movies()
+        cache.delete(payload_cache.version_key(self.top_movies.id))
+        self.assertEqual(self.get_top_movies()['X-Cache'], 'MISS')
+
+class ConditionalRequestTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        cache.clear()
+        self.top_movies = TopMovies.objects.create()
+        Movie.objects.create_movies(self.top_movies, TEST_MOVIES)
+        self.movies = list(self.top_movies.movie.all())
+        self.path = f'/{API_PATH}/top-movies/{self.top_movies.id}/'
+
+    def test_list_has_etag_and_last_modified(self):
+        response = self.client.get(self.path)
+        self.assertTrue(response['ETag'])
+        self.assertIn('Last-Modified', response)
+
+    def test_matching_etag_returns_304_without_serializing(self):
+        etag = self.client.get(self.path)['ETag']
+        cache.clear()
+        with self.assertNumQueries(1):
+            response = self.client.get(self.path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_matching_etag_on_cached_payload_returns_304(self):
+        etag = self.client.get(self.path)['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(self.path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_every_mutation_changes_etag(self):
+        etag = self.client.get(self.path)['ETag']
+        mutations = [
+            lambda: self.client.put(f'/{API_PATH}/top-movie/{self.movies[1].id}/move-rank-up/'),
+            lambda: self.client.post(f'{self.path}add/', data=dict(TEST_MOVIES[0], tmdb_id='999')),
+            lambda: self.client.patch(
+                self.path, data=json.dumps({'title': 'renamed'}), content_type='application/json',
+            ),
+            lambda: self.client.patch(
+                f'/{API_PATH}/top-movie/{self.movies[2].id}/',
+                data=json.dumps(dict(TEST_MOVIES[2], tmdb_id='998')), content_type='application/json',
+            ),
+            lambda: self.client.delete(f'/{API_PATH}/top-movie/{self.movies[0].id}/delete-rank/'),
+        ]
+        for mutate in mutations:
+            mutate()
+            response = self.client.get(self.path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            etag = response['ETag']
+
+    def test_movie_detail_supports_conditional_get(self):
+        path = f'/{API_PATH}/top-movie/{self.movies[0].id}/'
+        etag = self.client.get(path)['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.client.put(f'/{API_PATH}/top-movie/{self.movies[1].id}/move-rank-up/')
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['rank'], 2)
+
+    def test_stale_if_match_returns_412(self):
+        etag = self.client.get(self.path)['ETag']
+        self.client.put(f'/{API_PATH}/top-movie/{self.movies[1].id}/move-rank-up/')
+        for action in ['move-rank-up', 'move-rank-down', 'delete-rank']:
+            with self.subTest(action=action):
+                response = self.client.put(
+                    f'/{API_PATH}/top-movie/{self.movies[3].id}/{action}/',
+                    HTTP_IF_MATCH=etag,
+                )
+                self.assertEqual(response.status_code, 412)
+        response = self.client.put(
+            f'/{API_PATH}/top-movie/{self.movies[3].id}/move-to/',
+            data=json.dumps({'rank': 1}), content_type='application/json', HTTP_IF_MATCH=etag,
+        )
+        self.assertEqual(response.status_code, 412)
+        response = self.client.put(
+            f'{self.path}order/',
+            data=json.dumps({'order': [movie.id for movie in self.movies]}),
+            content_type='application/json', HTTP_IF_MATCH=etag,
+        )
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(self.top_movies.movie.get(id=self.movies[3].id).rank, 4)
+
+    def test_current_if_match_is_accepted_and_returns_new_etag(self):
+        etag = self.client.get(self.path)['ETag']
+        response = self.client.put(
+            f'/{API_PATH}/top-movie/{self.movies[1].id}/move-rank-up/',
+            HTTP_IF_MATCH=etag,
+        )
+        self.assertEqual(response.status_code, 200)
+        new_etag = response['ETag']
+        self.assertNotEqual(new_etag, etag)
+        response = self.client.put(
+            f'/{API_PATH}/top-movie/{self.movies[2].id}/move-rank-up/',
+            HTTP_IF_MATCH=new_etag,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(self.path)['ETag'], response['ETag'])
+
+    def test_stale_if_match_on_update_and_destroy_returns_412(self):
+        etag = self.client.get(self.path)['ETag']
+        self.client.put(f'/{API_PATH}/top-movie/{self.movies[1].id}/move-rank-up/')
+        requests = {
+            'rank-mode': lambda: self.client.patch(
+                self.path, data=json.dumps({'rank_mode': TopMovies.SPARSE}),
+                content_type='application/json', HTTP_IF_MATCH=etag,
+            ),
+            'movie-update': lambda: self.client.patch(
+                f'/{API_PATH}/top-movie/{self.movies[3].id}/',
+                data=json.dumps(dict(TEST_MOVIES[3], tmdb_id='999')),
+                content_type='application/json', HTTP_IF_MATCH=etag,
+            ),
+            'movie-delete': lambda: self.client.delete(
+                f'/{API_PATH}/top-movie/{self.movies[3].id}/', HTTP_IF_MATCH=etag,
+            ),
+            'list-delete': lambda: self.client.delete(self.path, HTTP_IF_MATCH=etag),
+        }
+        for name, request in requests.items():
+            with self.subTest(request=name):
+                self.assertEqual(request().status_code, 412)
+        self.top_movies.refresh_from_db()
+        self.assertEqual(self.top_movies.rank_mode, TopMovies.DENSE)
+        self.assertEqual(self.top_movies.movie.get(pk=self.movies[3].id).tmdb_id, TEST_MOVIES[3]['tmdb_id'])
+
+    def test_change_after_if_match_check_on_update_and_destroy_returns_412(self):
+        etag = self.client.get(self.path)['ETag']
+
+        def notify(top_movies_id, revision=None):
+            notify_list_changed(top_movies_id)
+            return notify_list_changed(top_movies_id, revision)
+
+        requests = {
+            'rank-mode': lambda: self.client.patch(
+                self.path, data=json.dumps({'rank_mode': TopMovies.SPARSE}),
+                content_type='application/json', HTTP_IF_MATCH=etag,
+            ),
+            'movie-delete': lambda: self.client.delete(
+                f'/{API_PATH}/top-movie/{self.movies[3].id}/', HTTP_IF_MATCH=etag,
+            ),
+        }
+        for name, request in requests.items():
+            with self.subTest(request=name):
+                with mock.patch('api.models.notify_list_changed', side_effect=notify):
+                    self.assertEqual(request().status_code, 412)
+                etag = self.client.get(self.path)['ETag']
+        self.top_movies.refresh_from_db()
+        self.assertEqual(self.top_movies.rank_mode, TopMovies.DENSE)
+        self.assertEqual(self.top_movies.movie.count(), len(TEST_MOVIES))
+
+    def test_change_after_if_match_check_returns_412(self):
+        etag = self.client.get(self.path)['ETag']
+
+        def notify(top_movies_id, revision=None):
+            # Another writer lands between the If-Match check and the write.
+            notify_list_changed(top_movies_id)
+            return notify_list_changed(top_movies_id, revision)
+
+        requests = {
+            'move-rank-up': lambda: self.client.put(
+                f'/{API_PATH}/top-movie/{self.movies[3].id}/move-rank-up/', HTTP_IF_MATCH=etag,
+            ),
+            'move-to': lambda: self.client.put(
+                f'/{API_PATH}/top-movie/{self.movies[3].id}/move-to/',
+                data=json.dumps({'rank': 1}), content_type='application/json', HTTP_IF_MATCH=etag,
+            ),
+            'delete-rank': lambda: self.client.put(
+                f'/{API_PATH}/top-movie/{self.movies[3].id}/delete-rank/', HTTP_IF_MATCH=etag,
+            ),
+            'order': lambda: self.client.put(
+                f'{self.path}order/',
+                data=json.dumps({'order': [movie.id for movie in reversed(self.movies)]}),
+                content_type='application/json', HTTP_IF_MATCH=etag,
+            ),
+        }
+        for name, request in requests.items():
+            with self.subTest(request=name):
+                with mock.patch('api.models.notify_list_changed', side_effect=notify) as claims:
+                    response = request()
+                self.assertEqual(response.status_code, 412)
+                self.assertEqual(claims.call_count, 1)
+                etag = self.client.get(self.path)['ETag']
+        self.assertEqual([movie.rank for movie in self.top_movies.movie.all()], [1, 2, 3, 4, 5])
+
+class FilmCatalogTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        cache.clear()
+        self.top_movies = TopMovies.objects.create()
+        self.other_top_movies = TopMovies.objects.create()
+        for top_movies in (self.top_movies, self.other_top_movies):
+            for movie in TEST_MOVIES:
+                self.client.post(f'/{API_PATH}/top-movies/{top_movies.id}/add/', data=movie)
+
+    def test_lists_share_films(self):
+        self.assertEqual(Film.objects.count(), len(TEST_MOVIES))
+        film = Film.objects.get(tmdb_id=TEST_MOVIES[0]['tmdb_id'])
+        self.assertEqual(
+            set(film.movie.values_list('top_movies', flat=True)),
+            {self.top_movies.id, self.other_top_movies.id},
+        )
+
+    def test_movie_keeps_wire_format(self):
+        movie = self.top_movies.movie.first()
+        response = self.client.get(f'/{API_PATH}/top-movie/{movie.id}/')
+        self.assertEqual(response.data, {
+            'id': movie.id,
+            'tmdb_id': TEST_MOVIES[0]['tmdb_id'],
+            'title': TEST_MOVIES[0]['title'],
+            'release_date': TEST_MOVIES[0]['release_date'],
+            'poster_path': TEST_MOVIES[0]['poster_path'],
+            'top_movies': self.top_movies.id,
+            'rank': 1,
+        })
+
+    def test_update_does_not_rewrite_shared_film(self):
+        movie = self.top_movies.movie.first()
+        for change in [{'title': 'renamed'}, {'tmdb_id': movie.tmdb_id, 'poster_path': ''}]:
+            with self.subTest(change=change):
+                response = self.client.patch(
+                    f'/{API_PATH}/top-movie/{movie.id}/',
+                    data=json.dumps(change),
+                    content_type='application/json',
+                )
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertEqual(list(response.data), [name for name in change if name != 'tmdb_id'])
+        film = Film.objects.get(pk=movie.film_id)
+        self.assertEqual((film.title, film.poster_path), (TEST_MOVIES[0]['title'], TEST_MOVIES[0]['poster_path']))
+
+    def test_update_accepts_unchanged_film_details(self):
+        movie = self.top_movies.movie.first()
+        response = self.client.put(
+            f'/{API_PATH}/top-movie/{movie.id}/',
+            data=json.dumps(TEST_MOVIES[0]),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_update_can_point_movie_at_another_film(self):
+        movie = self.top_movies.movie.first()
+        response = self.client.patch(
+            f'/{API_PATH}/top-movie/{movie.id}/',
+            data=json.dumps({'tmdb_id': '999', 'title': 'another film', 'release_date': '2001-01-01'}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.data['tmdb_id'], '999')
+        self.assertEqual(response.data['title'], 'another film')
+        self.assertEqual(Film.objects.count(), len(TEST_MOVIES) + 1)
+        other_movie = self.other_top_movies.movie.first()
+        self.assertEqual(other_movie.tmdb_id, TEST_MOVIES[0]['tmdb_id'])
+
+    def test_update_needs_details_of_a_film_not_in_the_catalog(self):
+        movie = self.top_movies.movie.first()
+        response = self.client.patch(
+            f'/{API_PATH}/top-movie/{movie.id}/',
+            data=json.dumps({'tmdb_id': '999'}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data), {'title', 'release_date'})
+        self.assertFalse(Film.objects.filter(tmdb_id='999').exists())
+
+    def test_update_points_movie_at_a_catalog_film_by_tmdb_id(self):
+        film = Film.objects.get_film('999', 'catalog film', '2001-01-01')
+        movie = self.top_movies.movie.first()
+        response = self.client.patch(
+            f'/{API_PATH}/top-movie/{movie.id}/',
+            data=json.dumps({'tmdb_id': '999', 'title': 'other title', 'release_date': '1999-01-01'}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['title'], response.data['release_date']), ('catalog film', '2001-01-01'))
+        self.assertEqual(self.top_movies.movie.get(pk=movie.pk).film_id, film.pk)
+
+    def test_update_cannot_point_movie_at_a_film_of_the_list(self):
+        movie, sibling = self.top_movies.movie.all()[:2]
+        scores = list(Film.objects.order_by('pk').values_list('score', 'list_count'))
+        response = self.client.patch(
+            f'/{API_PATH}/top-movie/{movie.id}/',
+            data=json.dumps({'tmdb_id': sibling.tmdb_id}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.top_movies.movie.get(pk=movie.pk).film_id, movie.film_id)
+        self.assertEqual(list(Film.objects.order_by('pk').values_list('score', 'list_count')), scores)
+
+    def test_list_holds_a_film_once(self):
+        movie = self.top_movies.movie.first()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Movie.objects.create(top_movies=self.top_movies, film=movie.film, rank=None, position=0)
+
+    def test_film_added_concurrently_returns_the_existing_movie(self):
+        movie = self.top_movies.movie.first()
+        with mock.patch.object(type(Movie.objects), '_create_movie', side_effect=IntegrityError):
+            self.assertEqual(Movie.objects.create_movie(**TEST_MOVIES[0], top_movies=self.top_movies), movie)
+        self.assertEqual(self.top_movies.movie.count(), len(TEST_MOVIES))
+
+class LeaderboardTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        self.top_movies = TopMovies.objects.create()
+        self.other_top_movies = TopMovies.objects.create(rank_mode=TopMovies.SPARSE)
+        Movie.objects.create_movies(self.top_movies, TEST_MOVIES)
+        Movie.objects.create_movies(self.other_top_movies, list(reversed(TEST_MOVIES[1:])))
+        run_commit_hooks()
+
+    def get_scores(self):
+        return dict(Film.objects.values_list('tmdb_id', 'score'))
+
+    def assertScoresMatchLists(self):
+        run_commit_hooks()
+        out = StringIO()
+        call_command('rebuild_leaderboard', '--check', stdout=out)
+        self.assertIn('none drifted', out.getvalue())
+
+    def test_adds_award_borda_points(self):
+        scores = self.get_scores()
+        self.assertEqual(scores[TEST_MOVIES[0]['tmdb_id']], 100)
+        self.assertEqual(scores[TEST_MOVIES[4]['tmdb_id']], 96 + 100)
+        self.assertEqual(Film.objects.get(tmdb_id=TEST_MOVIES[4]['tmdb_id']).list_count, 2)
+        self.assertScoresMatchLists()
+
+    def test_rank_edits_keep_scores_in_sync(self):
+        for top_movies in (self.top_movies, self.other_top_movies):
+            movies = list(top_movies.movie.all())
+            movies[3].reorder_rank(1)
+            movies[0].reorder_rank(4)
+            self.assertScoresMatchLists()
+            movies[1].delete_rank()
+            self.assertScoresMatchLists()
+        order = list(self.top_movies.movie.values_list('id', flat=True))
+        self.top_movies.set_order(list(reversed(order)))
+        self.assertScoresMatchLists()
+        self.other_top_movies.movie.first().set_film(Film.objects.get_film('999', 'new film', '2012-04-25'))
+        self.assertScoresMatchLists()
+        self.top_movies.delete()
+        self.assertScoresMatchLists()
+
+    def test_leaderboard_is_ordered_by_score(self):
+        response = self.client.get(f'/{API_PATH}/leaderboard/')
+        self.assertEqual(response.status_code, 200)
+        scores = [film['score'] for film in response.data['results']]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertEqual(scores[0], max(self.get_scores().values()))
+
+    def test_leaderboard_pages_cover_every_ranked_film_once(self):
+        Film.objects.get_film('999', 'unranked', '2012-04-25')
+        url = f'/{API_PATH}/leaderboard/?page_size=2'
+        pages = []
+        while url:
+            response = self.client.get(url)
+            pages.append([film['tmdb_id'] for film in response.data['results']])
+            url = response.data['next']
+        tmdb_ids = [tmdb_id for page in pages for tmdb_id in page]
+        self.assertEqual(sorted(tmdb_ids), sorted(movie['tmdb_id'] for movie in TEST_MOVIES))
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([film['tmdb_id'] for film in response.data['results']], pages[-2])
+
+    def test_rebuild_repairs_drifted_scores(self):
+        Film.objects.filter(tmdb_id=TEST_MOVIES[0]['tmdb_id']).update(score=7, list_count=3)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_leaderboard', '--check', stdout=StringIO())
+        out = StringIO()
+        call_command('rebuild_leaderboard', '--chunk-size', '2', stdout=out)
+        self.assertIn('corrected 1', out.getvalue())
+        self.assertScoresMatchLists()
+
+class ExportTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        self.top_movies = TopMovies.objects.create(title='favourites')
+        self.empty_top_movies = TopMovies.objects.create(title='empty')
+        self.sparse_top_movies = TopMovies.objects.create(rank_mode=TopMovies.SPARSE)
+        Movie.objects.create_movies(self.top_movies, TEST_MOVIES)
+        Movie.objects.create_movies(self.sparse_top_movies, TEST_MOVIES[:3])
+        self.sparse_top_movies.movie.last().reorder_rank(1)
+        self.client.force_login(get_user_model().objects.create_user('staff', password='secret', is_staff=True))
+
+    def export(self, **params):
+        response = self.client.get(f'/{API_PATH}/export/', params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_ndjson_has_one_line_per_list(self):
+        lists = [json.loads(line) for line in self.export().splitlines()]
+        self.assertEqual([top_movies['id'] for top_movies in lists], [
+            self.top_movies.id, self.empty_top_movies.id, self.sparse_top_movies.id,
+        ])
+        self.assertEqual(lists[0]['title'], 'favourites')
+        self.assertEqual([movie['title'] for movie in lists[0]['movie']], [movie['title'] for movie in TEST_MOVIES])
+        self.assertEqual(lists[0]['movie'][0], dict(TEST_MOVIES[0], rank=1))
+        self.assertEqual(lists[1]['movie'], [])
+        self.assertEqual([movie['rank'] for movie in lists[2]['movie']], [1, 2, 3])
+        self.assertEqual(lists[2]['movie'][0]['tmdb_id'], TEST_MOVIES[2]['tmdb_id'])
+
+    def test_csv_has_one_row_per_movie(self):
+        rows = list(csv.reader(StringIO(self.export(format='csv'))))
+        self.assertEqual(rows[0][:4], ['top_movies', 'top_movies_title', 'rank_mode', 'rank'])
+        self.assertEqual(len(rows), 1 + len(TEST_MOVIES) + 1 + 3)
+        self.assertEqual(rows[1][:5], [str(self.top_movies.id), 'favourites', 'dense', '1', TEST_MOVIES[0]['tmdb_id']])
+        self.assertEqual(rows[6][:4], [str(self.empty_top_movies.id), 'empty', 'dense', ''])
+
+    def test_export_can_be_sharded_by_id(self):
+        lists = [json.loads(line) for line in self.export(min_id=self.empty_top_movies.id).splitlines()]
+        self.assertEqual([top_movies['id'] for top_movies in lists], [self.empty_top_movies.id, self.sparse_top_movies.id])
+        lists = [json.loads(line) for line in self.export(max_id=self.top_movies.id).splitlines()]
+        self.assertEqual([top_movies['id'] for top_movies in lists], [self.top_movies.id])
+
+    def test_export_query_count_is_flat(self):
+        for i in range(20):
+            Movie.objects.create_movies(TopMovies.objects.create(), TEST_MOVIES)
+        response = self.client.get(f'/{API_PATH}/export/')
+        with self.assertNumQueries(2):
+            content = b''.join(response.streaming_content)
+        self.assertEqual(len(content.splitlines()), 23)
+
+    def test_only_admins_can_export(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(f'/{API_PATH}/export/').status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_login(get_user_model().objects.create_user('user', password='secret'))
+        self.assertEqual(self.client.get(f'/{API_PATH}/export/').status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_invalid_parameters_are_rejected(self):
+        self.assertEqual(self.client.get(f'/{API_PATH}/export/', {'format': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.get(f'/{API_PATH}/export/', {'min_id': 'a'}).status_code, 400)
+
+    def test_command_matches_endpoint(self):
+        out = StringIO()
+        call_command('export_lists', '--format', 'csv', '--chunk-size', '2', stdout=out)
+        self.assertEqual(out.getvalue(), self.export(format='csv'))
+
+class ImportListsTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as output:
+            output.write(content)
+        return path
+
+    def import_lists(self, *args):
+        out = StringIO()
+        call_command('import_lists', *args, stdout=out)
+        return out.getvalue()
+
+    def test_imports_movies_json_as_one_list(self):
+        out = self.import_lists('functional_tests/movies.json', '--title', 'imported')
+        top_movies = TopMovies.objects.get()
+        self.assertEqual(top_movies.title, 'imported')
+        self.assertEqual(top_movies.movie_count, len(TEST_MOVIES))
+        ranks = list(top_movies.movie.values_list('rank', 'film__tmdb_id'))
+        self.assertEqual(ranks, [(i + 1, movie['tmdb_id']) for i, movie in enumerate(TEST_MOVIES)])
+        self.assertIn('rows/s', out)
+
+    def test_imports_exported_ndjson(self):
+        top_movies = TopMovies.objects.create(title='favourites')
+        Movie.objects.create_movies(top_movies, TEST_MOVIES)
+        sparse_top_movies = TopMovies.objects.create(rank_mode=TopMovies.SPARSE)
+        Movie.objects.create_movies(sparse_top_movies, TEST_MOVIES[:2])
+        exported = StringIO()
+        call_command('export_lists', stdout=exported)
+        path = self.write('lists.ndjson', exported.getvalue())
+        self.import_lists(path, '--batch-size', '1')
+        lists = [json.loads(line) for line in exported.getvalue().splitlines()]
+        reimported = StringIO()
+        call_command('export_lists', '--min-id', str(sparse_top_movies.id + 1), stdout=reimported)
+        for top_movies in lists:
+            del top_movies['id']
+        self.assertEqual(
+            [{k: v for k, v in json.loads(line).items() if k != 'id'} for line in reimported.getvalue().splitlines()],
+            lists,
+        )
+        run_commit_hooks()
+        call_command('rebuild_leaderboard', '--check', stdout=StringIO())
+
+    def test_skips_duplicate_invalid_and_excess_movies(self):
+        movies = [dict(TEST_MOVIES[0], tmdb_id=str(i)) for i in range(MAX_MOVIES + 2)]
+        movies += [TEST_MOVIES[1], TEST_MOVIES[1], {'title': 'no tmdb id'}]
+        path = self.write('lists.json', json.dumps([{'title': 'big', 'movie': movies[:1] + movies}]))
+        out = self.import_lists(path)
+        self.assertEqual(TopMovies.objects.get().movie.count(), MAX_MOVIES)
+        self.assertIn('Skipped movies: 1 duplicate, 1 invalid, 4 over limit.', out)
+
+    def test_skips_movies_with_values_too_long_to_store(self):
+        movies = [
+            dict(TEST_MOVIES[0], tmdb_id='1' * 51),
+            dict(TEST_MOVIES[1], title='t' * 256),
+            dict(TEST_MOVIES[2], poster_path='/' + 'p' * 255),
+            dict(TEST_MOVIES[3], tmdb_id='4' * 50, title='t' * 255),
+        ]
+        path = self.write('lists.json', json.dumps([{'title': 'long', 'movie': movies}]))
+        out = self.import_lists(path)
+        self.assertEqual(list(Film.objects.values_list('tmdb_id', flat=True)), ['4' * 50])
+        self.assertIn('3 invalid', out)
+
+    def test_resumes_from_checkpoint(self):
+        lists = [{'title': f'list {i}', 'movie': TEST_MOVIES} for i in range(5)]
+        path = self.write('lists.ndjson', ''.join(json.dumps(top_movies) + '\n' for top_movies in lists))
+        checkpoint = os.path.join(self.directory.name, 'checkpoint.json')
+        with open(checkpoint, 'w') as output:
+            json.dump({'source': os.path.abspath(path), 'lists': 3}, output)
+        out = self.import_lists(path, '--checkpoint', checkpoint, '--batch-size', '1')
+        self.assertIn('Resuming after 3 lists.', out)
+        self.assertEqual(list(TopMovies.objects.values_list('title', flat=True)), ['list 3', 'list 4'])
+        with open(checkpoint) as checkpoint_file:
+            self.assertEqual(json.load(checkpoint_file)['lists'], 5)
+        self.import_lists(path, '--checkpoint', checkpoint)
+        self.assertEqual(TopMovies.objects.count(), 2)
+
+    def test_rejects_truncated_json(self):
+        path = self.write('lists.json', json.dumps(TEST_MOVIES)[:-20])
+        with self.assertRaises(CommandError):
+            self.import_lists(path)
+
+class BenchmarkTest(TestCase):
+
+    def benchmark(self, *args):
+        out = StringIO()
+        call_command('benchmark_api', '--lists', '3', '--requests', '5', '--films', '150', *args, stdout=out)
+        return json.loads(out.getvalue())
+
+    def test_reports_every_endpoint_without_errors(self):
+        report = self.benchmark('--list-size', '5')
+        self.assertEqual(report['meta']['vendor'], connection.vendor)
+        for name, result in report['endpoints'].items():
+            with self.subTest(endpoint=name):
+                self.assertEqual(result['requests'], 5)
+                self.assertEqual(result['errors'], 0)
+                self.assertLessEqual(result['latency_ms']['p50'], result['latency_ms']['p99'])
+        self.assertEqual(TopMovies.objects.count(), 0)
+        self.assertEqual(Film.objects.count(), 0)
+
+    def test_keep_data_keeps_the_lists(self):
+        self.benchmark('--list-size', '5', '--endpoint', 'new', '--keep-data')
+        self.assertEqual(TopMovies.objects.count(), 3 + 5)
+
+    def test_rank_queries_do_not_grow_with_list_size(self):
+        endpoints = ['--endpoint', 'move_rank_up', '--endpoint', 'move_rank_down', '--endpoint', 'delete_rank']
+        small = self.benchmark('--list-size', '5', *endpoints)['endpoints']
+        large = self.benchmark('--list-size', '80', *endpoints)['endpoints']
+        for name in small:
+            with self.subTest(endpoint=name):
+                self.assertEqual(small[name]['queries']['max'], large[name]['queries']['max'])
+
+class GenerateDataTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def generate(self, *args):
+        out = StringIO()
+        with self.settings(FIXTURE_DIRS=[self.directory.name]):
+            call_command('generate_data', '--lists', '40', '--films', '60', '--seed', '7', *args, stdout=out)
+        return out.getvalue()
+
+    def read_fixtures(self, name):
+        directory = os.path.join(self.directory.name, name)
+        contents = {}
+        for file_name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, file_name)) as fixture:
+                contents[file_name] = fixture.read()
+        return contents
+
+    def get_lists(self):
+        return [
+            (top_movies.title, [movie.tmdb_id for movie in top_movies.movie.all()])
+            for top_movies in TopMovies.objects.with_movies().order_by('id')
+        ]
+
+    def assertValidLists(self):
+        for top_movies in TopMovies.objects.all():
+            ranks = list(top_movies.movie.values_list('rank', flat=True))
+            self.assertEqual(top_movies.rank_mode, TopMovies.DENSE)
+            self.assertEqual(ranks, list(range(1, top_movies.movie_count + 1)))
+            self.assertLessEqual(top_movies.movie_count, MAX_MOVIES)
+        call_command('rebuild_leaderboard', '--check', stdout=StringIO())
+
+    def test_generates_dense_lists_with_skewed_popularity(self):
+        out = self.generate('--batch-size', '15')
+        self.assertIn('Generated 40 lists', out)
+        self.assertEqual(TopMovies.objects.count(), 40)
+        self.assertValidLists()
+        films = list(Film.objects.order_by('tmdb_id').values_list('list_count', flat=True))
+        self.assertEqual(len(films), 60)
+        self.assertGreater(sum(films[:6]), sum(films[-6:]))
+
+    def test_fixtures_do_not_depend_on_workers_or_batch_size(self):
+        self.generate('--fixture', 'first', '--lists-per-file', '15')
+        self.generate('--fixture', 'second', '--lists-per-file', '15', '--batch-size', '7', '--workers', '2')
+        first = self.read_fixtures('first')
+        self.assertEqual(sorted(first), ['films.json', 'lists_0001.json', 'lists_0002.json', 'lists_0003.json'])
+        self.assertEqual(first, self.read_fixtures('second'))
+        self.assertEqual(TopMovies.objects.count(), 0)
+
+    def test_fixtures_load_the_same_lists(self):
+        self.generate()
+        lists = self.get_lists()
+        TopMovies.objects.all().delete()
+        Film.objects.all().delete()
+        out = self.generate('--fixture', 'scale', '--lists-per-file', '25', '--compress')
+        labels = out.split('loaddata ')[1].split()
+        self.assertEqual(labels, ['scale/films', 'scale/lists_0001', 'scale/lists_0002'])
+        with self.settings(FIXTURE_DIRS=[self.directory.name]):
+            call_command('loaddata', *labels, verbosity=0)
+        self.assertEqual(self.get_lists(), lists)
+        self.assertValidLists()
+
+class ServerTimingTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        self.top_movies = TopMovies.objects.create()
+        self.movies = Movie.objects.create_movies(self.top_movies, TEST_MOVIES[:3])
+
+    def test_disabled_by_default(self):
+        response = self.client.get(f'/{API_PATH}/top-movies/{self.top_movies.id}/')
+        self.assertNotIn('Server-Timing', response)
+
+    def test_reports_stages_for_viewset_action(self):
+        movie_id = Movie.objects.get(top_movies=self.top_movies, rank=2).id
+        with self.settings(API_TIMING_SAMPLE_RATE=1), self.assertLogs('api.timing', 'INFO') as logs, \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.put(f'/{API_PATH}/top-movie/{movie_id}/move-rank-up/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        metrics = [metric.split(';')[0] for metric in response['Server-Timing'].split(', ')]
+        self.assertEqual(metrics, ['db', 'serialize', 'render', 'total'])
+        self.assertIn(f'desc="{len(queries)} queries"', response['Server-Timing'])
+        timing = logs.records[0].timing
+        self.assertEqual(timing['view'], 'MovieViewSet.move_rank_up')
+        self.assertEqual(timing['queries'], len(queries))
+        self.assertEqual(timing['status'], 200)
+        self.assertGreater(timing['serialize_ms'] + timing['render_ms'], 0)
+        self.assertIn('view=MovieViewSet.move_rank_up ', logs.output[0])
+
+    def test_names_function_views(self):
+        with self.settings(API_TIMING_SAMPLE_RATE=1), self.assertLogs('api.timing', 'INFO') as logs:
+            self.client.get(f'/{API_PATH}/')
+        self.assertEqual(logs.records[0].timing['view'], 'api_root')
+
+    def test_samples_requests(self):
+        with self.settings(API_TIMING_SAMPLE_RATE=0.5), mock.patch('api.timing.random.random', side_effect=[0.7, 0.2]):
+            skipped = self.client.get(f'/{API_PATH}/')
+            with self.assertLogs('api.timing', 'INFO') as logs:
+                sampled = self.client.get(f'/{API_PATH}/')
+        self.assertNotIn('Server-Timing', skipped)
+        self.assertIn('Server-Timing', sampled)
+        self.assertEqual(len(logs.records), 1)
+
+class MetricsTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        registry.reset()
+        payload_cache.reset_stats()
+        self.top_movies = TopMovies.objects.create()
+
+    def get_metrics(self, **extra):
+        response = self.client.get('/metrics', **extra)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode().splitlines()
+
+    def test_reports_requests_latency_queries_and_cache(self):
+        self.client.post(f'/{API_PATH}/top-movies/{self.top_movies.id}/add/', data=TEST_MOVIES[0])
+        self.client.get(f'/{API_PATH}/top-movies/{self.top_movies.id}/')
+        self.client.get(f'/{API_PATH}/top-movies/{self.top_movies.id}/')
+        self.client.get(f'/{API_PATH}/top-movies/0/')
+        lines = self.get_metrics()
+        self.assertIn('# TYPE api_request_duration_seconds histogram', lines)
+        self.assertIn('api_requests_total{view="TopMoviesViewSet.add",method="POST",status="201"} 1', lines)
+        self.assertIn('api_requests_total{view="TopMoviesViewSet.retrieve",method="GET",status="200"} 2', lines)
+        self.assertIn('api_requests_total{view="TopMoviesViewSet.retrieve",method="GET",status="404"} 1', lines)
+        self.assertIn('api_request_duration_seconds_count{view="TopMoviesViewSet.retrieve"} 3', lines)
+        self.assertIn('api_request_duration_seconds_bucket{view="TopMoviesViewSet.retrieve",le="+Inf"} 3', lines)
+        self.assertIn('api_request_queries_count{view="TopMoviesViewSet.add"} 1', lines)
+        self.assertIn('api_request_queries_bucket{view="TopMoviesViewSet.add",le="1"} 0', lines)
+        self.assertIn('api_payload_cache_requests_total{result="hit"} 1', lines)
+        # A missing list is answered before the cache is looked up.
+        self.assertIn('api_payload_cache_requests_total{result="miss"} 1', lines)
+
+    def test_aggregates_worker_processes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        def worker():
+            registry.record_request('MovieViewSet.delete_rank', 'PUT', 200, 0.02, 6)
+            registry.flush(force=True)
+
+        with self.settings(API_METRICS_DIR=directory.name):
+            self.client.put(f'/{API_PATH}/top-movie/0/delete-rank/')
+            for i in range(2):
+                process = multiprocessing.get_context('fork').Process(target=worker)
+                process.start()
+                process.join()
+                self.assertEqual(process.exitcode, 0)
+            lines = self.get_metrics()
+        self.assertEqual(len(os.listdir(directory.name)), 3)
+        self.assertIn('api_requests_total{view="MovieViewSet.delete_rank",method="PUT",status="200"} 2', lines)
+        self.assertIn('api_requests_total{view="MovieViewSet.delete_rank",method="PUT",status="404"} 1', lines)
+        self.assertIn('api_request_duration_seconds_count{view="MovieViewSet.delete_rank"} 3', lines)
+        self.assertIn('api_request_queries_bucket{view="MovieViewSet.delete_rank",le="5"} 1', lines)
+        self.assertIn('api_request_queries_bucket{view="MovieViewSet.delete_rank",le="10"} 3', lines)
+
+    def test_token_and_disabled(self):
+        with self.settings(API_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_403_FORBIDDEN)
+            self.get_metrics(HTTP_AUTHORIZATION='Bearer secret')
+        with self.settings(API_METRICS_ENABLED=False):
+            self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_404_NOT_FOUND)
+
+class SlowQueryTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        slow_query_log.clear()
+        self.addCleanup(slow_query_log.clear)
+        self.top_movies = TopMovies.objects.create()
+        Movie.objects.create_movies(self.top_movies, TEST_MOVIES[:3])
+        self.movie = Movie.objects.get(top_movies=self.top_movies, rank=3)
+
+    def test_fingerprint_ignores_values(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM t WHERE id IN (%s, %s,  %s) AND title = 'x' LIMIT 21"),
+            fingerprint('SELECT * FROM t WHERE id IN (%s) AND title = %s LIMIT 5'),
+        )
+        self.assertEqual(fingerprint('SELECT a FROM t WHERE id IN (%s, %s)'), 'SELECT a FROM t WHERE id IN (...)')
+
+    def test_records_slow_statements_with_plan(self):
+        with self.settings(API_SLOW_QUERY_MS=0), self.assertLogs('api.slow_queries', 'WARNING'):
+            response = self.client.put(f'/{API_PATH}/top-movie/{self.movie.id}/move-rank-up/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['rank'], 2)
+        entries = slow_query_log.entries()
+        self.assertEqual({entry['view'] for entry in entries}, {'MovieViewSet.move_rank_up'})
+        self.assertEqual([entry['sequence'] for entry in entries], sorted((e['sequence'] for e in entries), reverse=True))
+        update = next(entry for entry in entries if entry['sql'].startswith('UPDATE'))
+        self.assertTrue(update['explain'])
+        self.assertNotIn('EXPLAIN failed', update['explain'])
+        self.assertEqual(Movie.objects.get(pk=self.movie.pk).rank, 2)
+
+    def test_log_is_bounded(self):
+        with self.settings(API_SLOW_QUERY_MS=0, API_SLOW_QUERY_LOG_SIZE=3), self.assertLogs('api.slow_queries'):
+            self.client.get(f'/{API_PATH}/top-movies/{self.top_movies.id}/')
+            self.client.get(f'/{API_PATH}/top-movie/{self.movie.id}/')
+            entries = slow_query_log.entries()
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(entries[0]['view'], 'MovieViewSet.retrieve')
+
+    def test_disabled_by_default(self):
+        self.client.get(f'/{API_PATH}/top-movies/{self.top_movies.id}/')
+        self.assertEqual(slow_query_log.entries(), [])
+
+    def test_endpoint_and_command(self):
+        with self.settings(API_SLOW_QUERY_MS=0), self.assertLogs('api.slow_queries'):
+            self.client.get(f'/{API_PATH}/top-movie/{self.movie.id}/')
+        staff_client = APIClient()
+        self.assertEqual(staff_client.get(f'/{API_PATH}/slow-queries/').status_code, status.HTTP_403_FORBIDDEN)
+        staff_client.force_login(get_user_model().objects.create_user('staff', password='secret', is_staff=True))
+        response = staff_client.get(f'/{API_PATH}/slow-queries/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()[0]['view'], 'MovieViewSet.retrieve')
+        out = StringIO()
+        call_command('slow_queries', '--limit', '1', stdout=out)
+        self.assertIn('MovieViewSet.retrieve', out.getvalue())
+        self.assertEqual(len(json.loads(self.call_json())), len(response.json()))
+        self.assertEqual(staff_client.delete(f'/{API_PATH}/slow-queries/').status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(slow_query_log.entries(), [])
+
+    def call_json(self):
+        out = StringIO()
+        call_command('slow_queries', '--json', stdout=out)
+        return out.getvalue()
+
+class JSONBackendTest(TestCase):
+
+    client = APIClient
+
+    payload = {
+        'date': datetime.date(1994, 9, 23),
+        'naive': datetime.datetime(2020, 1, 2, 3, 4, 5, 678901),
+        'utc': datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+        'offset': datetime.datetime(2020, 1, 2, 3, 4, tzinfo=datetime.timezone(datetime.timedelta(hours=2))),
+        'time': datetime.time(12, 30),
+        'uuid': uuid.UUID(int=1),
+        'lazy': gettext_lazy('Not found.'),
+        'text': 'Amélie \u2028 \u2029 "quoted" \\ \x1f',
+        'numbers': [0, -1, 2 ** 70, 1.5, True, None],
+        'nested': ({1: 'one'}, []),
+    }
+
+    def test_backends_are_byte_identical(self):
+        expected = renderers.JSONRenderer().render(self.payload)
+        for name, backend in BACKENDS.items():
+            with self.subTest(backend=name):
+                self.assertEqual(backend.dumps(self.payload), expected)
+                self.assertEqual(backend.dumps({'price': decimal.Decimal('1.10')}), b'{"price":"1.10"}')
+                self.assertEqual(backend.loads(expected)['numbers'][2], 2 ** 70)
+                with self.assertRaises(ValueError):
+                    backend.loads(b'{"score": NaN}')
+
+    @unittest.skipUnless('orjson' in BACKENDS, 'orjson is not installed')
+    def test_orjson_is_the_default(self):
+        self.assertEqual(JSONRenderer().render(self.payload), BACKENDS['orjson'].dumps(self.payload))
+
+    def test_responses_match_across_backends(self):
+        top_movies = TopMovies.objects.create()
+        Movie.objects.create_movies(top_movies, TEST_MOVIES)
+        contents = set()
+        for name in BACKENDS:
+            cache.clear()
+            with self.settings(API_JSON_BACKEND=name):
+                response = self.client.get(f'/{API_PATH}/top-movies/{top_movies.id}/')
+                self.assertEqual(response['X-Cache'], 'MISS')
+                contents.add(response.content)
+        self.assertEqual(len(contents), 1)
+        self.assertEqual(json.loads(contents.pop())['movie'][0]['release_date'], TEST_MOVIES[0]['release_date'])
+
+    def test_indented_output_is_left_to_drf(self):
+        response = self.client.get(f'/{API_PATH}/', HTTP_ACCEPT='application/json; indent=2')
+        self.assertEqual(response.content, b'{\n  "message": "Welcome to My Top 100 Movies."\n}')
+
+    def test_parses_request_bodies(self):
+        top_movies = TopMovies.objects.create()
+        for name in BACKENDS:
+            with self.settings(API_JSON_BACKEND=name):
+                response = self.client.post(
+                    f'/{API_PATH}/top-movies/{top_movies.id}/add/',
+                    data=json.dumps({**TEST_MOVIES[0], 'tmdb_id': f'parser-{name}', 'title': f'Amélie {name}'}),
+                    content_type='application/json',
+                )
+                self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+                self.assertEqual(response.data['title'], f'Amélie {name}')
+                response = self.client.post(
+                    f'/{API_PATH}/top-movies/{top_movies.id}/add/', data='{"title": ', content_type='application/json',
+                )
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn('JSON parse error', response.data['detail'])
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_renderers', '--movies', '5', '--iterations', '3', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(set(report['backends']), {'drf'} | set(BACKENDS))
+        for result in report['backends'].values():
+            self.assertTrue(result['identical_to_drf'])
+        self.assertEqual(TopMovies.objects.count(), 0)
+
+class AsyncViewTest(TestCase):
+
+    client = APIClient
+
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+        self.top_movies = TopMovies.objects.create(title='Async')
+        Movie.objects.create_movies(self.top_movies, TEST_MOVIES[:3])
+        self.movie_ids = list(self.top_movies.movie.order_by('rank').values_list('id', flat=True))
+        # The test transaction is only visible from this thread.
+        self.settings_override = self.settings(API_ASYNC_THREADS=0)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    async def test_serves_hot_reads_as_async_views(self):
+        client = AsyncClient()
+        paths = [
+            f'/{API_PATH}/',
+            f'/{API_PATH}/top-movies/{self.top_movies.id}/',
+            f'/{API_PATH}/top-movie/{self.movie_ids[0]}/',
+            f'/{API_PATH}/top-movie/0/',
+        ]
+        for path in paths:
+            with self.subTest(path=path):
+                response = await client.get(path)
+                expected = await sync_to_async(self.client.get)(path)
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(response.content, expected.content)
+                self.assertTrue(asyncio.iscoroutinefunction(response.asgi_request.resolver_match.func))
+
+    async def test_other_routes_resolve_as_before(self):
+        client = AsyncClient()
+        response = await client.get(f'/{API_PATH}/top-movies/new/')
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        response = await client.get(f'/{API_PATH}/top-movies/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(asyncio.iscoroutinefunction(response.asgi_request.resolver_match.func))
+        response = await client.put(f'/{API_PATH}/top-movie/{self.movie_ids[1]}/move-rank-up/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['rank'], 1)
+
+    async def test_detail_routes_accept_writes(self):
+        client = AsyncClient()
+        response = await client.delete(f'/{API_PATH}/top-movie/{self.movie_ids[0]}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        response = await client.get(f'/{API_PATH}/top-movies/{self.top_movies.id}/')
+        self.assertEqual([movie['id'] for movie in response.json()['movie']], self.movie_ids[1:])
+
+    async def test_middleware_sees_queries_and_view_names(self):
+        with self.settings(API_TIMING_SAMPLE_RATE=1), self.assertLogs('api.timing', 'INFO') as logs:
+            response = await AsyncClient().get(f'/{API_PATH}/top-movies/{self.top_movies.id}/')
+        timing = logs.records[0].timing
+        self.assertEqual(timing['view'], 'TopMoviesViewSet.retrieve')
+        self.assertGreater(timing['queries'], 0)
+        self.assertIn(f'desc="{timing["queries"]} queries"', response['Server-Timing'])
+        response = await AsyncClient().get('/metrics')
+        lines = response.content.decode().splitlines()
+        self.assertIn('api_requests_total{view="TopMoviesViewSet.retrieve",method="GET",status="200"} 1', lines)
+
+    def test_sync_requests_keep_sync_views(self):
+        response = self.client.get(f'/{API_PATH}/top-movies/{self.top_movies.id}/')
+        self.assertFalse(asyncio.iscoroutinefunction(response.resolver_match.func))
+
+class AsyncBenchmarkTest(TransactionTestCase):
+
+    def test_serves_concurrent_requests_on_the_pool(self):
+        out = StringIO()
+        call_command(
+            'benchmark_asgi', '--lists', '2', '--list-size', '5', '--requests', '12', '--concurrency', '4',
+            '--db-latency-ms', '1', stdout=out,
+        )
+        servers = json.loads(out.getvalue())['servers']
+        for name, result in servers.items():
+            with self.subTest(server=name):
+                self.assertEqual(result['requests'], 12)
+                self.assertEqual(result['errors'], 0)
+        self.assertEqual(servers['wsgi']['concurrency'], 1)
+        self.assertGreater(servers['asgi']['concurrency'], 1)
+        self.assertEqual(TopMovies.objects.count(), 0)
+        self.assertEqual(Film.objects.count(), 0)
+
+class EventBackendTest(TestCase):
+
+    def setUp(self):
+        self.backend = LocalBackend()
+
+    async def next_event(self, subscription):
+        return await asyncio.wait_for(subscription.get(), 1)
+
+    async def test_delivers_events_of_the_list(self):
+        with self.backend.subscribe(1) as subscription:
+            self.backend.publish(2, 'add', {'id': 9})
+            moved = self.backend.publish(1, 'move', {'id': 3, 'from': 2, 'to': 1})
+            deleted = self.backend.publish(1, 'delete', {'id': 3, 'rank': 1})
+            self.assertEqual(self.backend.subscriber_count(1), 1)
+            self.assertEqual(await self.next_event(subscription), moved)
+            self.assertEqual(await self.next_event(subscription), deleted)
+        self.assertEqual(self.backend.subscriber_count(1), 0)
+
+    async def test_resumes_after_last_event_id(self):
+        events = [self.backend.publish(1, 'delete', {'id': i, 'rank': 1}) for i in range(3)]
+        self.backend.publish(2, 'delete', {'id': 9, 'rank': 1})
+        with self.backend.subscribe(1, events[0].id) as subscription:
+            self.assertEqual(await self.next_event(subscription), events[1])
+            self.assertEqual(await self.next_event(subscription), events[2])
+
+    async def test_resets_when_events_are_gone(self):
+        with self.settings(API_EVENTS_HISTORY=2):
+            backend = LocalBackend()
+            events = [backend.publish(1, 'delete', {'id': i, 'rank': 1}) for i in range(4)]
+        for last_event_id in [events[0].id, f'{LocalBackend().epoch}-4', 'garbage']:
+            with self.subTest(last_event_id=last_event_id), backend.subscribe(1, last_event_id) as subscription:
+                event = await self.next_event(subscription)
+                self.assertEqual((event.id, event.type, event.data), (events[-1].id, 'reset', {'top_movies': 1}))
+        with backend.subscribe(1, events[1].id) as subscription:
+            self.assertEqual(await self.next_event(subscription), events[2])
+
+    async def test_resets_slow_subscribers(self):
+        with self.backend.subscribe(1) as subscription:
+            events = [self.backend.publish(1, 'delete', {'id': i, 'rank': 1}) for i in range(QUEUE_SIZE + 1)]
+            await asyncio.sleep(0)
+            event = await self.next_event(subscription)
+            self.assertEqual((event.id, event.type), (events[-1].id, 'reset'))
+            later = self.backend.publish(1, 'delete', {'id': 0, 'rank': 1})
+            self.assertEqual(await self.next_event(subscription), later)
+
+    def test_refuses_several_workers(self):
+        with mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '2'}):
+            with self.assertRaises(ImproperlyConfigured):
+                LocalBackend()
+            PostgresBackend()
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'LISTEN/NOTIFY needs PostgreSQL')
+class PostgresEventBackendTest(TransactionTestCase):
+
+    async def test_delivers_events_published_on_another_connection(self):
+        backend = PostgresBackend()
+        data = {'id': 3, 'from': 2, 'to': 1}
+
+        async def published():
+            # Notifies sent before the listener is connected are lost.
+            while True:
+                await sync_to_async(backend.publish)(1, 'move', data)
+                try:
+                    return await asyncio.wait_for(subscription.get(), 0.1)
+                except asyncio.TimeoutError:
+                    pass
+
+        with backend.subscribe(2) as other, backend.subscribe(1) as subscription:
+            event = await asyncio.wait_for(published(), 5)
+            self.assertEqual((event.type, event.data), ('move', data))
+            self.assertTrue(other.queue.empty())
+
+# The stream tests read the ids of the events they publish, which only the
+# local backend returns.
+@override_settings(API_EVENTS_BACKEND='api.events.LocalBackend')
+class ListEventStreamTest(TransactionTestCase):
+
+    def setUp(self):
+        self.top_movies = TopMovies.objects.create()
+        Movie.objects.create_movies(self.top_movies, TEST_MOVIES[:3])
+        self.movies = list(self.top_movies.movie.order_by('rank'))
+        self.path = f'/{API_PATH}/top-movies/{self.top_movies.id}/events/'
+
+    async def open_stream(self):
+        response = await AsyncClient().get(self.path)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        return response.events
+
+    async def read(self, stream):
+        chunk = await asyncio.wait_for(stream.__anext__(), 5)
+        fields = dict(line.split(': ', 1) for line in chunk.decode().splitlines() if line)
+        return fields['event'], json.loads(fields['data'])
+
+    async def subscribed(self, count=1):
+        while get_events_backend().subscriber_count(self.top_movies.id) != count:
+            await asyncio.sleep(0.01)
+
+    async def test_streams_committed_rank_changes(self):
+        stream = await self.open_stream()
+        moved = asyncio.ensure_future(self.read(stream))
+        await asyncio.wait_for(self.subscribed(), 5)
+
+        def rolled_back_move():
+            with transaction.atomic():
+                self.movies[1].reorder_rank(1)
+                transaction.set_rollback(True)
+
+        await sync_to_async(rolled_back_move)()
+        await sync_to_async(self.movies[2].reorder_rank)(1)
+        self.assertEqual(await moved, ('move', {'id': self.movies[2].id, 'from': 3, 'to': 1}))
+        movie_id = self.movies[0].id
+        await sync_to_async(self.movies[0].delete_rank)()
+        self.assertEqual(await self.read(stream), ('delete', {'id': movie_id, 'rank': 2}))
+        movie = await sync_to_async(Movie.objects.create_movie)(**TEST_MOVIES[3], top_movies=self.top_movies)
+        self.assertEqual(await self.read(stream), ('add', {
+            'id': movie.id,
+            'rank': 3,
+            'tmdb_id': TEST_MOVIES[3]['tmdb_id'],
+            'title': TEST_MOVIES[3]['title'],
+            'release_date': TEST_MOVIES[3]['release_date'],
+            'poster_path': TEST_MOVIES[3]['poster_path'],
+        }))
+        await stream.aclose()
+        self.assertEqual(get_events_backend().subscriber_count(self.top_movies.id), 0)
+
+    async def test_streams_reset_for_bulk_changes(self):
+        stream = await self.open_stream()
+        reset = ('reset', {'top_movies': self.top_movies.id})
+        changes = {
+            'order': lambda: self.client.put(
+                f'/{API_PATH}/top-movies/{self.top_movies.id}/order/',
+                data=json.dumps({'order': [movie.id for movie in reversed(self.movies)]}),
+                content_type='application/json',
+            ),
+            'add-many': lambda: self.client.post(
+                f'/{API_PATH}/top-movies/{self.top_movies.id}/add-many/',
+                data=json.dumps(TEST_MOVIES[3:]), content_type='application/json',
+            ),
+            'rank-mode': lambda: self.client.patch(
+                f'/{API_PATH}/top-movies/{self.top_movies.id}/',
+                data=json.dumps({'rank_mode': TopMovies.SPARSE}), content_type='application/json',
+            ),
+            'delete': lambda: self.client.delete(f'/{API_PATH}/top-movies/{self.top_movies.id}/'),
+        }
+        for name, change in changes.items():
+            with self.subTest(change=name):
+                event = asyncio.ensure_future(self.read(stream))
+                await asyncio.wait_for(self.subscribed(), 5)
+                response = await sync_to_async(change)()
+                self.assertLess(response.status_code, 300)
+                self.assertEqual(await event, reset)
+        await stream.aclose()
+
+    async def test_sends_heartbeats(self):
+        with self.settings(API_EVENTS_HEARTBEAT=0.01):
+            stream = await self.open_stream()
+            self.assertEqual(await asyncio.wait_for(stream.__anext__(), 5), b': heartbeat\n\n')
+            await stream.aclose()
+
+    async def test_unknown_list_and_wsgi(self):
+        response = await AsyncClient().get(f'/{API_PATH}/top-movies/0/events/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = await sync_to_async(self.client.get)(self.path)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_asgi_handler_resumes_and_stops_on_disconnect(self):
+        first = publish(self.top_movies.id, 'delete', {'id': self.movies[2].id, 'rank': 3})
+        second = publish(self.top_movies.id, 'delete', {'id': self.movies[1].id, 'rank': 2})
+        disconnected = asyncio.Event()
+        messages = []
+
+        async def receive():
+            if not messages:
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+            if message.get('more_body'):
+                disconnected.set()
+
+        await asyncio.wait_for(ASGIHandler()({
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': self.path,
+            'raw_path': self.path.encode(),
+            'query_string': b'',
+            'root_path': '',
+            'headers': [(b'host', b'testserver'), (b'last-event-id', first.id.encode())],
+            'client': ('127.0.0.1', 0),
+            'server': ('testserver', 80),
+        }, receive, send), 5)
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertIn((b'Content-Type', b'text/event-stream'), messages[0]['headers'])
+        self.assertEqual(messages[1]['body'], (
+            f'id: {second.id}\nevent: delete\ndata: {{"id":{self.movies[1].id},"rank":2}}\n\n'
+        ).encode())
+        self.assertEqual(messages[-1], {'type': 'http.response.body'})
+        self.assertEqual(get_events_backend().subscriber_count(self.top_movies.id), 0)
+
+class MovieIndexTest(TestCase):
+
+    def setUp(self):
+        self.top_movies = TopMovies.objects.create()
+        Movie.objects.create_movies(self.top_movies, TEST_MOVIES)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index_name):
+        self.assertIn(index_name, queryset.explain())
+
+    def test_rank_range_uses_list_rank_index(self):
+        movies = Movie.objects.filter(top_movies=self.top_movies, rank__gte=2, rank__lte=4)
+        self.assertUsesIndex(movies, 'movie_list_rank_uniq')
+
+    def test_related_movies_use_list_position_index(self):
+        self.assertUsesIndex(self.top_movies.movie.all(), 'movie_list_position_idx')
+
+    def test_film_rankings_use_film_index(self):
+        film = Film.objects.get(tmdb_id=TEST_MOVIES[0]['tmdb_id'])
+        self.assertUsesIndex(film.movie.all(), 'api_movie_film_id')
+
+    def test_duplicate_rank_is_rejected(self):
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                if connection.vendor == 'postgresql':
+                    with connection.cursor() as cursor:
+                        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+                Movie.objects.create(
+                    film=Film.objects.get_film('999', 'duplicate', '2012-04-25'),
+                    top_movies=self.top_movies,
+                    rank=1,
+                    position=1,
+                )
+
+    def test_rank_moves_keep_ranks_unique(self):
+        movies = list(self.top_movies.movie.all())
+        movies[4].reorder_rank(1)
+        movies[0].reorder_rank(5)
+        movies[2].delete_rank()
+        self.top_movies.set_order(list(reversed(self.top_movies.movie.values_list('id', flat=True))))
+        ranks = list(self.top_movies.movie.values_list('rank', 'position'))
+        self.assertEqual(ranks, [(1, 1), (2, 2), (3, 3), (4, 4)])
+
+
+class ConcurrentRankEditTest(TransactionTestCase):
+
+    THREADS = 8
+    EDITS = 25
+    SIZE = 30
+
+    def setUp(self):
+        # The settings give SQLite a test database file; this only skips
+        # when they were overridden with an in-memory one.
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('threads need a file-backed test database')
+
+    def create_top_movies(self, rank_mode):
+        top_movies = TopMovies.objects.create(rank_mode=rank_mode)
+        for i in range(self.SIZE):
+            Movie.objects.create_movie(
+                tmdb_id=str(i),
+                title=f'movie {i}',
+                release_date='2012-04-25',
+                poster_path='',
+                top_movies=top_movies,
+            )
+        return top_movies
+
+    def run_workers(self, top_movies):
+        ids = list(top_movies.movie.values_list('id', flat=True))
+        errors = []
+
+        def work(seed):
+            rng = random.Random(seed)
+            try:
+                for _ in range(self.EDITS):
+                    try:
+                        movie = Movie.objects.get(pk=rng.choice(ids))
+                        if rng.random() < 0.1:
+                            movie.delete_rank()
+                        else:
+                            movie.reorder_rank(rng.randint(1, self.SIZE))
+                    except (ConcurrentUpdate, Movie.DoesNotExist):
+                        pass
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=work, args=(seed,)) for seed in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def assertRanksArePermutation(self, top_movies):
+        top_movies.refresh_from_db()
+        movies = Movie.objects.with_list_rank(top_movies.movie.all())
+        ranks = [movie.get_rank() for movie in movies]
+        self.assertEqual(ranks, list(range(1, top_movies.movie_count + 1)))
+        self.assertGreater(top_movies.revision, 0)
+
+    def test_concurrent_dense_edits_keep_ranks_dense(self):
+        top_movies = self.create_top_movies(TopMovies.DENSE)
+        self.run_workers(top_movies)
+        self.assertRanksArePermutation(top_movies)
+        positions = list(top_movies.movie.values_list('position', flat=True))
+        self.assertEqual(positions, list(range(1, len(positions) + 1)))
+        call_command('rebuild_leaderboard', '--check', stdout=StringIO())
+
+    def test_concurrent_sparse_edits_keep_positions_unique(self):
+        top_movies = self.create_top_movies(TopMovies.SPARSE)
+        self.run_workers(top_movies)
+        self.assertRanksArePermutation(top_movies)
+        positions = list(top_movies.movie.values_list('position', flat=True))
+        self.assertEqual(len(set(positions)), len(positions))
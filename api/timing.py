@@ -0,0 +1,146 @@
+import asyncio
+import contextvars
+import logging
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger('api.timing')
+
+STAGES = ['db', 'serialize', 'render']
+
+current_timings = contextvars.ContextVar('current_timings', default=None)
+query_wrappers = contextvars.ContextVar('query_wrappers', default=())
+
+
+def get_view_name(request):
+    # Viewsets are named after their action, e.g. MovieViewSet.move_rank_up.
+    if getattr(request, 'resolver_match', None) is None:
+        return 'unknown'
+    view_func = request.resolver_match.func
+    name = getattr(view_func, '__name__', type(view_func).__name__)
+    actions = getattr(view_func, 'actions', None)
+    if actions:
+        action = actions.get(request.method.lower())
+        if action is None:
+            return name
+        return f'{name}.{action}'
+    return name
+
+
+class RequestTimings:
+
+    def __init__(self):
+        self.queries = 0
+        self.durations = defaultdict(float)
+        self.active = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.durations['db'] += time.perf_counter() - start
+            self.queries += 1
+
+    def as_dict(self):
+        data = {'queries': self.queries}
+        for stage in STAGES + ['total']:
+            data[f'{stage}_ms'] = round(self.durations[stage] * 1000, 2)
+        return data
+
+    def server_timing(self):
+        metrics = [f'db;dur={self.durations["db"] * 1000:.2f};desc="{self.queries} queries"']
+        metrics += [f'{stage};dur={self.durations[stage] * 1000:.2f}' for stage in STAGES[1:] + ['total']]
+        return ', '.join(metrics)
+
+
+@contextmanager
+def wrap_queries(wrapper):
+    # The wrapper is also remembered for queries the request runs in other
+    # threads, see api.async_views.run_sync.
+    token = query_wrappers.set(query_wrappers.get() + (wrapper,))
+    try:
+        with connection.execute_wrapper(wrapper):
+            yield
+    finally:
+        query_wrappers.reset(token)
+
+
+@contextmanager
+def measure(stage):
+    # Only the outermost call of a stage counts, so nested serializers are
+    # not added up twice.
+    timings = current_timings.get()
+    if timings is None or stage in timings.active:
+        yield
+        return
+    timings.active.add(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.durations[stage] += time.perf_counter() - start
+        timings.active.discard(stage)
+
+
+class AsyncCapableMiddleware:
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Lets Django call this middleware without a thread hop.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+
+class ServerTimingMiddleware(AsyncCapableMiddleware):
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.sample_rate = getattr(settings, 'API_TIMING_SAMPLE_RATE', 0)
+        if not self.sample_rate:
+            raise MiddlewareNotUsed
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+        timings = RequestTimings()
+        with self.timing(timings):
+            response = self.get_response(request)
+        return self.report(request, response, timings)
+
+    async def __acall__(self, request):
+        if random.random() >= self.sample_rate:
+            return await self.get_response(request)
+        timings = RequestTimings()
+        with self.timing(timings):
+            response = await self.get_response(request)
+        return self.report(request, response, timings)
+
+    @contextmanager
+    def timing(self, timings):
+        token = current_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            with wrap_queries(timings):
+                yield
+        finally:
+            timings.durations['total'] = time.perf_counter() - start
+            current_timings.reset(token)
+
+    def report(self, request, response, timings):
+        response['Server-Timing'] = timings.server_timing()
+        data = {'view': get_view_name(request), **timings.as_dict()}
+        data.update(method=request.method, path=request.path, status=response.status_code)
+        logger.info(' '.join(f'{key}={value}' for key, value in data.items()), extra={'timing': data})
+        return response
@@ -3,7 +3,7 @@ from rest_framework import routers
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
-from .views import TopMoviesViewSet, MovieViewSet
+from .views import TopMoviesViewSet, MovieViewSet, LeaderboardViewSet, export, slow_queries
 
 @api_view(['GET'])
 def api_root(request):
@@ -15,10 +15,13 @@ def api_root(request):
 urlpatterns = [
     path('', api_root),
     path('auth/', include('rest_framework.urls')),
+    path('export/', export),
+    path('slow-queries/', slow_queries),
 ]
 
 router = routers.SimpleRouter()
 router.register('top-movies', TopMoviesViewSet, basename="TopMovies")
 router.register('top-movie', MovieViewSet, basename="Movie")
+router.register('leaderboard', LeaderboardViewSet, basename="Leaderboard")
 
 urlpatterns += router.urls
\ No newline at end of file
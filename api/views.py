@@ -1,21 +1,183 @@
+from urllib.parse import quote, urlencode
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, StreamingHttpResponse
 from django.shortcuts import render
-from rest_framework import status, viewsets
-from rest_framework.decorators import action
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import require_GET
+from rest_framework import mixins, status, viewsets
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.exceptions import APIException
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 
-from .models import TopMovies, Movie
-from .serializers import TopMoviesSerializer, MovieSerializer
+from .cache import payload_cache
+from .export import EXPORT_FORMATS, export_lists
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, registry
+from .models import ConcurrentUpdate, StaleRevision, Film, TopMovies, Movie, claim_revision
+from .slow_queries import slow_query_log
+from .serializers import (
+    TopMoviesSerializer, MovieSerializer, MovieOrderSerializer, MoveToSerializer, LeaderboardSerializer,
+    get_query_list,
+)
+
+class Conflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The list was changed concurrently, please retry.'
+    default_code = 'conflict'
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'The list was changed since the revision in If-Match.'
+    default_code = 'precondition_failed'
+
 
 # Create your views here.
-class TopMoviesViewSet(viewsets.ModelViewSet):
+class RevisionMixin:
+
+    etag = None
+    last_modified = None
+    revision = None
+    expected_revision = None
+
+    def load_revision(self, top_movies_id=None):
+        try:
+            if top_movies_id is None:
+                top_movies_id, revision, updated_at = self.get_revision()
+            else:
+                revision, updated_at = TopMovies.objects.get_revision(top_movies_id)
+        except (ObjectDoesNotExist, TypeError, ValueError):
+            self.etag = self.last_modified = self.revision = None
+            return False
+        self.revision = revision
+        self.etag = quote_etag(f'{top_movies_id}-{revision}')
+        self.last_modified = int(updated_at.timestamp())
+        return True
+
+    def check_revision(self, request):
+        if not self.load_revision():
+            return None
+        response = get_conditional_response(
+            request, etag=self.etag, last_modified=self.last_modified
+        )
+        if response is not None:
+            self.add_revision_headers(response)
+        elif request.headers.get('If-Match', '*').strip() != '*':
+            # The write claims this revision, so a change landing after the
+            # check above still fails the precondition.
+            self.expected_revision = self.revision
+        return response
+
+    def claim_revision(self, top_movies_id):
+        # Holds the If-Match revision until the surrounding transaction ends.
+        if self.expected_revision is not None:
+            claim_revision(top_movies_id, self.expected_revision)
+
+    def update(self, request, *args, **kwargs):
+        response = self.check_revision(request)
+        if response is not None:
+            return response
+        return super().update(request, *args, **kwargs)
+
+    def destroy(self, request, *args, **kwargs):
+        response = self.check_revision(request)
+        if response is not None:
+            return response
+        return super().destroy(request, *args, **kwargs)
+
+    def add_revision_headers(self, response):
+        if self.etag is not None:
+            response['ETag'] = self.etag
+            response['Last-Modified'] = http_date(self.last_modified)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, StaleRevision):
+            exc = PreconditionFailed()
+        elif isinstance(exc, ConcurrentUpdate):
+            exc = Conflict()
+        elif isinstance(exc, Movie.DoesNotExist):
+            exc = Http404()
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if 200 <= response.status_code < 300:
+            self.add_revision_headers(response)
+        return response
+
+class TopMoviesViewSet(RevisionMixin, viewsets.ModelViewSet):
 
     queryset = TopMovies.objects.all()
     serializer_class = TopMoviesSerializer
+    ordering = ('id',)
+
+    def get_queryset(self):
+        fields = get_query_list(self.request, 'fields')
+        if self.action in ('list', 'retrieve') and (not fields or 'movie' in fields):
+            return TopMovies.objects.with_movies()
+        return super().get_queryset()
+
+    def get_revision(self):
+        top_movies_id = self.kwargs['pk']
+        return (top_movies_id,) + TopMovies.objects.get_revision(top_movies_id)
+
+    def retrieve(self, request, *args, **kwargs):
+        response = self.check_revision(request)
+        if response is not None:
+            return response
+        if self.revision is None:
+            return super().retrieve(request, *args, **kwargs)
+        # Keyed on the revision just read from the database, so a worker with
+        # its own cache never serves a payload a write in another one replaced.
+        query = urlencode(sorted(request.query_params.lists()), doseq=True)
+        variant = f'{quote(request.accepted_media_type)}:{query}'
+        key = payload_cache.payload_key(kwargs['pk'], self.revision, variant)
+        payload = payload_cache.get(key)
+        if payload is not None:
+            content, content_type = payload
+            response = HttpResponse(content, content_type=content_type)
+            response['X-Cache'] = 'HIT'
+            return response
+        self.cache_key = key
+        response = super().retrieve(request, *args, **kwargs)
+        response['X-Cache'] = 'MISS'
+        return response
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            self.claim_revision(serializer.instance.pk)
+            serializer.save()
+        self.load_revision()
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            self.claim_revision(instance.pk)
+            instance.delete()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'cache_key', None) and response.status_code == 200:
+            response.render()
+            payload_cache.set(self.cache_key, (response.content, response['Content-Type']))
+        return response
 
     @action(detail=False, methods=["post"])
     def new(self, request):
+        if isinstance(request.data, list):
+            serializer = MovieSerializer(data=request.data, many=True, context=self.get_serializer_context())
+            if serializer.is_valid():
+                with transaction.atomic():
+                    new_top_movies = TopMovies.objects.create()
+                    serializer.save(top_movies=new_top_movies)
+                return Response(self.get_serializer(new_top_movies).data, status=status.HTTP_201_CREATED)
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         new_top_movies = TopMovies.objects.create()
-        serializer = MovieSerializer(data=request.data)
+        serializer = MovieSerializer(data=request.data, context=self.get_serializer_context())
         if serializer.is_valid():
             serializer.save(top_movies=new_top_movies)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -24,38 +186,177 @@ class TopMoviesViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=["post"])
     def add(self, request, pk=None):
         top_movies = self.get_object()
-        serializer = MovieSerializer(data=request.data)
+        serializer = MovieSerializer(data=request.data, context=self.get_serializer_context())
         if serializer.is_valid():
             serializer.save(top_movies=top_movies)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class MovieViewSet(viewsets.ModelViewSet):
+    @action(detail=True, methods=["post"], url_path="add-many")
+    def add_many(self, request, pk=None):
+        top_movies = self.get_object()
+        serializer = MovieSerializer(data=request.data, many=True, context=self.get_serializer_context())
+        if serializer.is_valid():
+            serializer.save(top_movies=top_movies)
+            return Response(self.get_serializer(top_movies).data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=True, methods=["put"])
+    def order(self, request, pk=None):
+        response = self.check_revision(request)
+        if response is not None:
+            return response
+        top_movies = self.get_object()
+        serializer = MovieOrderSerializer(data=request.data, context={'top_movies': top_movies})
+        if serializer.is_valid():
+            try:
+                top_movies.set_order(serializer.validated_data['order'], self.expected_revision)
+            except ValidationError as e:
+                return Response({'order': e.messages}, status=status.HTTP_400_BAD_REQUEST)
+            self.load_revision()
+            return Response(self.get_serializer(top_movies).data)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+class MovieViewSet(RevisionMixin, viewsets.ModelViewSet):
 
     queryset = Movie.objects.all()
     serializer_class = MovieSerializer
+    ordering = ('top_movies', 'position', 'id')
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if 'top_movies' in get_query_list(self.request, 'expand'):
+            queryset = Movie.objects.with_top_movies()
+        if self.action == 'list':
+            queryset = Movie.objects.with_list_rank(queryset)
+        return queryset
+
+    def get_revision(self):
+        return Movie.objects.get_list_revision(self.kwargs['pk'])
+
+    def retrieve(self, request, *args, **kwargs):
+        response = self.check_revision(request)
+        if response is not None:
+            return response
+        return super().retrieve(request, *args, **kwargs)
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            self.claim_revision(serializer.instance.top_movies_id)
+            serializer.save()
+        self.load_revision()
+
+    def perform_destroy(self, instance):
+        instance.delete_rank(self.expected_revision)
 
     @action(detail=True, methods=["put", "delete"], url_path="delete-rank")
     def delete_rank(self, request, pk=None):
+        response = self.check_revision(request)
+        if response is not None:
+            return response
         movie = self.get_object()
         top_movies = movie.top_movies
-        serializer = TopMoviesSerializer(top_movies)
-        movie.delete_rank()
+        serializer = TopMoviesSerializer(top_movies, context=self.get_serializer_context())
+        movie.delete_rank(self.expected_revision)
+        self.load_revision(top_movies.id)
         # return Response(status=status.HTTP_204_NO_CONTENT)
         return Response(serializer.data)
 
     @action(detail=True, methods=["put"], url_path="move-rank-up")
     def move_rank_up(self, request, pk=None):
+        response = self.check_revision(request)
+        if response is not None:
+            return response
         movie = self.get_object()
-        current_rank = movie.rank
-        movie.reorder_rank(current_rank-1)
+        movie.reorder_rank(delta=-1, expected_revision=self.expected_revision)
+        self.load_revision()
         serializer = self.get_serializer(movie)
         return Response(serializer.data)
     
     @action(detail=True, methods=["put"], url_path="move-rank-down")
     def move_rank_down(self, request, pk=None):
+        response = self.check_revision(request)
+        if response is not None:
+            return response
         movie = self.get_object()
-        current_rank = movie.rank
-        movie.reorder_rank(current_rank+1)
+        movie.reorder_rank(delta=1, expected_revision=self.expected_revision)
+        self.load_revision()
         serializer = self.get_serializer(movie)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(serializer.data)
+
+    @action(detail=True, methods=["put"], url_path="move-to")
+    def move_to(self, request, pk=None):
+        serializer = MoveToSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        response = self.check_revision(request)
+        if response is not None:
+            return response
+        movie = self.get_object()
+        current_rank = movie.get_rank()
+        movie.reorder_rank(serializer.validated_data['rank'], expected_revision=self.expected_revision)
+        self.load_revision()
+        rank = movie.get_rank()
+        if rank < current_rank:
+            shifted = {'start': rank, 'end': current_rank - 1, 'delta': 1}
+        elif rank > current_rank:
+            shifted = {'start': current_rank + 1, 'end': rank, 'delta': -1}
+        else:
+            shifted = None
+        return Response({
+            'id': movie.id,
+            'top_movies': movie.top_movies_id,
+            'previous_rank': current_rank,
+            'rank': rank,
+            'shifted': shifted,
+        })
+
+
+class LeaderboardViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
+
+    queryset = Film.objects.filter(list_count__gt=0)
+    serializer_class = LeaderboardSerializer
+    ordering = ('-score', 'id')
+
+
+@require_GET
+def export(request):
+    # A full dump is costly, so it is kept to the same admins as IsAdminUser.
+    # DRF would take ?format for its own format suffix.
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return HttpResponseBadRequest(f'Unknown format, use one of: {", ".join(EXPORT_FORMATS)}.')
+    try:
+        min_id, max_id = [
+            int(request.GET[name]) if request.GET.get(name) else None
+            for name in ('min_id', 'max_id')
+        ]
+    except ValueError:
+        return HttpResponseBadRequest('min_id and max_id must be integers.')
+    response = StreamingHttpResponse(
+        export_lists(export_format, min_id, max_id),
+        content_type=EXPORT_FORMATS[export_format],
+    )
+    response['Content-Disposition'] = f'attachment; filename="top-movies.{export_format}"'
+    return response
+
+
+@require_GET
+def metrics(request):
+    if not getattr(settings, 'API_METRICS_ENABLED', False):
+        raise Http404
+    token = getattr(settings, 'API_METRICS_TOKEN', None)
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAdminUser])
+def slow_queries(request):
+    if request.method == 'DELETE':
+        slow_query_log.clear()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    return Response(slow_query_log.entries())
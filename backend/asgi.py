@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+# What get_asgi_application() does, with a handler that can also stream
+# list events, see api.async_views.
+django.setup(set_prefix=False)
+
+from api.async_views import ASGIHandler  # noqa: E402
+
+application = ASGIHandler()
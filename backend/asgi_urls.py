@@ -0,0 +1,13 @@
+"""URLconf for requests served by backend.asgi
+
+The API routes come from api.async_views, where the hot read endpoints are
+async views that run the regular ones on a bounded thread pool. Everything
+else is backend.urls, so both URLconfs serve the same paths.
+"""
+from django.urls import path, include
+
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    path('api/v1/', include('api.async_views')),
+] + sync_urlpatterns
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import os
+import tempfile
 import django_heroku
 from pathlib import Path
 import dj_database_url
@@ -51,7 +53,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.async_views.AsyncRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'api.metrics.MetricsMiddleware',
+    'api.timing.ServerTimingMiddleware',
+    'api.slow_queries.SlowQueryMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -99,6 +105,70 @@ DATABASES = {
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'movie-ranking',
+    },
+    # Shared by every worker process and manage.py slow_queries.
+    'slow-queries': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'movie-ranking-slow-queries'),
+    },
+}
+
+API_CACHE_ALIAS = 'default'
+
+API_CACHE_TIMEOUT = 300
+
+# Fraction of requests that get a Server-Timing header and a log line with
+# their query count and DB, serializer and render times. 0 disables it.
+API_TIMING_SAMPLE_RATE = 0
+
+# Prometheus metrics served at /metrics. With several worker processes, set
+# API_METRICS_DIR to a directory they share and empty it on each deploy.
+API_METRICS_ENABLED = True
+
+API_METRICS_DIR = os.environ.get('API_METRICS_DIR')
+
+API_METRICS_TOKEN = os.environ.get('API_METRICS_TOKEN')
+
+# Statements slower than this many milliseconds are logged with their
+# EXPLAIN plan to a ring buffer of API_SLOW_QUERY_LOG_SIZE entries. None
+# disables the hook.
+API_SLOW_QUERY_MS = None
+
+API_SLOW_QUERY_LOG_SIZE = 100
+
+API_SLOW_QUERY_CACHE_ALIAS = 'slow-queries'
+
+# 'orjson' or 'json'. None picks orjson when it is installed.
+API_JSON_BACKEND = None
+
+# Under ASGI, the list, movie and root endpoints are served by async views
+# from API_ASYNC_URLCONF. Their ORM work runs on a pool of API_ASYNC_THREADS
+# threads per process, each holding its own database connection. 0 runs it
+# on the single thread-sensitive thread instead.
+API_ASYNC_URLCONF = 'backend.asgi_urls'
+
+API_ASYNC_THREADS = 8
+
+# Rank changes are streamed to viewers of a list over ASGI at
+# /api/v1/top-movies/<id>/events/. On PostgreSQL they reach the viewers of
+# every worker through LISTEN/NOTIFY. LocalBackend only reaches viewers
+# connected to the same process and refuses to run with WEB_CONCURRENCY > 1.
+# The last API_EVENTS_HISTORY events of each list are kept for clients that
+# reconnect with a Last-Event-ID.
+API_EVENTS_BACKEND = 'api.events.LocalBackend'
+
+API_EVENTS_HISTORY = 100
+
+# Seconds between heartbeat comments on an idle stream.
+API_EVENTS_HEARTBEAT = 15
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -152,10 +222,41 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.AllowAny',
     ],
     'DEFAULT_RENDERER_CLASSES': (
-        'rest_framework.renderers.JSONRenderer',
-    )
+        'api.renderers.JSONRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'api.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.KeysetPagination',
+    'PAGE_SIZE': 100,
 }
 
+# SQLite gets a plain unique index in place of the deferrable
+# movie_list_rank_uniq constraint (see api/migrations/0010).
+SILENCED_SYSTEM_CHECKS = ['models.W038']
+
 FIXTURE_DIRS = [(BASE_DIR / "fixtures")]
 
-django_heroku.settings(locals())
\ No newline at end of file
+django_heroku.settings(locals())
+
+# WhiteNoise 5 is sync-only and, first in line, would hold the one
+# thread-sensitive thread for the whole of every ASGI request.
+MIDDLEWARE = tuple(
+    'api.async_views.WhiteNoiseMiddleware' if name == 'whitenoise.middleware.WhiteNoiseMiddleware' else name
+    for name in MIDDLEWARE
+)
+
+LOGGING['loggers']['api'] = {
+    'handlers': ['console'],
+    'level': 'INFO',
+}
+
+if 'postgresql' in DATABASES['default']['ENGINE']:
+    API_EVENTS_BACKEND = 'api.events.PostgresBackend'
+
+# The rank edit stress tests share the test database between threads, which
+# an in-memory SQLite database cannot do.
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('TEST', {}).setdefault('NAME', str(BASE_DIR / 'test_db.sqlite3'))